@@ -5,21 +5,47 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import json
+import math
+import hashlib
+import ctypes
+import itertools
+import threading
+import collections
+import multiprocessing
+from multiprocessing.managers import BaseManager
+
 import yaml
 import numpy as np
 import librosa
-from utils.util import batch_indexer, token_indexer
+import scipy.signal
+from six.moves import queue
+from utils.batching import batch_indexer, get_indexer, pack_rows, shard_batches, GlobalBatchSampler
+from utils.audio import WavReader, ArchiveReader, is_archive, write_wav, pcm_to_float, pcm_to_int16
+from utils.indexed import IndexedArray, IndexedArrayBuilder, ShardedIndexedArray, shard_prefix
+
+
+def resample_audio(data, rate, sample_rate, method='librosa'):
+    """Resample a waveform with librosa's default (high quality) resampler, or a fast polyphase filter"""
+    if method == 'polyphase':
+        factor = math.gcd(rate, sample_rate)
+        return scipy.signal.resample_poly(data, sample_rate // factor, rate // factor).astype(np.float32)
+    if method == 'librosa':
+        return librosa.resample(data, orig_sr=rate, target_sr=sample_rate)
+    raise ValueError("Unknown resample method {}".format(method))
 
 
-def audio_encode(wav_path, offset=0.0, duration=None, sample_rate=16000):
+def audio_encode(wav_path, offset=0.0, duration=None, sample_rate=16000, resample='librosa'):
     """
     Encoding audio files into float list given the offset and duration
     We assume the sample rate to be 16k.
+    wav_path may also be a file-like object, such as an archive member.
     """
     # load data, sr=None enforce to use the native sample rate
     data, rate = librosa.load(wav_path, sr=None, offset=offset, duration=duration)
     if sample_rate is not None and rate != sample_rate:
-        data, rate = librosa.load(wav_path, sr=sample_rate, offset=offset, duration=duration)
+        # resample the decoded audio, instead of decoding again at the target rate
+        data, rate = resample_audio(data, rate, sample_rate, method=resample), sample_rate
     assert len(data.shape) == 1 and rate == sample_rate, (data.shape, rate)
 
     if data.dtype not in [np.float32, np.float64]:
@@ -27,7 +53,86 @@ def audio_encode(wav_path, offset=0.0, duration=None, sample_rate=16000):
     return data.astype(np.float32)
 
 
+def truncate_ids(ids, max_len, eos):
+    """Keep the same truncation as Vocab.to_id on the first max_len tokens of stored ids, eos included"""
+    if max_len is None or len(ids) <= max_len + 1:
+        return ids
+    return np.append(ids[:max_len], eos).astype(ids.dtype)
+
+
+def ragged_positions(sequences, max_len):
+    """Row, column and value of every id of `sequences` cut at max_len, as flat arrays"""
+    lengths = np.minimum([len(sequence) for sequence in sequences], max_len)
+    if lengths.sum() == 0:
+        values = np.zeros([0], dtype=np.int32)
+    else:
+        values = np.concatenate([np.asarray(sequence[:length], dtype=np.int32)
+                                 for sequence, length in zip(sequences, lengths.tolist())])
+
+    rows = np.repeat(np.arange(len(sequences), dtype=np.int64), lengths)
+    # position within the row: global position minus the row start
+    starts = np.cumsum(lengths) - lengths
+    cols = np.arange(len(values), dtype=np.int64) - np.repeat(starts, lengths)
+    return rows, cols, values
+
+
+# packed segments start on encoder frames, which stack 3 feature frames (see models/transformer.py)
+PACK_ALIGN = 3
+
+
+def pack_align(frames):
+    """Round frame lengths up to whole encoder frames"""
+    return -(-frames // PACK_ALIGN) * PACK_ALIGN
+
+
+class BatchBuffers(object):
+    """Reusable arrays for collating batches, one per name and size bucket
+
+    Buckets grow by powers of two, so a handful of buffers serve all batch shapes. An array
+    returned by `get` is overwritten by the next request of the same name and bucket: this is
+    only safe when every batch is copied out before the next one is collated, as the shared
+    memory transport of utils.queuer does.
+    """
+
+    def __init__(self, min_size=4096):
+        self.min_size = min_size
+        self._buffers = {}
+
+    def get(self, name, shape, dtype):
+        size = int(np.prod(shape))
+        bucket = max(self.min_size, 1 << max(size - 1, 0).bit_length())
+        key = (name, np.dtype(dtype).str, bucket)
+        if key not in self._buffers:
+            self._buffers[key] = np.empty([bucket], dtype=dtype)
+        return self._buffers[key][:size].reshape(shape)
+
+
+def resampled_path(cache_dir, audio_path, name, sample_rate):
+    """Location of the source audio file `name` of `audio_path` resampled to `sample_rate` in the cache"""
+    # one sub-directory per audio path and rate, as file names may repeat across audio paths
+    source_id = hashlib.md5(os.path.abspath(audio_path).encode('utf-8')).hexdigest()[:12]
+    subdir = "{}-{}".format(sample_rate, source_id)
+    return os.path.join(cache_dir, subdir, os.path.splitext(name)[0] + ".wav")
+
+
+def check_binarized(prefix, vocab):
+    """Make sure that the text file at `prefix` was binarised with the same vocabulary"""
+    with open(prefix + ".json", 'r', encoding='utf-8') as reader:
+        meta = json.load(reader)
+    if meta['vocab_size'] != vocab.size():
+        raise ValueError("{} is binarised with a vocabulary of {} tokens, but {} is used, please re-binarise it"
+                         "".format(prefix, meta['vocab_size'], vocab.size()))
+    # same size, but other tokens or another order (e.g. rebuilt with another --min_freq or corpus)
+    if meta.get('vocab_hash') != vocab.digest():
+        raise ValueError("{} is binarised with another vocabulary of {} tokens, please re-binarise it"
+                         "".format(prefix, vocab.size()))
+
+
 def get_rough_length(audio_infor, p):
+    if 'frames' in audio_infor:
+        # precomputed when loading the data
+        return audio_infor['frames']
+
     duration = audio_infor['duration']  # in seconds
     # total signals
     num_signal = int(duration * p.audio_sample_rate)
@@ -38,6 +143,310 @@ def get_rough_length(audio_infor, p):
     return num_frame
 
 
+class _CacheIndex(object):
+    """Bookkeeping of the audio cache, hosted by a manager process
+    Maps keys to lists of arena blocks in least-recently-used order.
+    """
+
+    def __init__(self, num_blocks, block_size):
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.entries = collections.OrderedDict()
+        self.free_blocks = list(range(num_blocks))[::-1]
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'inserts': 0}
+
+    def lookup(self, key):
+        if key not in self.entries:
+            self.counters['misses'] += 1
+            return None
+        self.counters['hits'] += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def allocate(self, key, dtype, length, nbytes):
+        if key in self.entries:
+            return None
+        num_blocks = (nbytes + self.block_size - 1) // self.block_size
+        if num_blocks > self.num_blocks:
+            return None
+
+        # evict least recently used entries until the new one fits
+        while len(self.free_blocks) < num_blocks:
+            _, (blocks, _, _) = self.entries.popitem(last=False)
+            self.free_blocks.extend(blocks)
+            self.counters['evictions'] += 1
+
+        blocks = [self.free_blocks.pop() for _ in range(num_blocks)]
+        self.entries[key] = (blocks, dtype, length)
+        self.counters['inserts'] += 1
+        return blocks
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats['entries'] = len(self.entries)
+        stats['bytes'] = (self.num_blocks - len(self.free_blocks)) * self.block_size
+        return stats
+
+
+class _CacheManager(BaseManager):
+    pass
+
+
+_CacheManager.register('CacheIndex', _CacheIndex)
+
+
+class AudioCache(object):
+    """Byte-bounded LRU cache of decoded waveforms shared by all data workers
+
+    Waveforms are stored in a shared arena of fixed-size blocks allocated before the
+    workers are forked, while the key => blocks index lives in a manager process.
+    All accesses are serialized by one lock, which only guards memory copies.
+    """
+
+    def __init__(self, capacity, block_size=32768):
+        num_blocks = max(capacity // block_size, 1)
+        self.block_size = block_size
+
+        self._arena = multiprocessing.RawArray(ctypes.c_char, num_blocks * block_size)
+        self._lock = multiprocessing.Lock()
+
+        self._manager = _CacheManager()
+        self._manager.start()
+        self._index = self._manager.CacheIndex(num_blocks, block_size)
+
+    def _blocks(self):
+        return np.frombuffer(self._arena, dtype=np.uint8).reshape([-1, self.block_size])
+
+    def get(self, key):
+        with self._lock:
+            entry = self._index.lookup(key)
+            if entry is None:
+                return None
+            blocks, dtype, length = entry
+
+            data = np.empty(length, dtype=dtype)
+            view = data.view(np.uint8)
+            arena = self._blocks()
+            for bidx, block in enumerate(blocks):
+                chunk = view[bidx * self.block_size: (bidx + 1) * self.block_size]
+                chunk[:] = arena[block, :len(chunk)]
+        return data
+
+    def put(self, key, data):
+        data = np.ascontiguousarray(data)
+        view = data.view(np.uint8).reshape([-1])
+
+        with self._lock:
+            blocks = self._index.allocate(key, data.dtype.str, len(data), view.nbytes)
+            if blocks is None:
+                return
+            arena = self._blocks()
+            for bidx, block in enumerate(blocks):
+                chunk = view[bidx * self.block_size: (bidx + 1) * self.block_size]
+                arena[block, :len(chunk)] = chunk
+
+    def stats(self):
+        """hits, misses, evictions, inserts, and the current number of entries/bytes"""
+        return self._index.stats()
+
+
+class Manifest(object):
+    """Columnar, memory-mapped training manifest produced by Dataset.compile_manifest
+
+    Layout under the manifest directory:
+        - wavs.txt: wav file names, referred to by position
+        - wav.npy, offset.npy, duration.npy, frames.npy: one value per segment
+        - tgt.bin/idx, ctc.bin/idx: untruncated target and ctc ids, eos included
+        - meta.json: vocabulary sizes and hashes, and audio settings used for compiling
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json"), 'r', encoding='utf-8') as reader:
+            self.meta = json.load(reader)
+        with open(os.path.join(path, "wavs.txt"), 'r', encoding='utf-8') as reader:
+            self.wavs = [line.rstrip('\n') for line in reader]
+
+        self.wav = np.load(os.path.join(path, "wav.npy"), mmap_mode='r')
+        self.offset = np.load(os.path.join(path, "offset.npy"), mmap_mode='r')
+        self.duration = np.load(os.path.join(path, "duration.npy"), mmap_mode='r')
+        self.frames = np.load(os.path.join(path, "frames.npy"), mmap_mode='r')
+
+        self.tgt = IndexedArray(os.path.join(path, "tgt"))
+        self.ctc = IndexedArray(os.path.join(path, "ctc"))
+
+    def __len__(self):
+        return len(self.wav)
+
+    def check(self, p, src_vocab, tgt_vocab):
+        expected = {
+            'audio_sample_rate': p.audio_sample_rate,
+            'audio_frame_step': p.audio_frame_step,
+            'src_vocab_size': src_vocab.size(),
+            'tgt_vocab_size': tgt_vocab.size(),
+            'src_vocab_hash': src_vocab.digest(),
+            'tgt_vocab_hash': tgt_vocab.digest(),
+        }
+        for key, value in expected.items():
+            if self.meta.get(key) != value:
+                raise ValueError("Manifest is compiled with {}={}, but {} is used, please re-compile it"
+                                 "".format(key, self.meta.get(key), value))
+
+
+class _CorpusShard(object):
+    """One shard of a ShardedCorpus: src/tgt/ctc indexed arrays plus frames and source rows"""
+
+    def __init__(self, prefix):
+        self.src = IndexedArray(prefix + ".src")
+        self.tgt = IndexedArray(prefix + ".tgt")
+        self.ctc = IndexedArray(prefix + ".ctc")
+        self.frames = np.load(prefix + ".frames.npy")
+        self.rows = np.load(prefix + ".rows.npy")
+
+    def __len__(self):
+        return len(self.frames)
+
+    def read(self, start, end, base=0):
+        """Read entries [start, end) with one sequential read per id field, sources are left in place
+        Entries are numbered from `base`, the position of the shard in its corpus.
+        """
+        def _split(array):
+            offsets = array.offsets[start: end + 1]
+            block = np.array(array.data[offsets[0]: offsets[-1]])
+            return np.split(block, (offsets[1:-1] - offsets[0]).tolist())
+
+        tgts, ctcs = _split(self.tgt), _split(self.ctc)
+        frames, rows = self.frames[start:end].tolist(), self.rows[start:end].tolist()
+        return list(zip(rows, frames, range(base + start, base + end), tgts, ctcs))
+
+
+class ShardedCorpus(object):
+    """Training samples packed into shards by scripts/pack_shards.py
+    Every shard holds waveforms (or features), target ids and ctc ids of its samples. Ids are read
+    in blocks of consecutive entries, with a few large sequential reads instead of one file access
+    per segment. Sources stay in the memory-mapped shard until a worker collates the batch, so
+    samples dropped by batch sharding are never read.
+    Files under the corpus directory:
+        - meta.json: shard number, source type and the settings used for packing
+        - shard.NNNNN.{src,tgt,ctc}.bin/idx: indexed arrays, ids are untruncated with eos
+        - shard.NNNNN.frames.npy, shard.NNNNN.rows.npy: rough frame lengths and source line numbers
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json"), 'r', encoding='utf-8') as reader:
+            self.meta = json.load(reader)
+
+        self.shards = [_CorpusShard(shard_prefix(os.path.join(path, "shard"), i))
+                       for i in range(self.meta['num_shards'])]
+        self.bounds = np.cumsum([0] + [len(shard) for shard in self.shards])
+
+    def __len__(self):
+        return int(self.bounds[-1])
+
+    def check(self, p, src_vocab, tgt_vocab):
+        expected = {
+            'input_type': p.input_type,
+            'audio_sample_rate': p.audio_sample_rate,
+            'audio_frame_step': p.audio_frame_step,
+            'src_vocab_size': src_vocab.size(),
+            'tgt_vocab_size': tgt_vocab.size(),
+            'src_vocab_hash': src_vocab.digest(),
+            'tgt_vocab_hash': tgt_vocab.digest(),
+        }
+        for key, value in expected.items():
+            if self.meta.get(key) != value:
+                raise ValueError("Shards are packed with {}={}, but {} is used, please re-pack them"
+                                 "".format(key, self.meta.get(key), value))
+
+    def _locate(self, i):
+        shard = int(np.searchsorted(self.bounds, i, side='right')) - 1
+        return shard, int(i - self.bounds[shard])
+
+    def entry(self, i):
+        shard, index = self._locate(i)
+        return self.shards[shard].read(index, index + 1, base=int(self.bounds[shard]))[0]
+
+    def source(self, i):
+        """Waveform (or features) of entry i"""
+        shard, index = self._locate(i)
+        return self.shards[shard].src[index]
+
+    def lengths(self):
+        """Frames, target lengths and ctc lengths of all entries"""
+        return (np.concatenate([shard.frames for shard in self.shards]),
+                np.concatenate([shard.tgt.lengths() for shard in self.shards]),
+                np.concatenate([shard.ctc.lengths() for shard in self.shards]))
+
+    def _shard_blocks(self, sidx, rng, shuffle, block_size):
+        shard = self.shards[sidx]
+        starts = np.arange(0, len(shard), block_size)
+        if shuffle:
+            rng.shuffle(starts)
+        for start in starts.tolist():
+            block = shard.read(start, min(start + block_size, len(shard)), base=int(self.bounds[sidx]))
+            if shuffle:
+                block = [block[i] for i in rng.permutation(len(block))]
+            yield block
+
+    def iterate(self, seed=None, shuffle=True, parallel=4, block_size=256):
+        """Yield (row, frames, entry index, tgt ids, ctc ids) entries, see `source` for reading sources
+
+        Shards are visited in a random order, each in shuffled blocks of consecutive entries.
+        `parallel` shards are read at the same time by background threads, and their blocks are
+        interleaved round-robin, so the output only depends on the seed.
+        """
+        rng = np.random.RandomState(seed)
+        shard_order = rng.permutation(len(self.shards)) if shuffle else np.arange(len(self.shards))
+        shard_seeds = rng.randint(0, 2 ** 31 - 1, size=len(self.shards))
+
+        # set when the iteration ends, even early: readers then stop instead of blocking on a full queue
+        stop = threading.Event()
+
+        def _put(_blocks, _item):
+            while not stop.is_set():
+                try:
+                    _blocks.put(_item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def _reader(_sidx, _blocks):
+            _rng = np.random.RandomState(shard_seeds[_sidx])
+            for _block in self._shard_blocks(_sidx, _rng, shuffle, block_size):
+                if not _put(_blocks, _block):
+                    return
+            _put(_blocks, None)
+
+        threads = []
+
+        def _start(_sidx):
+            _blocks = queue.Queue(2)
+            _thread = threading.Thread(target=_reader, args=(_sidx, _blocks))
+            _thread.daemon = True
+            _thread.start()
+            threads.append(_thread)
+            return _blocks
+
+        pending = collections.deque(shard_order.tolist())
+        active = collections.deque()
+        try:
+            while len(pending) > 0 or len(active) > 0:
+                while len(pending) > 0 and len(active) < max(parallel, 1):
+                    active.append(_start(pending.popleft()))
+
+                blocks = active.popleft()
+                block = blocks.get()
+                if block is None:
+                    continue
+                active.append(blocks)
+                for entry in block:
+                    yield entry
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+
 class Dataset(object):
     def __init__(self,
                  params,
@@ -48,13 +457,35 @@ class Dataset(object):
                  ctc_file='',                   # either translation or transcript file
                  batch_or_token='batch',
                  data_leak_ratio=0.5,
-                 src_audio_path=''):
+                 src_audio_path='',
+                 audio_cache=None,              # shared AudioCache of decoded waveforms
+                 resample_cache='',             # directory of source files resampled once to 16-bit wav
+                 src_feature_path='',           # offline logmel features, for input_type=features
+                 manifest='',                   # compiled manifest replacing the source/target/ctc files
+                 batch_sampler='buffer',        # buffer: sort within buffers, global: sort the whole corpus
+                 shards='',                     # packed shards replacing the audio, source/target/ctc files
+                 tgt_bin='',                    # binarised target files, replacing the text ones
+                 ctc_bin='',                    # binarised ctc files, replacing the text ones
+                 cost_model=None,               # BatchCostModel filling token batches to a predicted cost
+                 packing='greedy',              # token batch boundaries: greedy, or dp minimising padding
+                 pack_sequences=False,          # pack several samples into each row, for training
+                 num_shards=1,                  # number of training processes splitting the batches
+                 shard_index=0):                # the share of batches taken by this process
         self.source = src_file
         self.target = tgt_file
         self.src_vocab = src_vocab         # Note source vocabulary here is meaningless
         self.tgt_vocab = tgt_vocab
         self.batch_or_token = batch_or_token
         self.data_leak_ratio = data_leak_ratio
+        self.batch_sampler = batch_sampler
+        self._global_sampler = None
+        self.cost_model = cost_model if batch_or_token == 'token' else None
+        self.packing = packing
+
+        if not 0 <= shard_index < num_shards:
+            raise ValueError("Invalid shard index {} of {} shards".format(shard_index, num_shards))
+        self.num_shards = num_shards
+        self.shard_index = shard_index
 
         self.p = params
         self.sr = params.audio_sample_rate
@@ -69,38 +500,366 @@ class Dataset(object):
 
         self.leak_buffer = []
 
+        self.manifest = None
+        if manifest != '':
+            self.manifest = Manifest(manifest)
+            self.manifest.check(params, src_vocab, tgt_vocab)
+
+        # prefixes of the binarised target/ctc files, written with their vocabularies
+        self.tgt_bin = tgt_bin
+        self.ctc_bin = ctc_bin
+        for prefixes, vocab in [(tgt_bin, tgt_vocab), (ctc_bin, src_vocab)]:
+            if prefixes != '':
+                for prefix in prefixes.strip().split(";"):
+                    check_binarized(prefix, vocab)
+
+        self.shards = None
+        if shards != '':
+            self.shards = ShardedCorpus(shards)
+            self.shards.check(params, src_vocab, tgt_vocab)
+
+        # waveforms travel as int16 pcm up to the model, which scales them on the device
+        self.pcm_int16 = params.input_type == 'audio' and params.audio_dtype == 'int16'
+
+        # batches are collated into reused arrays when workers hand them over through shared memory
+        self.batch_buffers = None
+        if params.collate_buffers and params.shm_slots > 0 and params.process_num > 0:
+            self.batch_buffers = BatchBuffers()
+
+        # memory-mapped reader for plain wav files, librosa handles the others
+        self.wav_reader = WavReader() if params.audio_reader == 'mmap' else None
+        # src_audio_path may also be a tar or zip archive, its members are read in place
+        self.archive = None
+        if params.input_type == 'audio' and is_archive(src_audio_path):
+            self.archive = ArchiveReader(src_audio_path)
+        # source files which cannot be sliced directly (other rates or formats) are decoded and
+        # resampled once into the cache, and sliced from there
+        self.resample_cache = resample_cache if resample_cache != '' else None
+        self.cache_reader = None
+        if self.resample_cache is not None:
+            self.cache_reader = self.wav_reader if self.wav_reader is not None else WavReader()
+        self.audio_cache = audio_cache
+        # cached segments are keyed by their audio root as well, as datasets share one cache
+        self.audio_root = os.path.abspath(src_audio_path)
+
+        # offline features are row-aligned with the source yaml files, see scripts/extract_features.py
+        self.feature_store = None
+        if params.input_type == 'features':
+            if self.shards is None:
+                self.feature_store = ShardedIndexedArray(src_feature_path)
+            # max_frame_len counts audio samples, convert it into feature frames
+            frame_step = int(params.audio_frame_step * self.sr / 1e3)
+            self.max_frame_len = (self.max_frame_len + frame_step - 1) // frame_step
+
+        # batches are lists of rows, filled with samples up to the longest source and target a
+        # row may hold, in feature frames and tokens
+        self.pack_capacity = None
+        if pack_sequences:
+            # source units (audio samples or feature vectors) per feature frame
+            self.pack_step = 1 if params.input_type == 'features' \
+                else int(params.audio_frame_step * self.sr / 1e3)
+            self.pack_capacity = [self.max_frame_len // self.pack_step // PACK_ALIGN * PACK_ALIGN,
+                                  self.max_text_len]
+
     # loading dataset
-    def load_data(self, is_train=False):
-        sources = self.source.strip().split(";")
-        targets = self.target.strip().split(";")
-        ctcrefs = self.ctcref.strip().split(";")
+    def load_data(self, is_train=False, seed=None):
+        if self.shards is not None:
+            for sample in self.load_shards(is_train, seed=seed):
+                yield sample
+            return
 
-        for source, target, ctcref in zip(sources, targets, ctcrefs):
-            with open(source, 'r', encoding='utf-8') as src_reader, \
-                    open(target, 'r', encoding='utf-8') as tgt_reader, \
-                    open(ctcref, 'r', encoding='utf-8') as ctc_reader:
+        if self.manifest is not None:
+            for sample in self.load_manifest(is_train):
+                yield sample
+            return
 
-                while True:
-                    src_line = src_reader.readline()
-                    tgt_line = tgt_reader.readline()
-                    ctc_line = ctc_reader.readline()
+        sources = self.source.strip().split(";")
+        targets = self.id_streams(self.target, self.tgt_bin, self.tgt_vocab)
+        ctcrefs = self.id_streams(self.ctcref, self.ctc_bin, self.src_vocab)
 
-                    if tgt_line == "" or src_line == "" or ctc_line == "":
-                        break
+        row = -1
+        for source, target, ctcref in zip(sources, targets, ctcrefs):
+            with open(source, 'r', encoding='utf-8') as src_reader:
+                # stops at the end of the shortest file
+                for src_line, tgt_ids, ctc_ids in zip(src_reader, target, ctcref):
+                    row += 1
 
                     src_line = src_line.strip()
-                    tgt_line = tgt_line.strip()
-                    ctc_line = ctc_line.strip()
 
-                    if is_train and (tgt_line == "" or src_line == "" or ctc_line == ""):
+                    # empty text lines only hold the eos
+                    if is_train and (len(tgt_ids) <= 1 or src_line == "" or len(ctc_ids) <= 1):
                         continue
 
+                    audio_infor = yaml.safe_load(src_line)[0]
+                    # global line number over all source files, locating offline features
+                    audio_infor['row'] = row
+                    audio_infor['frames'] = get_rough_length(audio_infor, self.p)
+
                     yield (
-                        yaml.safe_load(src_line)[0],
-                        self.tgt_vocab.to_id(tgt_line.split()[:self.max_text_len]),
-                        self.src_vocab.to_id(ctc_line.split()[:self.max_text_len]),
+                        audio_infor,
+                        tgt_ids,
+                        ctc_ids,
                     )
 
+    def id_streams(self, text_files, bin_prefixes, vocab):
+        """Token ids of every line, one stream per file: read from the binarised copies when given
+        (array views, see vocab.py --binarize), converted from the text files otherwise (lists)
+        """
+        def _text_ids(_path):
+            with open(_path, 'r', encoding='utf-8') as reader:
+                for line in reader:
+                    yield vocab.to_id(line.strip().split()[:self.max_text_len])
+
+        def _binary_ids(_prefix):
+            array, eos = IndexedArray(_prefix), vocab.eos()
+            for i in range(len(array)):
+                yield truncate_ids(array[i], self.max_text_len, eos)
+
+        if bin_prefixes != '':
+            return [_binary_ids(prefix) for prefix in bin_prefixes.strip().split(";")]
+        return [_text_ids(path) for path in text_files.strip().split(";")]
+
+    def load_manifest(self, is_train=False, chunk_size=10000):
+        m = self.manifest
+        eos = self.tgt_vocab.eos(), self.src_vocab.eos()
+
+        for start in range(0, len(m), chunk_size):
+            end = min(start + chunk_size, len(m))
+            # convert columns by chunks, avoiding per-element numpy scalars
+            wavs = m.wav[start:end].tolist()
+            offsets = m.offset[start:end].tolist()
+            durations = m.duration[start:end].tolist()
+            frames = m.frames[start:end].tolist()
+
+            for i in range(end - start):
+                row = start + i
+                tgt_ids, ctc_ids = m.tgt[row], m.ctc[row]
+
+                # empty lines only hold the eos symbol
+                if is_train and (len(tgt_ids) <= 1 or len(ctc_ids) <= 1):
+                    continue
+
+                audio_infor = {
+                    'wav': m.wavs[wavs[i]],
+                    'offset': offsets[i],
+                    'duration': durations[i],
+                    'frames': frames[i],
+                    'row': row,
+                }
+                yield (audio_infor,
+                       truncate_ids(tgt_ids, self.max_text_len, eos[0]),
+                       truncate_ids(ctc_ids, self.max_text_len, eos[1]))
+
+    def shard_sample(self, entry):
+        """Convert one ShardedCorpus entry into the load_data format, the source is read when collating"""
+        row, frames, index, tgt_ids, ctc_ids = entry
+        audio_infor = {'row': row, 'frames': frames, 'entry': index}
+        return (audio_infor,
+                truncate_ids(tgt_ids, self.max_text_len, self.tgt_vocab.eos()),
+                truncate_ids(ctc_ids, self.max_text_len, self.src_vocab.eos()))
+
+    def load_shards(self, is_train=False, seed=None):
+        # shuffled shards and blocks for training, the packing order otherwise
+        entries = self.shards.iterate(seed=seed, shuffle=is_train,
+                                      parallel=self.p.shard_read_parallel,
+                                      block_size=self.p.shard_block_size)
+        for entry in entries:
+            # empty lines only hold the eos symbol
+            if is_train and (len(entry[3]) <= 1 or len(entry[4]) <= 1):
+                continue
+            yield self.shard_sample(entry)
+
+    def pack_shards(self, output, num_shards, shuffle=True, seed=1234, audio_dtype='int16'):
+        """Pack the sources, target and ctc ids of this dataset into a ShardedCorpus under `output`"""
+        if not os.path.exists(output):
+            os.makedirs(output)
+
+        # store untruncated ids, truncation is applied while loading
+        max_text_len, self.max_text_len = self.max_text_len, None
+        try:
+            samples = list(self.load_data(is_train=False))
+        finally:
+            self.max_text_len = max_text_len
+
+        order = np.arange(len(samples))
+        if shuffle:
+            # shards hold random subsets, written sequentially
+            order = np.random.RandomState(seed).permutation(len(samples))
+        shard_size = (len(samples) + num_shards - 1) // max(num_shards, 1)
+
+        features = self.p.input_type == 'features'
+        frame_step = int(self.p.audio_frame_step * self.sr / 1e3)
+        for sidx in range(num_shards):
+            prefix = shard_prefix(os.path.join(output, "shard"), sidx)
+            src_builder = None
+            tgt_builder = IndexedArrayBuilder(prefix + ".tgt", np.int32)
+            ctc_builder = IndexedArrayBuilder(prefix + ".ctc", np.int32)
+            frames, rows = [], []
+
+            for i in order[sidx * shard_size: (sidx + 1) * shard_size].tolist():
+                audio_infor, tgt_ids, ctc_ids = samples[i]
+                source = self.load_source(audio_infor)
+
+                if features:
+                    frames.append(len(source))
+                else:
+                    source = pcm_to_int16(source) if audio_dtype == 'int16' else pcm_to_float(source)
+                    frames.append((len(source) + frame_step - 1) // frame_step)
+                rows.append(audio_infor['row'])
+
+                if src_builder is None:
+                    src_builder = IndexedArrayBuilder(
+                        prefix + ".src", np.float32 if features else audio_dtype, source.shape[1:])
+                src_builder.add(source)
+                tgt_builder.add(tgt_ids)
+                ctc_builder.add(ctc_ids)
+
+            if src_builder is None:
+                src_builder = IndexedArrayBuilder(prefix + ".src", np.float32 if features else audio_dtype)
+            src_builder.finalize()
+            tgt_builder.finalize()
+            ctc_builder.finalize()
+            np.save(prefix + ".frames.npy", np.asarray(frames, dtype=np.int32))
+            np.save(prefix + ".rows.npy", np.asarray(rows, dtype=np.int64))
+
+        with open(os.path.join(output, "meta.json"), 'w', encoding='utf-8') as writer:
+            json.dump({
+                'num_shards': num_shards,
+                'input_type': self.p.input_type,
+                'audio_dtype': 'float32' if features else audio_dtype,
+                'audio_sample_rate': self.p.audio_sample_rate,
+                'audio_frame_step': self.p.audio_frame_step,
+                'src_vocab_size': self.src_vocab.size(),
+                'tgt_vocab_size': self.tgt_vocab.size(),
+                'src_vocab_hash': self.src_vocab.digest(),
+                'tgt_vocab_hash': self.tgt_vocab.digest(),
+                'size': len(samples),
+            }, writer, indent=2)
+
+        return len(samples)
+
+    def manifest_sample(self, row):
+        """Load one manifest row in the same format as load_data"""
+        m = self.manifest
+        audio_infor = {
+            'wav': m.wavs[int(m.wav[row])],
+            'offset': float(m.offset[row]),
+            'duration': float(m.duration[row]),
+            'frames': int(m.frames[row]),
+            'row': int(row),
+        }
+        tgt_ids = truncate_ids(m.tgt[row], self.max_text_len, self.tgt_vocab.eos())
+        ctc_ids = truncate_ids(m.ctc[row], self.max_text_len, self.src_vocab.eos())
+        return audio_infor, tgt_ids, ctc_ids
+
+    def compile_manifest(self, output):
+        """Binarize the yaml/text inputs of this dataset into a Manifest under `output`"""
+        if not os.path.exists(output):
+            os.makedirs(output)
+
+        wav2id = {}
+        wavs, offsets, durations, frames = [], [], [], []
+        tgt_builder = IndexedArrayBuilder(os.path.join(output, "tgt"), np.int32)
+        ctc_builder = IndexedArrayBuilder(os.path.join(output, "ctc"), np.int32)
+
+        # store untruncated ids, truncation is applied while loading
+        max_text_len, self.max_text_len = self.max_text_len, None
+        try:
+            for audio_infor, tgt_ids, ctc_ids in self.load_data(is_train=False):
+                if audio_infor['wav'] not in wav2id:
+                    wav2id[audio_infor['wav']] = len(wav2id)
+                wavs.append(wav2id[audio_infor['wav']])
+                offsets.append(audio_infor['offset'])
+                durations.append(audio_infor['duration'])
+                frames.append(audio_infor['frames'])
+
+                tgt_builder.add(tgt_ids)
+                ctc_builder.add(ctc_ids)
+        finally:
+            self.max_text_len = max_text_len
+
+        tgt_builder.finalize()
+        ctc_builder.finalize()
+
+        np.save(os.path.join(output, "wav.npy"), np.asarray(wavs, dtype=np.int32))
+        np.save(os.path.join(output, "offset.npy"), np.asarray(offsets, dtype=np.float64))
+        np.save(os.path.join(output, "duration.npy"), np.asarray(durations, dtype=np.float64))
+        np.save(os.path.join(output, "frames.npy"), np.asarray(frames, dtype=np.int32))
+
+        with open(os.path.join(output, "wavs.txt"), 'w', encoding='utf-8') as writer:
+            for wav in sorted(wav2id, key=wav2id.get):
+                writer.write(wav + "\n")
+        with open(os.path.join(output, "meta.json"), 'w', encoding='utf-8') as writer:
+            json.dump({
+                'audio_sample_rate': self.p.audio_sample_rate,
+                'audio_frame_step': self.p.audio_frame_step,
+                'src_vocab_size': self.src_vocab.size(),
+                'tgt_vocab_size': self.tgt_vocab.size(),
+                'src_vocab_hash': self.src_vocab.digest(),
+                'tgt_vocab_hash': self.tgt_vocab.digest(),
+                'size': len(wavs),
+            }, writer, indent=2)
+
+        return len(wavs)
+
+    def load_audio(self, audio_infor):
+        """Return the waveform of one segment, either as a view of the raw PCM or decoded floats"""
+        key = (self.audio_root, audio_infor['wav'], audio_infor['offset'], audio_infor['duration'], self.sr)
+        if self.audio_cache is not None:
+            data = self.audio_cache.get(key)
+            if data is not None:
+                return data
+
+        name, offset, duration = audio_infor['wav'], audio_infor['offset'], audio_infor['duration']
+
+        data = self.slice_audio(name, offset, duration)
+        if data is None and self.resample_cache is not None:
+            data = self.cache_reader.segment(self.resampled_audio(name), offset, duration, sample_rate=self.sr)
+        if data is None:
+            data = audio_encode(self.audio_file(name), offset, duration,
+                                sample_rate=self.sr, resample=self.p.resample_method)
+
+        if self.audio_cache is not None:
+            data = pcm_to_int16(data) if self.pcm_int16 else pcm_to_float(data)
+            self.audio_cache.put(key, data)
+        return data
+
+    def audio_file(self, name):
+        """Path of a source audio file, or a file-like object for archive members"""
+        if self.archive is not None:
+            return self.archive.open(name)
+        return os.path.join(self.src_audio_path, name)
+
+    def slice_audio(self, name, offset=0.0, duration=None):
+        """Read a segment in place, without decoding; None unless the file is plain wav at the sample rate"""
+        if self.wav_reader is None:
+            return None
+        if self.archive is not None:
+            return self.archive.segment(name, offset, duration, sample_rate=self.sr)
+        return self.wav_reader.segment(self.audio_file(name), offset, duration, sample_rate=self.sr)
+
+    def resampled_audio(self, name):
+        """Path of the source audio file resampled in the cache, which is filled on first use"""
+        path = resampled_path(self.resample_cache, self.src_audio_path, name, self.sr)
+        if not os.path.exists(path):
+            data = audio_encode(self.audio_file(name), sample_rate=self.sr, resample=self.p.resample_method)
+            write_wav(path, pcm_to_int16(data), self.sr)
+        return path
+
+    def load_source(self, audio_infor):
+        """Return the model input of one segment: waveform, or [frames, dim] features"""
+        if 'entry' in audio_infor:
+            # read from the packed shards
+            return self.shards.source(audio_infor['entry'])
+        if self.feature_store is not None:
+            return self.feature_store[audio_infor['row']]
+        return self.load_audio(audio_infor)
+
+    def _batch_array(self, name, shape, dtype):
+        if self.batch_buffers is None:
+            return np.empty(shape, dtype=dtype)
+        return self.batch_buffers.get(name, shape, dtype)
+
     def to_matrix(self, batch):
         batch_size = len(batch)
 
@@ -110,13 +869,8 @@ class Dataset(object):
         for sample in batch:
             audio_infor = sample[1]
             frames.append(get_rough_length(audio_infor, self.p))
+            sources.append(self.load_source(audio_infor))
 
-            sources.append(audio_encode(
-                os.path.join(self.src_audio_path, audio_infor['wav']),
-                audio_infor['offset'],
-                audio_infor['duration'],
-                sample_rate=self.sr))
- 
         src_lens = [len(sample) for sample in sources]
         tgt_lens = [len(sample[2]) for sample in batch]
         ctc_lens = [len(sample[3]) for sample in batch]
@@ -126,38 +880,115 @@ class Dataset(object):
         ctc_len = min(self.max_text_len, max(ctc_lens))
 
         # (x, s, t) => (data_index, audio, translation)
-        s = np.zeros([batch_size, src_len], dtype=np.float32)
-        t = np.zeros([batch_size, tgt_len], dtype=np.int32)
-        x = []
-        for eidx, sample in enumerate(batch):
-            x.append(sample[0])
-            src_ids, tgt_ids = sources[eidx], sample[2]
+        # audio: [batch, samples] for waveforms, [batch, frames, dim] for features
+        s = self._batch_array('src', [batch_size, src_len] + list(sources[0].shape[1:]),
+                              np.int16 if self.pcm_int16 else np.float32)
+        convert = pcm_to_int16 if self.pcm_int16 else pcm_to_float
+        for eidx, src_ids in enumerate(sources):
+            # pcm samples are converted while being copied into the batch
+            length = min(src_len, len(src_ids))
+            convert(src_ids[:length], out=s[eidx, :length])
+            s[eidx, length:] = 0
 
-            s[eidx, :min(src_len, len(src_ids))] = src_ids[:src_len]
-            t[eidx, :min(tgt_len, len(tgt_ids))] = tgt_ids[:tgt_len]
+        x = [sample[0] for sample in batch]
+
+        t = self._batch_array('tgt', [batch_size, tgt_len], np.int32)
+        t.fill(0)
+        rows, cols, values = ragged_positions([sample[2] for sample in batch], tgt_len)
+        t[rows, cols] = values
 
         # construct sparse label sequence, for ctc training
-        seq_indexes = []
-        seq_values = []
-        for n, sample in enumerate(batch):
-            # change to ctc_ids and ctc_len
-            sequence = sample[3][:ctc_len]
-
-            seq_indexes.extend(zip([n] * len(sequence), range(len(sequence))))
-            # apply CoLaCTC (MoD)
-            if self.p.cola_ctc_L < 0:
-              seq_values.extend(sequence)
-            else:
-              # i.e. a very simple mod operation
-              seq_values.extend([v % self.p.cola_ctc_L for v in sequence])
+        rows, cols, seq_values = ragged_positions([sample[3] for sample in batch], ctc_len)
+        # apply CoLaCTC (MoD)
+        if self.p.cola_ctc_L >= 0:
+            # i.e. a very simple mod operation
+            seq_values %= self.p.cola_ctc_L
 
-        seq_indexes = np.asarray(seq_indexes, dtype=np.int64)
-        seq_values = np.asarray(seq_values, dtype=np.int32)
+        seq_indexes = np.stack([rows, cols], axis=1)
         seq_shape = np.asarray([batch_size, ctc_len], dtype=np.int64)
 
         return x, s, t, (seq_indexes, seq_values, seq_shape), frames
 
+    def to_packed_matrix(self, batch):
+        """Collate a batch of packed rows, each one a list of samples
+
+        Besides the usual arrays, returns the segment id of every source frame and target token,
+        counted from 1 within each row, 0 for padding. Source segments are padded to whole
+        encoder frames so that none of these straddles two segments. CTC labels have one
+        sequence per segment, in row-major order.
+        """
+        step = self.pack_step
+        align = step * PACK_ALIGN
+
+        x, rows, frames = [], [], []
+        for row in batch:
+            x.extend(sample[0] for sample in row)
+            frames.append(sum(pack_align(get_rough_length(sample[1], self.p)) for sample in row))
+            rows.append([self.load_source(sample[1]) for sample in row])
+
+        widths = [[-(-len(source) // align) * align for source in sources] for sources in rows]
+        src_len = min(self.max_frame_len, max(sum(width) for width in widths))
+
+        s = self._batch_array('src', [len(batch), src_len] + list(rows[0][0].shape[1:]),
+                              np.int16 if self.pcm_int16 else np.float32)
+        src_seg = np.zeros([len(batch), -(-src_len // step)], dtype=np.int32)
+        convert = pcm_to_int16 if self.pcm_int16 else pcm_to_float
+        tgts, ctcs, tgt_segs = [], [], []
+        for ridx, (row, sources) in enumerate(zip(batch, rows)):
+            start = 0
+            for sidx, (sample, source, width) in enumerate(zip(row, sources, widths[ridx])):
+                if start >= src_len:
+                    # rough lengths underestimated the row, drop the samples left out
+                    break
+                length = min(len(source), src_len - start)
+                end = min(start + width, src_len)
+                convert(source[:length], out=s[ridx, start:start + length])
+                s[ridx, start + length:end] = 0
+                src_seg[ridx, start // step:-(-end // step)] = sidx + 1
+
+                tgts.append(sample[2])
+                ctcs.append(sample[3])
+                tgt_segs.append(np.full([len(sample[2])], sidx + 1, dtype=np.int32))
+                start = end
+            s[ridx, start:] = 0
+
+        # targets of a row are concatenated, with at most max_text_len tokens
+        row_sizes = [int(seg.max()) for seg in src_seg]
+        offsets = np.cumsum([0] + row_sizes)
+        row_tgts = [np.concatenate(tgts[offsets[i]:offsets[i + 1]]) for i in range(len(batch))]
+        row_segs = [np.concatenate(tgt_segs[offsets[i]:offsets[i + 1]]) for i in range(len(batch))]
+        tgt_len = min(self.max_text_len, max(len(tgt) for tgt in row_tgts))
+
+        t = self._batch_array('tgt', [len(batch), tgt_len], np.int32)
+        t.fill(0)
+        tgt_seg = np.zeros([len(batch), tgt_len], dtype=np.int32)
+        tok_rows, cols, values = ragged_positions(row_tgts, tgt_len)
+        t[tok_rows, cols] = values
+        tgt_seg[tok_rows, cols] = ragged_positions(row_segs, tgt_len)[2]
+
+        ctc_len = min(self.max_text_len, max(len(ctc) for ctc in ctcs))
+        tok_rows, cols, seq_values = ragged_positions(ctcs, ctc_len)
+        if self.p.cola_ctc_L >= 0:
+            seq_values %= self.p.cola_ctc_L
+        seq_indexes = np.stack([tok_rows, cols], axis=1)
+        seq_shape = np.asarray([len(ctcs), ctc_len], dtype=np.int64)
+
+        return x, s, t, (seq_indexes, seq_values, seq_shape), frames, (src_seg, tgt_seg)
+
     def processor(self, batch):
+        if self.pack_capacity is not None:
+            x, s, t, spar, f, (src_seg, tgt_seg) = self.to_packed_matrix(batch)
+            return {
+                'src': s,
+                'tgt': t,
+                'src_seg': src_seg,
+                'tgt_seg': tgt_seg,
+                'frames': f,
+                'spar': spar,
+                'index': x,
+                'raw': batch,
+            }
+
         x, s, t, spar, f = self.to_matrix(batch)
         return {
             'src': s,
@@ -168,38 +999,137 @@ class Dataset(object):
             'raw': batch,
         }
 
-    def batcher(self, size, buffer_size=1000, shuffle=True, train=True):
+    def global_index(self, train=True):
+        """Lengths [frames, target tokens] of all samples, and a loader from sample position to sample"""
+        if self.shards is not None:
+            # samples are read from their shards when batched
+            frames, tgt_lens, ctc_lens = self.shards.lengths()
+            entries = np.arange(len(self.shards))
+            if train:
+                entries = entries[(tgt_lens > 1) & (ctc_lens > 1)]
+            if self.max_text_len is not None:
+                tgt_lens = np.minimum(tgt_lens, self.max_text_len + 1)
+            lengths = np.stack([frames[entries], tgt_lens[entries]], axis=1)
+            return lengths, lambda i: (i,) + self.shard_sample(self.shards.entry(entries[i]))
+
+        if self.manifest is not None:
+            # vectorized over the manifest columns, samples are only loaded when batched
+            m = self.manifest
+            tgt_lens, ctc_lens = m.tgt.lengths(), m.ctc.lengths()
+            rows = np.arange(len(m))
+            if train:
+                rows = rows[(tgt_lens > 1) & (ctc_lens > 1)]
+            if self.max_text_len is not None:
+                tgt_lens = np.minimum(tgt_lens, self.max_text_len + 1)
+            lengths = np.stack([np.asarray(m.frames)[rows], tgt_lens[rows]], axis=1)
+            return lengths, lambda i: (i,) + self.manifest_sample(rows[i])
+
+        samples = list(self.load_data(train))
+        lengths = [[get_rough_length(sample[0], self.p), len(sample[1])] for sample in samples]
+        return lengths, lambda i: (i,) + samples[i]
+
+    def global_batcher(self, size, shuffle=True, train=True, seed=None, cursor=0):
+        # the sampler is built once, in the calling process, and reused across epochs
+        key = (size, train)
+        if self._global_sampler is None or self._global_sampler[0] != key:
+            lengths, loader = self.global_index(train)
+            if self.pack_capacity is not None:
+                lengths = np.asarray(lengths, dtype=np.int64)
+                lengths[:, 0] = pack_align(lengths[:, 0])
+            sampler = GlobalBatchSampler(lengths, size, self.batch_or_token,
+                                         cost_model=self.cost_model, packing=self.packing,
+                                         pack_capacity=self.pack_capacity)
+            self._global_sampler = (key, sampler, loader)
+        _, sampler, loader = self._global_sampler
+
+        def _batches():
+            for index in sampler.iterate(seed, cursor=cursor, shuffle=shuffle,
+                                         num_shards=self.num_shards, shard_index=self.shard_index):
+                if self.pack_capacity is not None:
+                    yield [[loader(i) for i in row.tolist()] for row in index]
+                else:
+                    yield [loader(i) for i in index.tolist()]
+        return _batches()
+
+    def batcher(self, size, buffer_size=1000, shuffle=True, train=True, seed=None, cursor=0):
+        """Iterate over batches of samples
+        seed: the random seed of this epoch, batches are shuffled by the global numpy state if None
+        cursor: the number of leading batches to skip, e.g. already trained before resuming.
+            Skipped batches are never processed, only the sample indices are computed.
+
+        With num_shards > 1, batches are formed over the full corpus and split among the shards
+        afterwards: each shard gets one batch out of every num_shards, so that all shards run the
+        same number of steps. This requires the same seed in all processes.
+        """
+        if self.batch_sampler == 'global':
+            return self.global_batcher(size, shuffle=shuffle, train=train, seed=seed, cursor=cursor)
+        # note that the leaked tails of the previous epoch are not recovered when resuming
+        batches = self.buffer_batcher(size, buffer_size=buffer_size, shuffle=shuffle, train=train, seed=seed)
+        if self.num_shards > 1:
+            # samples of the other shards are listed, but never loaded or collated here
+            batches = shard_batches(batches, self.num_shards, self.shard_index)
+        return itertools.islice(batches, cursor, None)
+
+    def _unit_length(self, unit):
+        """[frames, target tokens] of a sample, or summed over a packed row of samples"""
+        if self.pack_capacity is None:
+            return [get_rough_length(unit[1], self.p), len(unit[2])]
+        return [sum(pack_align(get_rough_length(sample[1], self.p)) for sample in unit),
+                sum(len(sample[2]) for sample in unit)]
+
+    def batch_lengths(self, batch):
+        """[frames, target tokens] of every unit of a batch: samples, or rows of packed samples"""
+        return np.asarray([self._unit_length(unit) for unit in batch], dtype=np.int64).reshape([len(batch), 2])
+
+    def buffer_batcher(self, size, buffer_size=1000, shuffle=True, train=True, seed=None):
+        rng = np.random if seed is None else np.random.RandomState(seed)
+
         def _handle_buffer(_buffer):
-            sorted_buffer = sorted(
-                _buffer, key=lambda xx: max(get_rough_length(xx[1], self.p), len(xx[2])))
+            if self.pack_capacity is not None:
+                # samples are packed into rows, which are then sorted and batched as samples are
+                rows = pack_rows([self._unit_length([sample]) for sample in _buffer], self.pack_capacity)
+                _buffer = [[_buffer[ii] for ii in row] for row in rows]
+
+            sorted_buffer = sorted(_buffer, key=lambda xx: max(self._unit_length(xx)))
 
             if self.batch_or_token == 'batch':
                 buffer_index = batch_indexer(len(sorted_buffer), size)
             else:
-                buffer_index = token_indexer(
-                    [[get_rough_length(sample[1], self.p), len(sample[2])]
-                     for sample in sorted_buffer], size)
+                buffer_index = get_indexer(self.packing)(
+                    [self._unit_length(unit) for unit in sorted_buffer], size, cost_model=self.cost_model)
 
             index_over_index = batch_indexer(len(buffer_index), 1)
-            if shuffle: np.random.shuffle(index_over_index)
+            if shuffle: rng.shuffle(index_over_index)
 
             for ioi in index_over_index:
                 index = buffer_index[ioi[0]]
                 batch = [sorted_buffer[ii] for ii in index]
                 yield batch
 
+        def _is_tail(_data):
+            # check whether the data is tailed
+            lengths = self.batch_lengths(_data)
+            if self.cost_model is not None:
+                return self.cost_model.batch_cost(lengths) < self.cost_model.budget * self.data_leak_ratio
+
+            batch_size = len(_data) if self.batch_or_token == 'batch' \
+                else max(np.sum(lengths, axis=0))
+            return batch_size < size * self.data_leak_ratio
+
+        def _samples(_data):
+            # leaked rows go back to the buffer as samples
+            if self.pack_capacity is None:
+                return _data
+            return [sample for row in _data for sample in row]
+
         buffer = self.leak_buffer
         self.leak_buffer = []
-        for i, (src_ids, tgt_ids, ctc_ids) in enumerate(self.load_data(train)):
+        for i, (src_ids, tgt_ids, ctc_ids) in enumerate(self.load_data(train, seed=seed)):
             buffer.append((i, src_ids, tgt_ids, ctc_ids))
             if len(buffer) >= buffer_size:
                 for data in _handle_buffer(buffer):
-                    # check whether the data is tailed
-                    batch_size = len(data) if self.batch_or_token == 'batch' \
-                        else max(sum([len(sample[2]) for sample in data]),
-                                 sum([get_rough_length(sample[1], self.p) for sample in data]))
-                    if batch_size < size * self.data_leak_ratio:
-                        self.leak_buffer += data
+                    if _is_tail(data):
+                        self.leak_buffer += _samples(data)
                     else:
                         yield data
                 buffer = self.leak_buffer
@@ -208,11 +1138,7 @@ class Dataset(object):
         # deal with data in the buffer
         if len(buffer) > 0:
             for data in _handle_buffer(buffer):
-                # check whether the data is tailed
-                batch_size = len(data) if self.batch_or_token == 'batch' \
-                    else max(sum([len(sample[2]) for sample in data]),
-                             sum([get_rough_length(sample[1], self.p) for sample in data]))
-                if train and batch_size < size * self.data_leak_ratio:
-                    self.leak_buffer += data
+                if train and _is_tail(data):
+                    self.leak_buffer += _samples(data)
                 else:
                     yield data
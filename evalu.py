@@ -46,23 +46,90 @@ def decode_hypothesis(seqs, scores, params, mask=None):
     return hypoes, marks
 
 
-def decoding(session, features, out_seqs, out_scores, dataset, params):
-    """Performing decoding with exising information"""
-    translations = []
-    scores = []
-    indices = []
-
-    eval_queue = queuer.EnQueuer(
-        dataset.batcher(params.eval_batch_size,
-                        buffer_size=params.buffer_size,
-                        shuffle=False,
-                        train=False),
+def eval_batches(dataset, params, pool=None):
+    """Dev/test batches, served by the persistent worker pool when given"""
+    reader = dataset.batcher(params.eval_batch_size,
+                             buffer_size=params.buffer_size,
+                             shuffle=False,
+                             train=False)
+    if pool is not None:
+        return pool.submit('dev', reader)
+
+    return queuer.EnQueuer(
+        reader,
         dataset.processor,
         worker_processes_num=params.process_num,
         input_queue_size=params.input_queue_size,
         output_queue_size=params.output_queue_size,
+        **queuer.transport_options(params)
     )
 
+
+class BatchCache(object):
+    """Processed dev batches of the first evaluation, replayed by the following ones
+
+    Only what decoding consumes is kept: the padded sources and the sample indices. Sources
+    are copied into memory, or appended to a file at `path` which is then memory-mapped.
+    """
+
+    def __init__(self, path=''):
+        self.path = path
+        self.complete = False
+        self._batches = []
+        self._memmap = None
+
+    def record(self, batches):
+        """Yield `batches`, keeping a copy of each one; the cache is complete once they are exhausted"""
+        self._batches = []
+        writer = open(self.path, 'wb') if self.path != '' else None
+        offset, dtype = 0, None
+        try:
+            for data in batches:
+                src = np.ascontiguousarray(data['src'])
+                if writer is None:
+                    # copy out, the batch may live in a reused shared memory slot
+                    self._batches.append((np.array(src), list(data['index'])))
+                else:
+                    dtype = src.dtype
+                    writer.write(src.tobytes())
+                    self._batches.append(((offset, src.shape), list(data['index'])))
+                    offset += src.size
+                yield data
+        finally:
+            if writer is not None:
+                writer.close()
+
+        if writer is not None and offset > 0:
+            self._memmap = np.memmap(self.path, dtype=dtype, mode='r', shape=(offset,))
+        self.complete = True
+
+    def __iter__(self):
+        for src, index in self._batches:
+            if self._memmap is not None:
+                (offset, shape) = src
+                src = self._memmap[offset:offset + int(np.prod(shape))].reshape(shape)
+            yield {'src': src, 'index': index}
+
+    def __len__(self):
+        return len(self._batches)
+
+
+def decoding(session, features, out_seqs, out_scores, dataset, params, pool=None, cache=None):
+    """Performing decoding with exising information
+    cache: a BatchCache, filled by the first decoding and replayed afterwards
+    """
+    translations = []
+    scores = []
+    indices = []
+
+    eval_job = None
+    if cache is not None and cache.complete:
+        eval_queue = iter(cache)
+    else:
+        eval_queue = eval_job = eval_batches(dataset, params, pool)
+        if cache is not None:
+            eval_queue = cache.record(eval_job)
+
     def _predict_one_batch(_data_on_gpu):
         feed_dicts = {}
 
@@ -91,69 +158,65 @@ def decoding(session, features, out_seqs, out_scores, dataset, params):
 
         return _step_translations, _step_scores, _step_indices
 
-    very_begin_time = time.time()
-    data_on_gpu = []
-    for bidx, data in enumerate(eval_queue):
-        if bidx == 0:
-            # remove the data reading time
-            very_begin_time = time.time()
-
-        data_on_gpu.append(data)
-        # use multiple gpus, and data samples is not enough
-        if len(params.gpus) > 0 and len(data_on_gpu) < len(params.gpus):
-            continue
-
-        start_time = time.time()
-        step_outputs = _predict_one_batch(data_on_gpu)
+    try:
+        very_begin_time = time.time()
         data_on_gpu = []
-
-        translations.extend(step_outputs[0])
-        scores.extend(step_outputs[1])
-        indices.extend(step_outputs[2])
-
-        print(
-            "Decoding Batch {} using {:.3f} s, translating {} "
-            "sentences using {:.3f} s in total".format(
-                bidx, time.time() - start_time,
-                len(translations), time.time() - very_begin_time
+        for bidx, data in enumerate(eval_queue):
+            if bidx == 0:
+                # remove the data reading time
+                very_begin_time = time.time()
+
+            data_on_gpu.append(data)
+            # use multiple gpus, and data samples is not enough
+            if len(params.gpus) > 0 and len(data_on_gpu) < len(params.gpus):
+                continue
+
+            start_time = time.time()
+            step_outputs = _predict_one_batch(data_on_gpu)
+            data_on_gpu = []
+
+            translations.extend(step_outputs[0])
+            scores.extend(step_outputs[1])
+            indices.extend(step_outputs[2])
+
+            print(
+                "Decoding Batch {} using {:.3f} s, translating {} "
+                "sentences using {:.3f} s in total".format(
+                    bidx, time.time() - start_time,
+                    len(translations), time.time() - very_begin_time
+                )
             )
-        )
 
-    if len(data_on_gpu) > 0:
+        if len(data_on_gpu) > 0:
 
-        start_time = time.time()
-        step_outputs = _predict_one_batch(data_on_gpu)
+            start_time = time.time()
+            step_outputs = _predict_one_batch(data_on_gpu)
 
-        translations.extend(step_outputs[0])
-        scores.extend(step_outputs[1])
-        indices.extend(step_outputs[2])
+            translations.extend(step_outputs[0])
+            scores.extend(step_outputs[1])
+            indices.extend(step_outputs[2])
 
-        print(
-            "Decoding Batch {} using {:.3f} s, translating {} "
-            "sentences using {:.3f} s in total".format(
-                'final', time.time() - start_time,
-                len(translations), time.time() - very_begin_time
+            print(
+                "Decoding Batch {} using {:.3f} s, translating {} "
+                "sentences using {:.3f} s in total".format(
+                    'final', time.time() - start_time,
+                    len(translations), time.time() - very_begin_time
+                )
             )
-        )
+    finally:
+        # release the shared memory slots and workers of the dev job, even when decoding fails
+        if eval_job is not None:
+            eval_job.close()
 
     return translations, scores, indices
 
 
-def scoring(session, features, out_scores, dataset, params):
+def scoring(session, features, out_scores, dataset, params, pool=None):
     """Performing decoding with exising information"""
     scores = []
     indices = []
 
-    eval_queue = queuer.EnQueuer(
-        dataset.batcher(params.eval_batch_size,
-                        buffer_size=params.buffer_size,
-                        shuffle=False,
-                        train=False),
-        dataset.processor,
-        worker_processes_num=params.process_num,
-        input_queue_size=params.input_queue_size,
-        output_queue_size=params.output_queue_size,
-    )
+    eval_queue = eval_job = eval_batches(dataset, params, pool)
 
     total_entropy = 0.
     total_tokens = 0.
@@ -189,54 +252,58 @@ def scoring(session, features, out_scores, dataset, params):
 
         return _decode_scores, _step_indices, _batch_entropy, _batch_tokens
 
-    very_begin_time = time.time()
-    data_on_gpu = []
-    for bidx, data in enumerate(eval_queue):
-        if bidx == 0:
-            # remove the data reading time
-            very_begin_time = time.time()
-
-        data_on_gpu.append(data)
-        # use multiple gpus, and data samples is not enough
-        if len(params.gpus) > 0 and len(data_on_gpu) < len(params.gpus):
-            continue
-
-        start_time = time.time()
-        step_outputs = _predict_one_batch(data_on_gpu)
+    try:
+        very_begin_time = time.time()
         data_on_gpu = []
-
-        scores.extend(step_outputs[0])
-        indices.extend(step_outputs[1])
-
-        total_entropy += step_outputs[2]
-        total_tokens += step_outputs[3]
-
-        print(
-            "Decoding Batch {} using {:.3f} s, translating {} "
-            "sentences using {:.3f} s in total".format(
-                bidx, time.time() - start_time,
-                len(scores), time.time() - very_begin_time
+        for bidx, data in enumerate(eval_queue):
+            if bidx == 0:
+                # remove the data reading time
+                very_begin_time = time.time()
+
+            data_on_gpu.append(data)
+            # use multiple gpus, and data samples is not enough
+            if len(params.gpus) > 0 and len(data_on_gpu) < len(params.gpus):
+                continue
+
+            start_time = time.time()
+            step_outputs = _predict_one_batch(data_on_gpu)
+            data_on_gpu = []
+
+            scores.extend(step_outputs[0])
+            indices.extend(step_outputs[1])
+
+            total_entropy += step_outputs[2]
+            total_tokens += step_outputs[3]
+
+            print(
+                "Decoding Batch {} using {:.3f} s, translating {} "
+                "sentences using {:.3f} s in total".format(
+                    bidx, time.time() - start_time,
+                    len(scores), time.time() - very_begin_time
+                )
             )
-        )
 
-    if len(data_on_gpu) > 0:
+        if len(data_on_gpu) > 0:
 
-        start_time = time.time()
-        step_outputs = _predict_one_batch(data_on_gpu)
+            start_time = time.time()
+            step_outputs = _predict_one_batch(data_on_gpu)
 
-        scores.extend(step_outputs[0])
-        indices.extend(step_outputs[1])
+            scores.extend(step_outputs[0])
+            indices.extend(step_outputs[1])
 
-        total_entropy += step_outputs[2]
-        total_tokens += step_outputs[3]
+            total_entropy += step_outputs[2]
+            total_tokens += step_outputs[3]
 
-        print(
-            "Decoding Batch {} using {:.3f} s, translating {} "
-            "sentences using {:.3f} s in total".format(
-                'final', time.time() - start_time,
-                len(scores), time.time() - very_begin_time
+            print(
+                "Decoding Batch {} using {:.3f} s, translating {} "
+                "sentences using {:.3f} s in total".format(
+                    'final', time.time() - start_time,
+                    len(scores), time.time() - very_begin_time
+                )
             )
-        )
+    finally:
+        # release the shared memory slots and workers of the dev job, even when scoring fails
+        eval_job.close()
 
     scores = [data[1] for data in
               sorted(zip(indices, scores), key=lambda x: x[0])]
@@ -286,13 +286,17 @@ def ffn_layer(x, d, d_o, dropout=None, scope=None):
 
 
 def add_timing_signal(x, min_timescale=1.0, max_timescale=1.0e4,
-                      time=None, name=None):
-    """Transformer Positional Embedding"""
+                      time=None, position=None, name=None):
+    """Transformer Positional Embedding
+    position: [batch, length] positions of every element, e.g. restarting at each packed segment
+    """
 
     with tf.name_scope(name, default_name="add_timing_signal", values=[x]):
         length = tf.shape(x)[1]
         channels = tf.shape(x)[2]
-        if time is None:
+        if position is not None:
+            position = dtype.tf_to_float(position)
+        elif time is None:
             position = dtype.tf_to_float(tf.range(length))
         else:
             # decoding position embedding
@@ -307,15 +311,34 @@ def add_timing_signal(x, min_timescale=1.0, max_timescale=1.0e4,
             dtype.tf_to_float(tf.range(num_timescales)) * -log_timescale_increment
         )
 
-        scaled_time = (tf.expand_dims(position, 1) *
-                       tf.expand_dims(inv_timescales, 0))
-        signal = tf.concat([tf.sin(scaled_time), tf.cos(scaled_time)], axis=1)
-        signal = tf.pad(signal, [[0, 0], [0, tf.math.mod(channels, 2)]])
-        signal = tf.reshape(signal, [1, length, channels])
+        # [length, num_timescales], or [batch, length, num_timescales] for batched positions
+        scaled_time = tf.expand_dims(position, -1) * inv_timescales
+        signal = tf.concat([tf.sin(scaled_time), tf.cos(scaled_time)], axis=-1)
+        signal = tf.pad(signal, [[0, 0]] * (signal.shape.ndims - 1) + [[0, tf.math.mod(channels, 2)]])
+        signal = tf.reshape(signal, [-1, length, channels])
 
         return x + signal
 
 
+def segment_positions(segments):
+    """Position of every element within its segment
+    segments: [batch, length] ids of contiguous segments, such as packed sequences
+    """
+    with tf.name_scope("segment_positions", values=[segments]):
+        shape = tf.shape(segments)
+        index = tf.tile(tf.expand_dims(tf.range(shape[1]), 0), [shape[0], 1])
+
+        # a segment starts wherever the id changes along the row
+        starts = tf.not_equal(segments, tf.pad(segments, [[0, 0], [1, 0]], constant_values=-1)[:, :-1])
+        ordinal = tf.cumsum(tf.cast(starts, tf.int32), axis=1) - 1
+
+        # first index of every (row, segment)
+        flat = ordinal + tf.expand_dims(tf.range(shape[0]) * shape[1], 1)
+        first = tf.math.unsorted_segment_min(index, flat, shape[0] * shape[1])
+
+        return index - tf.gather(first, flat)
+
+
 def attention_bias(inputs, mode, inf=None, name=None):
     """ A bias tensor used in attention mechanism"""
 
@@ -334,6 +357,16 @@ def attention_bias(inputs, mode, inf=None, name=None):
             mask = inputs
             ret = (1.0 - mask) * inf
             return tf.expand_dims(tf.expand_dims(ret, 1), 1)
+        elif mode == "segment":
+            # block-diagonal mask of packed sequences, inputs: segment ids of queries and keys,
+            # where 0 is padding. queries only attend to keys of their own segment, padding
+            # queries to all valid keys, which keeps their softmax well-defined
+            q_segments, k_segments = inputs
+            visible = tf.equal(tf.expand_dims(q_segments, 2), tf.expand_dims(k_segments, 1))
+            visible = tf.logical_or(visible, tf.expand_dims(tf.equal(q_segments, 0), 2))
+            visible = tf.logical_and(visible, tf.expand_dims(tf.greater(k_segments, 0), 1))
+            ret = dtype.tf_to_float(inf * (1.0 - tf.cast(visible, tf.float32)))
+            return tf.expand_dims(ret, 1)
         elif mode == "aan":
             length = tf.shape(inputs)[1]
             diagonal = tf.eye(length)
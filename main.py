@@ -12,11 +12,19 @@ import tensorflow as tf
 
 import evalu
 import lrs
-from data import Dataset
+from data import Dataset, AudioCache
+from utils.batching import BatchCostModel, PaddingMeter
 from models import model
 from search import beam_search
-from utils import parallel, cycle, util, queuer, saver, dtype
-from modules import initializer
+from utils import parallel, cycle, util, queuer, saver, dtype, prefetch
+from modules import initializer, speech
+
+
+def source_placeholder(params):
+    # raw waveforms [batch, samples], or offline logmel features [batch, frames, dim]
+    if params.input_type == "features":
+        return tf.compat.v1.placeholder(tf.float32, [None, None, speech.feature_size(params)], "source")
+    return tf.compat.v1.placeholder(speech.source_dtype(params), [None, None], "source")
 
 
 def tower_train_graph(train_features, optimizer, graph, params):
@@ -89,33 +97,78 @@ def train(params):
     # loading dataset
     print("Begin Loading Training and Dev Dataset")
     start_time = time.time()
+    # decoded waveforms shared by all data workers across epochs
+    audio_cache = AudioCache(params.audio_cache_mb * 1024 * 1024) if params.audio_cache_mb > 0 else None
     train_dataset = Dataset(params, params.src_train_file, params.tgt_train_file,
                             params.src_vocab, params.tgt_vocab,
                             ctc_file=params.ctc_train_file,
                             batch_or_token=params.batch_or_token,
                             data_leak_ratio=params.data_leak_ratio,
-                            src_audio_path=params.src_train_path)
+                            src_audio_path=params.src_train_path,
+                            audio_cache=audio_cache,
+                            resample_cache=params.resample_cache,
+                            src_feature_path=params.src_train_feature,
+                            manifest=params.train_manifest,
+                            batch_sampler=params.batch_sampler,
+                            shards=params.train_shards,
+                            tgt_bin=params.tgt_train_bin,
+                            ctc_bin=params.ctc_train_bin,
+                            cost_model=BatchCostModel.from_string(params.batch_cost, params.batch_cost_budget),
+                            packing=params.batch_packing,
+                            pack_sequences=params.pack_sequences,
+                            num_shards=params.num_shards,
+                            shard_index=params.shard_index)
     dev_dataset = Dataset(params, params.src_dev_file, params.tgt_dev_file,
                           params.src_vocab, params.src_vocab,
                           batch_or_token='batch',
                           data_leak_ratio=params.data_leak_ratio,
-                          src_audio_path=params.src_dev_path)
+                          src_audio_path=params.src_dev_path,
+                          audio_cache=audio_cache,
+                          resample_cache=params.resample_cache,
+                          src_feature_path=params.src_dev_feature)
     print(
         "End Loading dataset, within {} seconds".format(time.time() - start_time))
 
+    # data workers forked once (before the session starts), serving all epochs and dev evaluations
+    pool = None
+    if params.process_num > 0:
+        pool = queuer.WorkerPool(
+            {'train': train_dataset.processor, 'dev': dev_dataset.processor},
+            worker_processes_num=params.process_num,
+            input_queue_size=params.input_queue_size,
+            output_queue_size=params.output_queue_size,
+            autotune_interval=params.data_autotune_interval,
+            min_workers=params.process_num_min,
+            max_workers=params.process_num_max or None,
+            **queuer.transport_options(params)
+        )
+
     # Build Graph
     with tf.Graph().as_default():
         lr = tf.compat.v1.placeholder(tf.as_dtype(dtype.floatx()), [], "learn_rate")
 
         # shift automatically sliced multi-gpu process into `zero` manner :)
-        features = []
-        for fidx in range(max(len(params.gpus), 1)):
-            feature = {
-                "source": tf.compat.v1.placeholder(tf.float32, [None, None], "source"),
-                "target": tf.compat.v1.placeholder(tf.int32, [None, None], "target"),
-                "label": tf.compat.v1.sparse_placeholder(tf.int32, name="label"),
-            }
-            features.append(feature)
+        prefetcher = None
+        if params.device_prefetch and params.safe_nan:
+            # safe nan runs every batch twice, which a one-pass input pipeline cannot serve
+            print("Device prefetch is disabled under safe_nan, falling back to feed_dict")
+        if params.device_prefetch and not params.safe_nan:
+            # batches are staged into per-tower tf.data pipelines ahead of the step using them
+            prefetcher = prefetch.DevicePrefetcher(params, lookahead=params.device_prefetch_steps)
+            features = prefetcher.features
+        else:
+            features = []
+            for fidx in range(max(len(params.gpus), 1)):
+                feature = {
+                    "source": source_placeholder(params),
+                    "target": tf.compat.v1.placeholder(tf.int32, [None, None], "target"),
+                    "label": tf.compat.v1.sparse_placeholder(tf.int32, name="label"),
+                }
+                if params.pack_sequences:
+                    # segment ids of the samples packed into each row
+                    feature["source_segments"] = tf.compat.v1.placeholder(tf.int32, [None, None], "source_segments")
+                    feature["target_segments"] = tf.compat.v1.placeholder(tf.int32, [None, None], "target_segments")
+                features.append(feature)
 
         # session info
         sess = util.get_session(params.gpus)
@@ -154,6 +207,8 @@ def train(params):
 
         # initialize the model
         sess.run(tf.compat.v1.global_variables_initializer())
+        if prefetcher is not None:
+            sess.run(prefetcher.initializers)
 
         # log parameters
         util.variable_printer()
@@ -165,8 +220,23 @@ def train(params):
             best_checkpoints=params.best_checkpoints,
         )
 
+        # step times per padded batch shape, fitted by scripts/fit_batch_cost.py
+        cost_profile = None
+        if params.batch_cost_profile != "":
+            cost_profile = open(params.batch_cost_profile, 'a', encoding='utf-8')
+
+        def _profile_step(_shape, _start):
+            if cost_profile is not None:
+                cost_profile.write("{}\t{}\t{}\t{:.6f}\n".format(
+                    _shape[0], _shape[1], _shape[2], time.time() - _start))
+
         print("Training")
         cycle_counter = 0
+        padding_meter = PaddingMeter()
+        # dev batches processed at the first evaluation, replayed by the following ones
+        dev_cache = None
+        if params.cache_dev_batches:
+            dev_cache = evalu.BatchCache(params.dev_batch_cache_path)
         data_on_gpu = []
         cum_tokens = []
         cum_frames = []
@@ -185,6 +255,7 @@ def train(params):
 
         start_time = time.time()
         start_epoch = params.recorder.epoch
+        next_queue = None
         for epoch in range(start_epoch, params.epoches + 1):
 
             params.recorder.epoch = epoch
@@ -193,32 +264,54 @@ def train(params):
             size = params.batch_size if params.batch_or_token == 'batch' \
                 else params.token_size
 
-            train_queue = queuer.EnQueuer(
-                train_dataset.batcher(size,
-                                      buffer_size=params.buffer_size,
-                                      shuffle=params.shuffle_batch,
-                                      train=True),
-                train_dataset.processor,
-                worker_processes_num=params.process_num,
-                input_queue_size=params.input_queue_size,
-                output_queue_size=params.output_queue_size,
-            )
+            # resume from the batch cursor of the recorded epoch, without replaying the data pipeline
+            cursor = 0
+            epoch_seed = params.random_seed + epoch
+            if params.train_continue and epoch == start_epoch:
+                cursor = max(params.recorder.cursor, params.recorder.lidx + 1)
+                if params.recorder.epoch_seed >= 0:
+                    epoch_seed = params.recorder.epoch_seed
+                if cursor > 0:
+                    print("{} Skipping {} batches according to record".format(util.time_str(time.time()), cursor))
+            params.recorder.epoch_seed = epoch_seed
+
+            def _train_reader(_seed, _cursor):
+                return train_dataset.batcher(size,
+                                             buffer_size=params.buffer_size,
+                                             shuffle=params.shuffle_batch,
+                                             train=True,
+                                             seed=_seed,
+                                             cursor=_cursor)
+
+            if pool is None:
+                train_queue = queuer.EnQueuer(
+                    _train_reader(epoch_seed, cursor),
+                    train_dataset.processor,
+                    worker_processes_num=params.process_num,
+                    input_queue_size=params.input_queue_size,
+                    output_queue_size=params.output_queue_size,
+                    **queuer.transport_options(params)
+                )
+            else:
+                # the job of this epoch may have been prefetched at the previous one
+                if next_queue is None or cursor > 0:
+                    train_queue = pool.submit('train', _train_reader(epoch_seed, cursor))
+                else:
+                    train_queue = next_queue
+
+                # prefetch the next epoch once this one is fully fed
+                next_queue = None
+                if epoch < params.epoches:
+                    next_queue = pool.submit('train', _train_reader(params.random_seed + epoch + 1, 0),
+                                             after=train_queue)
 
             adapt_lr.before_epoch(eidx=epoch)
 
-            for lidx, data in enumerate(train_queue):
-
-                if params.train_continue:
-                    if lidx <= params.recorder.lidx:
-                        segments = params.recorder.lidx // 5
-                        if params.recorder.lidx < 5 or lidx % segments == 0:
-                            print(
-                                "{} Passing {}-th index according to record"
-                                "".format(util.time_str(time.time()), lidx))
-
-                        continue
+            train_batches = train_queue if prefetcher is None else prefetcher.stage(train_queue)
+            for lidx, data in enumerate(train_batches, start=cursor):
 
                 params.recorder.lidx = lidx
+                params.recorder.cursor = lidx + 1
 
                 data_on_gpu.append(data)
                 # use multiple gpus, and data samples is not enough
@@ -247,11 +340,23 @@ def train(params):
                         features[fidx]["label"]: shard_data["spar"],
                         lr: adapt_lr.get_lr(),
                     }
+                    if params.pack_sequences:
+                        feed_dict[features[fidx]["source_segments"]] = shard_data["src_seg"]
+                        feed_dict[features[fidx]["target_segments"]] = shard_data["tgt_seg"]
+                    if prefetcher is not None:
+                        # the same batches are already staged on the towers
+                        feed_dict = {lr: adapt_lr.get_lr()}
                     feed_dicts.update(feed_dict)
 
                     # collect target tokens
                     cum_tokens.append(np.sum(shard_data['tgt'] > 0))
                     cum_frames.append(sum(shard_data['frames']))
+                    padding_meter.add(shard_data['frames'], np.sum(shard_data['tgt'] > 0, axis=1))
+
+                # padded shape of the slowest tower, for profiling the batch cost
+                step_shape = np.max([[len(d['frames']), max(d['frames']), d['tgt'].shape[1]]
+                                     for d in data_on_gpu], axis=0).tolist()
+                step_start = time.time()
 
                 # reset data points on gpus
                 data_on_gpu = []
@@ -259,6 +364,7 @@ def train(params):
                 # internal accumulative gradient collection
                 if cycle_counter < params.update_cycle:
                     sess.run(ops["collect_op"], feed_dict=feed_dicts)
+                    _profile_step(step_shape, step_start)
 
                 # at the final step, update model parameters
                 if cycle_counter == params.update_cycle:
@@ -269,6 +375,7 @@ def train(params):
                         _, loss, gnorm, pnorm, gstep = sess.run(
                             [ops["train_op"], vle["loss"], vle["gradient_norm"], vle["parameter_norm"],
                              global_step], feed_dict=feed_dicts)
+                        _profile_step(step_shape, step_start)
 
                         if np.isnan(loss) or np.isinf(loss) or np.isnan(gnorm) or np.isinf(gnorm):
                             tf.logging.error("Nan or Inf raised! Loss {} GNorm {}.".format(loss, gnorm))
@@ -301,6 +408,14 @@ def train(params):
                                 adapt_lr.get_lr(), data['src'].shape, data['tgt'].shape,
                                 np.sum(cum_tokens), np.sum(cum_frames), end_time - start_time)
                         )
+                        if pool is not None and params.data_autotune_interval > 0:
+                            pool_stats = pool.stats()
+                            if len(pool_stats['history']) > 0:
+                                _, starvation, backpressure, _, _, action = pool_stats['history'][-1]
+                                print("{} Data pool, {} workers, depth {}, last tuning: {}, "
+                                      "starvation {:.3f}, backpressure {:.3f}".format(
+                                          util.time_str(end_time), pool_stats['workers'], pool_stats['depth'],
+                                          action, starvation, backpressure))
                         start_time = time.time()
                         cum_tokens = []
                         cum_frames = []
@@ -320,7 +435,7 @@ def train(params):
                         eval_start_time = time.time()
                         tranes, scores, indices = evalu.decoding(
                             sess, features, eval_seqs,
-                            eval_scores, dev_dataset, params)
+                            eval_scores, dev_dataset, params, pool=pool, cache=dev_cache)
                         bleu = evalu.eval_metric(tranes, params.tgt_dev_file, indices=indices)
                         eval_end_time = time.time()
                         print("End Evaluating")
@@ -395,8 +510,24 @@ def train(params):
                 print("Early Stopped!")
                 break
 
+            if pool is not None:
+                # batches of an incomplete gpu group are carried into the next epoch, copy them
+                #   out of their shared memory slots, which closing the job releases
+                data_on_gpu = [queuer.copy_chunk(d) for d in data_on_gpu]
+                if prefetcher is not None:
+                    prefetcher.detach()
+                train_queue.close()
+
             # reset to 0
             params.recorder.lidx = -1
+            params.recorder.cursor = 0
+
+            print("Padding ratio of epoch {}: frames {:.3f}, tokens {:.3f}".format(epoch, *padding_meter.ratios()))
+            padding_meter.reset()
+            if audio_cache is not None:
+                print("Audio cache after epoch {}: {}".format(epoch, audio_cache.stats()))
+            if pool is not None:
+                print("Data pool after epoch {}: {}".format(epoch, pool.stats()))
 
             adapt_lr.after_epoch(eidx=epoch)
 
@@ -408,11 +539,19 @@ def train(params):
 
     gstep = int(params.recorder.step + 1)
     eval_start_time = time.time()
-    tranes, scores, indices = evalu.decoding(sess, features, eval_seqs, eval_scores, dev_dataset, params)
+    tranes, scores, indices = evalu.decoding(sess, features, eval_seqs, eval_scores, dev_dataset, params,
+                                             pool=pool, cache=dev_cache)
     bleu = evalu.eval_metric(tranes, params.tgt_dev_file, indices=indices)
     eval_end_time = time.time()
     print("End Evaluating")
 
+    if pool is not None:
+        pool.close()
+    if prefetcher is not None:
+        prefetcher.close()
+    if cost_profile is not None:
+        cost_profile.close()
+
     if params.ema_decay > 0.:
         sess.run(ops['ema_restore_op'])
 
@@ -441,7 +580,9 @@ def evaluate(params):
                            params.src_vocab, params.src_vocab,
                            batch_or_token='batch',
                            data_leak_ratio=params.data_leak_ratio,
-                           src_audio_path=params.src_test_path)
+                           src_audio_path=params.src_test_path,
+                           resample_cache=params.resample_cache,
+                           src_feature_path=params.src_test_feature)
     print(
         "End Loading dataset, within {} seconds".format(time.time() - start_time))
 
@@ -450,7 +591,7 @@ def evaluate(params):
         features = []
         for fidx in range(max(len(params.gpus), 1)):
             feature = {
-                "source": tf.compat.v1.placeholder(tf.float32, [None, None], "source"),
+                "source": source_placeholder(params),
             }
             features.append(feature)
 
@@ -517,7 +658,9 @@ def scorer(params):
                            params.src_vocab, params.tgt_vocab,
                            batch_or_token='batch',
                            data_leak_ratio=params.data_leak_ratio,
-                           src_audio_path=params.src_test_path)
+                           src_audio_path=params.src_test_path,
+                           resample_cache=params.resample_cache,
+                           src_feature_path=params.src_test_feature)
     print(
         "End Loading dataset, within {} seconds".format(time.time() - start_time))
 
@@ -526,7 +669,7 @@ def scorer(params):
         features = []
         for fidx in range(max(len(params.gpus), 1)):
             feature = {
-                "source": tf.compat.v1.placeholder(tf.float32, [None, None], "source"),
+                "source": source_placeholder(params),
                 "target": tf.compat.v1.placeholder(tf.int32, [None, None], "target"),
             }
             features.append(feature)
@@ -45,11 +45,43 @@ def stacking(inputs, scale=3, mask=None):
         return concat_inputs
 
 
-def encoder(source, params):
+def packed_segment_ids(segments, num_segments):
+    """Index of every (row, segment) among all segments of a packed batch, in row-major order
+    segments: [batch, len] ids from 1, padding (0) is mapped to one extra index after the others
+    num_segments: [batch] number of segments in each row
+    """
+    offsets = tf.cumsum(num_segments, exclusive=True)
+    total = tf.reduce_sum(num_segments)
+    ids = tf.expand_dims(offsets, 1) + segments - 1
+    ids = tf.where(tf.greater(segments, 0), ids, tf.fill(tf.shape(ids), total))
+    return ids, total
+
+
+def segment_sum(x, ids, total):
+    """Sum [batch, len, ...] values per packed segment, see packed_segment_ids"""
+    return tf.math.unsorted_segment_sum(x, ids, total + 1)[:total]
+
+
+def unpack_segments(x, segments, ids, total):
+    """Move the frames of every packed segment into a row of its own: [total, max_len, dim]"""
+    valid = tf.where(tf.greater(segments, 0))
+    positions = func.segment_positions(segments)
+    index = tf.stack([tf.gather_nd(ids, valid), tf.gather_nd(positions, valid)], axis=1)
+    max_len = tf.reduce_max(positions) + 1
+    return tf.scatter_nd(index, tf.gather_nd(x, valid), tf.stack([total, max_len, tf.shape(x)[-1]]))
+
+
+def encoder(source, params, segments=None):
+    """segments: [batch, num_frames] ids of the samples packed into each row, 0 for padding"""
     hidden_size = params.hidden_size
 
-    # extract logmel features
-    source, mask, wavframes = speech.extract_logmel_features(source, params)
+    if params.input_type == "features":
+        # pre-extracted logmel features, padded frames are all-zero vectors
+        assert not params.use_nafm, "neural acoustic modeling requires waveform inputs"
+        mask = 1. - util.embedding_to_padding(source)
+    else:
+        # extract logmel features
+        source, mask, wavframes = speech.extract_logmel_features(source, params, segments=segments)
     target = source
 
     if params.use_nafm:
@@ -81,7 +113,13 @@ def encoder(source, params):
 
     # tried different settings for scale, turns out 3 is good
     source, mask = stacking(source, scale=3, mask=mask)
-    if not params.sinusoid_posenc:
+    positions = None
+    if segments is not None:
+        # packed segments start on stacked frames, the data pads each of them accordingly
+        segments = util.fit_length(segments, util.shape_list(mask)[1] * 3)[:, ::3]
+        segments *= tf.cast(mask, segments.dtype)
+        positions = func.segment_positions(segments)
+    elif not params.sinusoid_posenc:
         source = source[:, :params.max_poslen]
         mask = mask[:, :params.max_poslen]
     source, mask = dtype.tf_to_float(source), dtype.tf_to_float(mask)
@@ -90,18 +128,29 @@ def encoder(source, params):
     inputs = func.linear(source, params.embed_size, scope="emb_mapper")
 
     # transformer is sensitive to the position encoding,
+    # positions restart at every packed segment
     if params.sinusoid_posenc:
-        inputs = func.add_timing_signal(inputs)
+        inputs = func.add_timing_signal(inputs, position=positions)
     else:
         pos_emb = tf.compat.v1.get_variable("pos_embedding", [params.max_poslen, params.embed_size])
 
-        ishp = util.shape_list(inputs)
-        inputs += tf.expand_dims(pos_emb[:ishp[1]], 0)
+        if positions is None:
+            ishp = util.shape_list(inputs)
+            inputs += tf.expand_dims(pos_emb[:ishp[1]], 0)
+        else:
+            inputs += tf.gather(pos_emb, tf.minimum(positions, params.max_poslen - 1))
 
     # this normalization layer deeply stabilize the gradient and optimization issue
     inputs = func.layer_norm(inputs)
     inputs = util.valid_apply_dropout(inputs, params.dropout)
 
+    # packed segments never attend to each other. distance penalties (pdp) need no change:
+    # within a segment, relative distances are the same as in the unpacked sample
+    if segments is None:
+        self_bias = func.attention_bias(mask, "masking")
+    else:
+        self_bias = func.attention_bias((segments, segments), "segment")
+
     with tf.compat.v1.variable_scope("encoder"):
         x = inputs
         for layer in range(params.num_encoder_layer):
@@ -118,7 +167,7 @@ def encoder(source, params):
                     y = func.dot_attention(
                         x,
                         None,
-                        func.attention_bias(mask, "masking"),
+                        self_bias,
                         hidden_size,
                         num_heads=params.num_heads,
                         dropout=params.attention_dropout,
@@ -155,6 +204,8 @@ def encoder(source, params):
         },
         "mask": mask
     }
+    if segments is not None:
+        states['segments'] = segments
 
     if params.use_nafm:
         states['_target'] = target
@@ -163,7 +214,8 @@ def encoder(source, params):
     return states
 
 
-def decoder(target, state, params, labels=None):
+def decoder(target, state, params, labels=None, segments=None):
+    """segments: [batch, len] ids of the targets packed into each row, training only"""
     mask = dtype.tf_to_float(tf.cast(target, tf.bool))
     hidden_size = params.hidden_size
     initializer = tf.random_normal_initializer(0.0, hidden_size ** -0.5)
@@ -171,6 +223,8 @@ def decoder(target, state, params, labels=None):
     is_training = ('decoder' not in state)
 
     if is_training:
+        if segments is not None:
+            segments, _ = util.remove_invalid_seq(segments, mask)
         target, mask = util.remove_invalid_seq(target, mask)
 
     embed_name = "embedding" if params.shared_source_target_embedding \
@@ -187,7 +241,13 @@ def decoder(target, state, params, labels=None):
     if is_training:
         inputs = tf.pad(inputs, [[0, 0], [1, 0], [0, 0]])
         inputs = inputs[:, :-1, :]
-        inputs = func.add_timing_signal(inputs)
+        if segments is None:
+            inputs = func.add_timing_signal(inputs)
+        else:
+            # every packed target starts from an empty input, with positions from 0
+            follows = tf.equal(segments, tf.pad(segments, [[0, 0], [1, 0]])[:, :-1])
+            inputs *= tf.expand_dims(dtype.tf_to_float(follows), -1)
+            inputs = func.add_timing_signal(inputs, position=func.segment_positions(segments))
     else:
         inputs = tf.cond(tf.reduce_all(tf.equal(target, params.tgt_vocab.pad())),
                          lambda: tf.zeros_like(inputs),
@@ -197,6 +257,13 @@ def decoder(target, state, params, labels=None):
 
     inputs = util.valid_apply_dropout(inputs, params.dropout)
 
+    self_bias = func.attention_bias(tf.shape(mask)[1], "causal")
+    cross_bias = func.attention_bias(state['mask'], "masking")
+    if segments is not None:
+        # block-diagonal on top of causal, minimum keeps a single infinity
+        self_bias = tf.minimum(self_bias, func.attention_bias((segments, segments), "segment"))
+        cross_bias = func.attention_bias((segments, state['segments']), "segment")
+
     with tf.compat.v1.variable_scope("decoder"):
         x = inputs
         for layer in range(params.num_decoder_layer):
@@ -212,7 +279,7 @@ def decoder(target, state, params, labels=None):
                     y = func.dot_attention(
                         x,
                         None,
-                        func.attention_bias(tf.shape(mask)[1], "causal"),
+                        self_bias,
                         hidden_size,
                         num_heads=params.num_heads,
                         dropout=params.attention_dropout,
@@ -234,7 +301,7 @@ def decoder(target, state, params, labels=None):
                     y = func.dot_attention(
                         x,
                         state['encodes'],
-                        func.attention_bias(state['mask'], "masking"),
+                        cross_bias,
                         hidden_size,
                         num_heads=params.num_heads,
                         dropout=params.attention_dropout,
@@ -292,6 +359,13 @@ def decoder(target, state, params, labels=None):
     per_sample_loss = tf.reduce_sum(centropy * mask, -1) / tf.reduce_sum(mask, -1)
     loss = tf.reduce_mean(per_sample_loss)
 
+    if segments is not None:
+        # rows hold several samples: average over packed segments, not rows
+        segment_ids, num_segments = packed_segment_ids(segments, tf.reduce_max(segments, -1))
+        segment_tokens = segment_sum(mask, segment_ids, num_segments)
+        loss = tf.reduce_mean(
+            segment_sum(centropy * mask, segment_ids, num_segments) / tf.maximum(segment_tokens, 1.))
+
     if is_training and params.ctc_enable:
         assert labels is not None
 
@@ -304,16 +378,24 @@ def decoder(target, state, params, labels=None):
             ctc_label_size = params.cola_ctc_L + 1
 
         enc_logits = func.linear(encoding, ctc_label_size, scope="ctc_mapper")
+        enc_lens = tf.cast(tf.reduce_sum(state['mask'], -1), tf.int32)
+        tgt_lens = tf.reduce_sum(mask, -1)
+        if segments is not None:
+            # one ctc sequence per packed segment, labels come with one row per segment
+            src_ids, _ = packed_segment_ids(state['segments'], tf.reduce_max(segments, -1))
+            enc_logits = unpack_segments(enc_logits, state['segments'], src_ids, num_segments)
+            enc_lens = tf.cast(segment_sum(state['mask'], src_ids, num_segments), tf.int32)
+            tgt_lens = segment_tokens
         # seq dimension transpose
         enc_logits = tf.transpose(enc_logits, (1, 0, 2))
 
         enc_logits = tf.cast(enc_logits, tf.float32)
 
         with tf.name_scope('loss'):
-            ctc_loss = tf.compat.v1.nn.ctc_loss(labels, enc_logits, tf.cast(tf.reduce_sum(state['mask'], -1), tf.int32),
+            ctc_loss = tf.compat.v1.nn.ctc_loss(labels, enc_logits, enc_lens,
                                       ignore_longer_outputs_than_inputs=True,
                                       preprocess_collapse_repeated=params.ctc_repeated)
-            ctc_loss /= tf.reduce_sum(mask, -1)
+            ctc_loss /= tgt_lens
             ctc_loss = tf.reduce_mean(ctc_loss)
 
         loss = params.ctc_alpha * ctc_loss + (1. - params.ctc_alpha) * loss
@@ -338,9 +420,10 @@ def train_fn(features, params, initializer=None):
                            reuse=tf.compat.v1.AUTO_REUSE,
                            dtype=tf.as_dtype(dtype.floatx()),
                            custom_getter=dtype.float32_variable_storage_getter):
-        state = encoder(features['source'], params)
+        state = encoder(features['source'], params, segments=features.get('source_segments'))
         loss, logits, state, _ = decoder(features['target'], state, params,
-                                         labels=features['label'] if params.ctc_enable else None)
+                                         labels=features['label'] if params.ctc_enable else None,
+                                         segments=features.get('target_segments'))
 
         return {
             "loss": loss
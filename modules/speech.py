@@ -46,7 +46,7 @@ def compute_mel_filterbank_features(
         log_noise_floor=1e-3, apply_mask=True):
     """implement mel-filterbank extraction using tf ops.
       args:
-        waveforms: float32 tensor with shape [batch_size, max_len]
+        waveforms: float32 tensor with shape [batch_size, max_len], or integer pcm samples
         sample_rate: sampling rate of the waveform
         dither: stddev of gaussian noise added to waveform to prevent quantization
           artefacts
@@ -69,6 +69,10 @@ def compute_mel_filterbank_features(
     # [batch_size, ?, fft_unique_bins]
     # where fft_unique_bins = fft_length // 2 + 1
 
+    # integer pcm is scaled here, on the device, the same way as utils.audio.pcm_to_float
+    if waveforms.dtype.is_integer:
+        waveforms = tf.cast(waveforms, tf.float32) / float(2 ** (8 * waveforms.dtype.size - 1))
+
     # find the wave length: the largest index for which the value is !=0
     # note that waveforms samples that are exactly 0.0 are quite common, so
     # simply doing sum(waveforms != 0, axis=-1) will not work correctly.
@@ -140,12 +144,28 @@ def compute_mel_filterbank_features(
     return tf.expand_dims(log_mel_sgram, -1, name="mel_sgrams"), masks, frames
 
 
-def extract_logmel_features(wav, hparams):
+def feature_size(hparams):
+    """Dimension of the features returned by extract_logmel_features"""
+    d = hparams.audio_num_mel_bins
+    if hparams.audio_add_delta_deltas:
+        d *= 3
+    return d
+
+
+def source_dtype(hparams):
+    """Data type of the model input, int16 waveforms are scaled inside the frontend"""
+    if hparams.input_type == "audio" and hparams.audio_dtype == "int16":
+        return tf.int16
+    return tf.float32
+
+
+def extract_logmel_features(wav, hparams, segments=None):
     """ extract logmel features from raw wav file
     
     args:
         wav: [batch, wavlength],
         hparams: hyper-parameters
+        segments: [batch, num_frames] ids of the utterances packed into each row, 0 for padding
     returns:
         features: [batch, num_frames, features]
         mask: [batch, num_frames]
@@ -173,11 +193,25 @@ def extract_logmel_features(wav, hparams):
 
     # this replaces cmvn estimation on data
     var_epsilon = 1e-08
-    mean = tf.reduce_sum(mel_fbanks * masking, keepdims=True, axis=1) / \
-            (tf.reduce_sum(masking, keepdims=True, axis=1) + var_epsilon)
-    sqr_diff = tf.math.squared_difference(mel_fbanks, mean)
-    variance = tf.reduce_sum(sqr_diff * masking, keepdims=True, axis=1) / \
+    if segments is None:
+        mean = tf.reduce_sum(mel_fbanks * masking, keepdims=True, axis=1) / \
                 (tf.reduce_sum(masking, keepdims=True, axis=1) + var_epsilon)
+        sqr_diff = tf.math.squared_difference(mel_fbanks, mean)
+        variance = tf.reduce_sum(sqr_diff * masking, keepdims=True, axis=1) / \
+                    (tf.reduce_sum(masking, keepdims=True, axis=1) + var_epsilon)
+    else:
+        # packed utterances are normalized separately, over the frames of their own segment
+        segments = util.fit_length(segments, mfshp[1])
+        ids = segments + tf.expand_dims(tf.range(mfshp[0]) * mfshp[1], 1)
+        num_ids = mfshp[0] * mfshp[1]
+
+        def _segment_mean(x):
+            total = tf.math.unsorted_segment_sum(x * masking, ids, num_ids)
+            count = tf.math.unsorted_segment_sum(masking, ids, num_ids)
+            return tf.gather(total / (count + var_epsilon), ids)
+
+        mean = _segment_mean(mel_fbanks)
+        variance = _segment_mean(tf.math.squared_difference(mel_fbanks, mean))
 
     mel_fbanks = (mel_fbanks - mean) * tf.math.rsqrt(variance + var_epsilon)
 
@@ -17,233 +17,15 @@ import models
 import main as graph
 from vocab import Vocab
 from utils.recorder import Recorder
-from utils import dtype, util
+from utils import dtype, util, hparams
 
 
 logger = tf.get_logger()
 logger.propagate = False
 
 
-# define global initial parameters
-global_params = tc.training.HParams(
-    # whether share source and target word embedding
-    shared_source_target_embedding=False,
-    # whether share target and softmax word embedding
-    shared_target_softmax_embedding=True,
-
-    # decoding maximum length: source length + decode_length
-    decode_length=50,
-    # beam size
-    beam_size=4,
-    # length penalty during beam search
-    decode_alpha=0.6,
-    decode_beta=1./6.,
-    # noise beam search with gumbel
-    enable_noise_beam_search=False,
-    # beam search temperature, sharp or flat prediction
-    beam_search_temperature=1.0,
-    # return top elements, not used
-    top_beams=1,
-    # which version of beam search to use
-    # cache or dev
-    search_mode="cache",
-
-    # distance considered for PDP
-    pdp_r=512,
-
-    # speech feature number
-    # not that meaningful, we extracted mel features of dimension 40
-    #   after applying deltas, the feature grows to 120
-    audio_sample_rate=16000,
-    audio_preemphasis=0.97,
-    # note, disable it after training
-    audio_dither=1.0 / np.iinfo(np.int16).max,
-    audio_frame_length=25.0,
-    audio_frame_step=10.0,
-    audio_lower_edge_hertz=20.0,
-    audio_upper_edge_hertz=8000.0,
-    audio_num_mel_bins=80,
-    audio_add_delta_deltas=True,
-
-    # ASR pretrained model path
-    asr_pretrain="",
-    # whether filter variables from ASR initialization, such as not initlaize global steps
-    filter_variables=False,
-
-    # lrate decay
-    # number of shards
-    nstable=4,
-    # warmup steps: start point for learning rate stop increaing
-    warmup_steps=4000,
-    # select strategy: noam, gnmt+, epoch, score and vanilla
-    lrate_strategy="noam",
-    # learning decay rate
-    lrate_decay=0.5,
-    # cosine learning rate schedule period
-    cosine_period=5000,
-    # cosine factor
-    cosine_factor=1,
-
-    # early stopping
-    estop_patience=100,
-
-    # initialization
-    # type of initializer
-    initializer="uniform",
-    # initializer range control
-    initializer_gain=0.08,
-
-    # parameters for rnnsearch
-    # encoder and decoder hidden size
-    hidden_size=1000,
-    # source and target embedding size
-    embed_size=620,
-    # dropout value
-    dropout=0.1,
-    relu_dropout=0.1,
-    residual_dropout=0.1,
-    # label smoothing value
-    label_smooth=0.1,
-    # model name
-    model_name="transformer",
-    # scope name
-    scope_name="transformer",
-    # filter size for transformer
-    filter_size=2048,
-    # attention dropout
-    attention_dropout=0.1,
-    # the number of encoder layers, valid for deep nmt
-    num_encoder_layer=6,
-    # the number of decoder layers, valid for deep nmt
-    num_decoder_layer=6,
-    # the number of attention heads
-    num_heads=8,
-
-    # sample rate * N / 100
-    max_frame_len=100,
-    max_text_len=100,
-    # constant batch size at 'batch' mode for batch-based batching
-    batch_size=80,
-    # constant token size at 'token' mode for token-based batching
-    token_size=3000,
-    # token or batch-based data iterator
-    batch_or_token='token',
-    # batch size for decoding, i.e. number of source sentences decoded at the same time
-    eval_batch_size=32,
-    # whether shuffle batches during training
-    shuffle_batch=True,
-    # data leak buffer threshold
-    data_leak_ratio=0.5,
-
-    # whether use multiprocessing deal with data reading, default true
-    process_num=1,
-    # buffer size controls the number of sentences readed in one time,
-    buffer_size=100,
-    # a unique queue in multi-thread reading process
-    input_queue_size=100,
-    output_queue_size=100,
-
-    # source vocabulary
-    src_vocab_file="",
-    # target vocabulary
-    tgt_vocab_file="",
-    # source train file
-    src_train_path="",
-    src_train_file="",
-    # target train file
-    tgt_train_file="",
-    # ctc train file
-    ctc_train_file="",
-    # source development file
-    src_dev_path="",
-    src_dev_file="",
-    # target development file
-    tgt_dev_file="",
-    # source test file
-    src_test_path="",
-    src_test_file="",
-    # target test file
-    tgt_test_file="",
-    # output directory
-    output_dir="",
-    # output during testing
-    test_output="",
-
-    # adam optimizer hyperparameters
-    beta1=0.9,
-    beta2=0.999,
-    epsilon=1e-9,
-    # gradient clipping value
-    clip_grad_norm=5.0,
-    # the gradient norm upper bound, to avoid wired large gradient norm, only works for safe nan mode
-    gnorm_upper_bound=1e20,
-    # initial learning rate
-    lrate=1e-5,
-    # minimum learning rate
-    min_lrate=0.0,
-    # maximum learning rate
-    max_lrate=1.0,
-
-    # maximum epochs
-    epoches=10,
-    # the effective batch size is: batch/token size * update_cycle * num_gpus
-    # sequential update cycle
-    update_cycle=1,
-    # the number of gpus
-    gpus=[0],
-
-    # enable safely handle nan
-    safe_nan=False,
-    # exponential moving average for stability, disabled by default
-    ema_decay=-1.,
-
-    # enable training deep transformer
-    deep_transformer_init=False,
-
-    # print information every disp_freq training steps
-    disp_freq=100,
-    # evaluate on the development file every eval_freq steps
-    eval_freq=10000,
-    # save the model parameters every save_freq steps
-    save_freq=5000,
-    # print sample translations every sample_freq steps
-    sample_freq=1000,
-    # saved checkpoint number
-    checkpoints=5,
-    best_checkpoints=1,
-    # the maximum training steps, program with stop if epochs or max_training_steps is meet
-    max_training_steps=1000,
-
-    # random control, not so well for tensorflow.
-    random_seed=1234,
-    # whether or not train from checkpoint
-    train_continue=True,
-
-    # provide interface to modify the default datatype
-    default_dtype="float32",
-    dtype_epsilon=1e-8,
-    dtype_inf=1e8,
-    loss_scale=1.0,
-
-    # speech-specific settings
-    sinusoid_posenc=True,
-    max_poslen=2048,
-    ctc_repeated=False,
-    ctc_enable=False,
-    ctc_alpha=0.3,      # ctc loss factor
-    enc_localize="log",
-    dec_localize="none",
-    encdec_localize="none",
-
-    # cola ctc settings
-    # -1: disable cola ctc, in our paper we set 256.
-    cola_ctc_L=-1,
-
-    # neural acoustic feature modeling
-    use_nafm=False,
-    nafm_alpha=0.05,
-
-)
+# define global initial parameters, listed in utils/hparams.py
+global_params = tc.training.HParams(**hparams.default_params())
 
 flags = tf.flags
 flags.DEFINE_string("config", "", "Additional Mergable Parameters")
@@ -286,6 +68,8 @@ def setup_recorder(params):
     recorder.estop = False
 
     recorder.lidx = -1      # local data index
+    recorder.cursor = 0     # the next batch to train in this epoch, used for resuming
+    recorder.epoch_seed = -1    # the random seed shuffling batches of this epoch
     recorder.step = 0       # global step, start from 0
     recorder.epoch = 1      # epoch number, start from 1
     recorder.lrate = params.lrate     # running learning rate
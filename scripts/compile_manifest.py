@@ -0,0 +1,62 @@
+# coding: utf-8
+
+"""
+Compile the yaml source file, the target file and the ctc file into a binary manifest.
+Training with `train_manifest` then skips yaml parsing and tokenization in every epoch.
+The manifest depends on the vocabularies and the audio frame settings, recompile it when they change.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from run import global_params
+from data import Dataset
+from vocab import Vocab
+
+
+def parseargs():
+    parser = argparse.ArgumentParser(description="Compile training manifest")
+
+    parser.add_argument("--source", type=str, required=True,
+                        help="source yaml files, separated by ';'")
+    parser.add_argument("--target", type=str, required=True,
+                        help="target files, separated by ';'")
+    parser.add_argument("--ctc", type=str, default="",
+                        help="ctc label files, separated by ';', default to the target files")
+    parser.add_argument("--src_vocab", type=str, required=True,
+                        help="source (ctc) vocabulary")
+    parser.add_argument("--tgt_vocab", type=str, required=True,
+                        help="target vocabulary")
+    parser.add_argument("--output", type=str, required=True,
+                        help="the output manifest directory")
+    parser.add_argument("--parameters", type=str, default="",
+                        help="audio parameters, the same as for training")
+
+    return parser.parse_args()
+
+
+def main(args):
+    params = global_params
+    params.parse(args.parameters)
+
+    src_vocab = Vocab(args.src_vocab)
+    tgt_vocab = Vocab(args.tgt_vocab)
+
+    start_time = time.time()
+    dataset = Dataset(params, args.source, args.target, src_vocab, tgt_vocab, ctc_file=args.ctc)
+    size = dataset.compile_manifest(args.output)
+
+    print("Saving {} segments into {}, within {:.3f} seconds".format(
+        size, args.output, time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main(parseargs())
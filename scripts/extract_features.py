@@ -0,0 +1,117 @@
+# coding: utf-8
+
+"""
+Pre-extract logmel features (with deltas and per-utterance cmvn) into a sharded feature store.
+The store is row-aligned with the source yaml lines, and consumed with `input_type=features`.
+Pass the same audio_* parameters as used for training; dithering is always disabled,
+so the features are identical to what the in-graph frontend computes at inference.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+
+import yaml
+import numpy as np
+import tensorflow as tf
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from run import global_params
+from data import Dataset
+from modules import speech
+from utils import util
+from utils.audio import pcm_to_float
+from utils.indexed import ShardedIndexedArrayBuilder
+
+
+def parseargs():
+    parser = argparse.ArgumentParser(description="Extract logmel features")
+
+    parser.add_argument("--source", type=str, required=True,
+                        help="source yaml files, separated by ';'")
+    parser.add_argument("--audio_path", type=str, required=True,
+                        help="the wav directory")
+    parser.add_argument("--output", type=str, required=True,
+                        help="output prefix of the feature store")
+    parser.add_argument("--parameters", type=str, default="",
+                        help="audio parameters, the same as for training")
+    parser.add_argument("--batch_size", type=int, default=16,
+                        help="number of segments processed at once")
+    parser.add_argument("--shard_size", type=int, default=50000,
+                        help="number of segments per shard")
+    parser.add_argument("--gpu", type=int, default=-1,
+                        help="the gpu device index, -1 uses cpu")
+
+    return parser.parse_args()
+
+
+def read_segments(source):
+    for path in source.strip().split(";"):
+        with open(path, 'r', encoding='utf-8') as reader:
+            for line in reader:
+                line = line.strip()
+                yield yaml.safe_load(line)[0] if line != "" else None
+
+
+def main(args):
+    params = global_params
+    params.parse(args.parameters)
+    params.input_type = "audio"
+    params.audio_dither = 0.0
+
+    dataset = Dataset(params, args.source, args.source, None, None,
+                      src_audio_path=args.audio_path)
+    dim = speech.feature_size(params)
+
+    with tf.Graph().as_default():
+        wav = tf.compat.v1.placeholder(tf.float32, [None, None], "source")
+        feats, masks, _ = speech.extract_logmel_features(wav, params)
+
+        sess = util.get_session([args.gpu] if args.gpu >= 0 else [])
+        builder = ShardedIndexedArrayBuilder(args.output, np.float32, [dim], shard_size=args.shard_size)
+
+        def _flush(_batch):
+            if len(_batch) == 0:
+                return
+            sources = [dataset.load_audio(audio_infor) for audio_infor in _batch]
+            s = np.zeros([len(sources), max(len(src) for src in sources)], dtype=np.float32)
+            for sidx, src in enumerate(sources):
+                pcm_to_float(src, out=s[sidx, :len(src)])
+
+            _feats, _masks = sess.run([feats, masks], feed_dict={wav: s})
+            for fidx in range(len(sources)):
+                num_frames = min(int(_masks[fidx].sum()), _feats.shape[1])
+                builder.add(_feats[fidx, :num_frames])
+
+        start_time = time.time()
+        batch = []
+        for row, audio_infor in enumerate(read_segments(args.source)):
+            if audio_infor is None:
+                # keep rows aligned for empty lines
+                _flush(batch)
+                batch = []
+                builder.add(np.zeros([0, dim], dtype=np.float32))
+                continue
+
+            batch.append(audio_infor)
+            if len(batch) >= args.batch_size:
+                _flush(batch)
+                batch = []
+
+            if (row + 1) % 10000 == 0:
+                print("{} Extracted {} segments".format(util.time_str(time.time()), row + 1))
+        _flush(batch)
+
+        num_shards = builder.finalize()
+        print("Saving features into {} shards under {}, within {:.3f} seconds".format(
+            num_shards, args.output, time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main(parseargs())
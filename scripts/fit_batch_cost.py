@@ -0,0 +1,62 @@
+# coding: utf-8
+
+"""
+Fit the batch cost model on step times profiled with `batch_cost_profile`.
+Every profile line holds: batch size, padded frames, padded target tokens and step seconds.
+The fitted coefficients are printed as `batch_cost`, together with a `batch_cost_budget`
+matching the chosen percentile of the profiled step times.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.batching import BatchCostModel
+
+
+def parseargs():
+    parser = argparse.ArgumentParser(description="Fit the batch cost model")
+
+    parser.add_argument("profile", type=str, nargs="+",
+                        help="profile files written during training")
+    parser.add_argument("--skip", type=int, default=100,
+                        help="leading steps of every file to skip, such as graph warmup")
+    parser.add_argument("--percentile", type=float, default=50.,
+                        help="step time percentile used as the budget")
+
+    return parser.parse_args()
+
+
+def main(args):
+    records = []
+    for path in args.profile:
+        with open(path, 'r', encoding='utf-8') as reader:
+            lines = [line.split() for line in reader if line.strip() != ""]
+        records.extend([[float(v) for v in line] for line in lines[args.skip:]])
+
+    if len(records) < 4:
+        raise ValueError("Not enough profiled steps: {}".format(len(records)))
+    counts, frames, tokens, seconds = np.asarray(records).T
+
+    coefficients = BatchCostModel.fit(counts, frames, tokens, seconds)
+    model = BatchCostModel(coefficients, 1.)
+    predicted = model(counts, frames, tokens)
+
+    error = np.abs(predicted - seconds)
+    print("Fitted on {} steps, mean absolute error {:.4f} s ({:.1%} of the mean step time)".format(
+        len(seconds), error.mean(), error.mean() / seconds.mean()))
+    print("batch_cost=\"{}\",batch_cost_budget={:.6f}".format(
+        ",".join("{:.6g}".format(c) for c in coefficients),
+        np.percentile(seconds, args.percentile)))
+
+
+if __name__ == "__main__":
+    main(parseargs())
@@ -0,0 +1,79 @@
+# coding: utf-8
+
+"""
+Pack the training corpus into shards, each holding the waveforms (or offline features), the
+target ids and the ctc ids of its segments, for training with `train_shards`.
+Shards are read with large sequential reads, which suits network filesystems much better
+than one access per segment. Segments are shuffled across shards while packing.
+Waveforms are stored as int16 by default; pass `input_type=features` (with `src_feature_path`)
+in the parameters to pack offline features instead.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from run import global_params
+from data import Dataset
+from vocab import Vocab
+
+
+def parseargs():
+    parser = argparse.ArgumentParser(description="Pack training shards")
+
+    parser.add_argument("--source", type=str, required=True,
+                        help="source yaml files, separated by ';'")
+    parser.add_argument("--target", type=str, required=True,
+                        help="target files, separated by ';'")
+    parser.add_argument("--ctc", type=str, default="",
+                        help="ctc label files, separated by ';', default to the target files")
+    parser.add_argument("--src_vocab", type=str, required=True,
+                        help="source (ctc) vocabulary")
+    parser.add_argument("--tgt_vocab", type=str, required=True,
+                        help="target vocabulary")
+    parser.add_argument("--audio_path", type=str, default="",
+                        help="the wav directory")
+    parser.add_argument("--feature_path", type=str, default="",
+                        help="offline features, for input_type=features")
+    parser.add_argument("--output", type=str, required=True,
+                        help="the output shard directory")
+    parser.add_argument("--num_shards", type=int, default=64,
+                        help="number of shards")
+    parser.add_argument("--audio_dtype", type=str, default="int16", choices=["int16", "float32"],
+                        help="storage type of waveforms")
+    parser.add_argument("--no_shuffle", action="store_true",
+                        help="keep the corpus order instead of shuffling segments across shards")
+    parser.add_argument("--seed", type=int, default=1234,
+                        help="random seed for shuffling")
+    parser.add_argument("--parameters", type=str, default="",
+                        help="audio parameters, the same as for training")
+
+    return parser.parse_args()
+
+
+def main(args):
+    params = global_params
+    params.parse(args.parameters)
+
+    src_vocab = Vocab(args.src_vocab)
+    tgt_vocab = Vocab(args.tgt_vocab)
+
+    start_time = time.time()
+    dataset = Dataset(params, args.source, args.target, src_vocab, tgt_vocab, ctc_file=args.ctc,
+                      src_audio_path=args.audio_path, src_feature_path=args.feature_path)
+    size = dataset.pack_shards(args.output, args.num_shards, shuffle=not args.no_shuffle,
+                               seed=args.seed, audio_dtype=args.audio_dtype)
+
+    print("Packing {} segments into {} shards under {}, within {:.3f} seconds".format(
+        size, args.num_shards, args.output, time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main(parseargs())
@@ -0,0 +1,101 @@
+# coding: utf-8
+
+"""
+Resample the source audio files of a corpus once into the `resample_cache` directory.
+Files that data workers cannot slice directly (another sample rate than audio_sample_rate,
+or not plain wav) are decoded and stored as 16-bit wav at audio_sample_rate, so that
+training only reads already-resampled audio. Without this pass, the cache is filled on
+first use by the data workers. Pass the same parameters as used for training.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+import collections
+import multiprocessing
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from run import global_params
+from data import Dataset
+from utils import util
+
+
+def parseargs():
+    parser = argparse.ArgumentParser(description="Resample source audio files once")
+
+    parser.add_argument("--source", type=str, required=True,
+                        help="source yaml files, separated by ';'")
+    parser.add_argument("--audio_path", type=str, required=True,
+                        help="the wav directory, or a tar/zip archive")
+    parser.add_argument("--cache", type=str, default="",
+                        help="the resample cache directory, default to resample_cache of the parameters")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="number of resampling processes")
+    parser.add_argument("--parameters", type=str, default="",
+                        help="audio parameters, the same as for training")
+
+    return parser.parse_args()
+
+
+def read_audio_files(source):
+    """Distinct audio files of the yaml segments, in order of appearance"""
+    names = collections.OrderedDict()
+    for path in source.strip().split(";"):
+        with open(path, 'r', encoding='utf-8') as reader:
+            for line in reader:
+                line = line.strip()
+                if line != "":
+                    names[yaml.safe_load(line)[0]['wav']] = None
+    return list(names)
+
+
+# set before forking the workers, which inherit it
+_dataset = None
+
+
+def _resample(name):
+    # files sliced in place by the data workers are left alone
+    if _dataset.slice_audio(name, duration=0.0) is not None:
+        return False
+    _dataset.resampled_audio(name)
+    return True
+
+
+def main(args):
+    global _dataset
+
+    params = global_params
+    params.parse(args.parameters)
+    params.input_type = "audio"
+    cache = args.cache if args.cache != "" else params.resample_cache
+    if cache == "":
+        raise ValueError("No resample cache directory given")
+
+    _dataset = Dataset(params, args.source, args.source, None, None,
+                       src_audio_path=args.audio_path, resample_cache=cache)
+    names = read_audio_files(args.source)
+
+    start_time = time.time()
+    resampled = 0
+    pool = multiprocessing.Pool(args.workers)
+    for fidx, done in enumerate(pool.imap_unordered(_resample, names, chunksize=4)):
+        resampled += int(done)
+        if (fidx + 1) % 1000 == 0:
+            print("{} Checked {} files, resampled {}".format(util.time_str(time.time()), fidx + 1, resampled))
+    pool.close()
+    pool.join()
+
+    print("Resampling {} of {} audio files into {}, within {:.3f} seconds".format(
+        resampled, len(names), cache, time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main(parseargs())
@@ -1,13 +1,33 @@
 # coding=utf-8
 
+"""
+Shuffle parallel corpora (and an aligned h5 audio file) with bounded memory.
+
+Two passes: lines (and audio entries) are first scattered into random buckets on disk, then
+every bucket is loaded, shuffled and appended to the outputs. This gives a uniform random
+permutation while holding one bucket in memory at a time.
+
+The shuffled audio is written as one contiguous chunked dataset `audio`, with entry i at rows
+offsets[i]:offsets[i+1] of it, and an `offsets` dataset. Input audio is read either in that
+layout or as one `audio_{idx}` dataset per utterance.
+"""
+
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+import sys
+import shutil
 import argparse
+import tempfile
 import numpy
 import h5py
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.indexed import IndexedArray, IndexedArrayBuilder
+
 
 def parseargs():
     parser = argparse.ArgumentParser(description="Shuffle corpus")
@@ -19,46 +39,111 @@ def parseargs():
     parser.add_argument("--suffix", type=str, default="shuf",
                         help="Suffix of output files")
     parser.add_argument("--seed", type=int, help="Random seed")
+    parser.add_argument("--buckets", type=int, default=64,
+                        help="number of on-disk buckets, memory use is about 1/buckets of the data")
+    parser.add_argument("--chunk_rows", type=int, default=1 << 20,
+                        help="h5 chunk size (in rows) of the output audio")
+    parser.add_argument("--tmp_dir", type=str, default="",
+                        help="directory for the buckets, default to that of the first corpus")
 
     return parser.parse_args()
 
 
-def main(args):
-    name = args.corpus
-    suffix = "." + args.suffix
-    stream = [open(item, "r") for item in name]
-    data = [fd.readlines() for fd in stream]
-    minlen = min([len(lines) for lines in data])
-
-    if args.seed:
-        numpy.random.seed(args.seed)
-
-    indices = numpy.arange(minlen)
-    numpy.random.shuffle(indices)
-
-    newstream = [open(item + suffix, "w") for item in name]
-
-    if args.audio != "none":
-        audiostream = h5py.File(args.audio + suffix + ".h5", 'w')
-        audioreader = h5py.File(args.audio, 'r')
+def read_audio(reader):
+    """Yield the audio entries of an h5 file in order, either layout"""
+    if "offsets" in reader:
+        audio, offsets = reader["audio"], reader["offsets"][()]
+        for i in range(len(offsets) - 1):
+            yield audio[offsets[i]:offsets[i + 1]]
+    else:
+        idx = 0
+        while "audio_{}".format(idx) in reader:
+            yield reader["audio_{}".format(idx)][()]
+            idx += 1
 
-    for h, idx in enumerate(indices.tolist()):
-        lines = [item[idx] for item in data]
 
-        for line, fd in zip(lines, newstream):
-            fd.write(line)
+def audio_spec(reader):
+    """Element dtype and trailing shape of the h5 audio entries"""
+    dataset = reader["audio"] if "offsets" in reader else reader["audio_0"]
+    return dataset.dtype, dataset.shape[1:]
 
-        if args.audio != "none":
-            audio = audioreader["audio_{}".format(idx)][()]
-            audiostream.create_dataset("audio_{}".format(h), data=audio)
 
-    if args.audio != "none":
-        audioreader.close()
-        audiostream.close()
-
-    for fdr, fdw in zip(stream, newstream):
-        fdr.close()
-        fdw.close()
+def main(args):
+    name = args.corpus
+    suffix = "." + args.suffix
+    rng = numpy.random.RandomState(args.seed)
+    use_audio = args.audio != "none"
+
+    tmp_dir = tempfile.mkdtemp(prefix="shuffle.",
+                               dir=args.tmp_dir or os.path.dirname(os.path.abspath(name[0])))
+    try:
+        # pass 1: scatter lines (and audio) into random buckets
+        bucket_files = [[open(os.path.join(tmp_dir, "{}.{}".format(b, c)), "wb")
+                         for c in range(len(name))] for b in range(args.buckets)]
+        stream = [open(item, "rb") for item in name]
+        entries = [zip(*stream)]
+
+        if use_audio:
+            audioreader = h5py.File(args.audio, 'r')
+            dtype, shape = audio_spec(audioreader)
+            bucket_audio = [IndexedArrayBuilder(os.path.join(tmp_dir, "{}.audio".format(b)),
+                                                dtype, shape) for b in range(args.buckets)]
+            entries.append(read_audio(audioreader))
+
+        counts = numpy.zeros([args.buckets], dtype=numpy.int64)
+        for entry in zip(*entries):
+            b = rng.randint(args.buckets)
+            counts[b] += 1
+
+            for line, fd in zip(entry[0], bucket_files[b]):
+                fd.write(line if line.endswith(b"\n") else line + b"\n")
+            if use_audio:
+                bucket_audio[b].add(entry[1])
+
+        for fd in stream + sum(bucket_files, []):
+            fd.close()
+        if use_audio:
+            audioreader.close()
+            for builder in bucket_audio:
+                builder.finalize()
+
+        print("Scattered {} lines into {} buckets".format(counts.sum(), args.buckets))
+
+        # pass 2: shuffle each bucket in memory and append it to the outputs
+        newstream = [open(item + suffix, "wb") for item in name]
+
+        if use_audio:
+            audiostream = h5py.File(args.audio + suffix + ".h5", 'w')
+            audio_out = audiostream.create_dataset(
+                "audio", shape=(0,) + shape, maxshape=(None,) + shape, dtype=dtype,
+                chunks=(max(args.chunk_rows // max(int(numpy.prod(shape)), 1), 1),) + shape)
+            offsets = [numpy.zeros([1], dtype=numpy.int64)]
+
+        for b in range(args.buckets):
+            indices = rng.permutation(counts[b])
+
+            for c, fd in enumerate(newstream):
+                with open(os.path.join(tmp_dir, "{}.{}".format(b, c)), "rb") as reader:
+                    lines = reader.readlines()
+                fd.writelines([lines[idx] for idx in indices])
+
+            if use_audio and counts[b] > 0:
+                array = IndexedArray(os.path.join(tmp_dir, "{}.audio".format(b)))
+                audio = numpy.concatenate([array[idx] for idx in indices], axis=0)
+
+                start = audio_out.shape[0]
+                audio_out.resize(start + len(audio), axis=0)
+                audio_out[start:] = audio
+                offsets.append(start + numpy.cumsum(array.lengths()[indices]))
+                del array
+
+        for fd in newstream:
+            fd.close()
+        if use_audio:
+            audiostream.create_dataset("offsets", data=numpy.concatenate(offsets))
+            audiostream.close()
+    finally:
+        shutil.rmtree(tmp_dir)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,191 @@
+# coding: utf-8
+
+"""
+Replay the training batcher on sample lengths only, to tune token_size, buffer_size,
+data_leak_ratio, batch_or_token and the other batching parameters offline.
+Batches come from Dataset.batcher as in training, but are never loaded: lengths are read from
+the manifest (or from the yaml durations), so no audio is decoded and tensorflow is not needed.
+Training defaults come from utils/hparams.py, and every one of them is overridden by `--name value`:
+values are python literals of the type of the default, several values sweep the parameter.
+
+For every configuration, reports the number of batches and samples per epoch, the batch size
+distribution, the padding ratio of frames and tokens, the samples leaked at the end of the
+epoch, and the predicted step cost (with `batch_cost` or `--cost`).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import ast
+import time
+import argparse
+import itertools
+import multiprocessing
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data import Dataset
+from vocab import Vocab
+from utils.hparams import default_params
+from utils.batching import BatchCostModel, PaddingMeter
+
+
+def parseargs():
+    parser = argparse.ArgumentParser(description="Simulate training batches")
+
+    parser.add_argument("--manifest", type=str, default="",
+                        help="compiled training manifest")
+    parser.add_argument("--source", type=str, default="",
+                        help="source yaml files, separated by ';', without a manifest")
+    parser.add_argument("--target", type=str, default="",
+                        help="target files, separated by ';', without a manifest")
+    parser.add_argument("--ctc", type=str, default="",
+                        help="ctc label files, separated by ';', default to the target files")
+    parser.add_argument("--src_vocab", type=str, required=True,
+                        help="source (ctc) vocabulary")
+    parser.add_argument("--tgt_vocab", type=str, required=True,
+                        help="target vocabulary")
+    parser.add_argument("--feature_path", type=str, default="",
+                        help="offline features, for input_type=features")
+    parser.add_argument("--cost", type=str, default="",
+                        help="cost coefficients \"frame,frame_square,token,bias\" for predicting "
+                             "step costs, default to batch_cost")
+    parser.add_argument("--epochs", type=int, default=1,
+                        help="number of epochs to replay, leaked samples carry over")
+    parser.add_argument("--time_limit", type=float, default=60.,
+                        help="seconds after which a configuration is given up")
+
+    group = parser.add_argument_group("training parameters",
+                                      "defaults of utils/hparams.py, configurations are the product "
+                                      "of all values given")
+    for name, default in default_params().items():
+        group.add_argument("--" + name, type=param_type(name, default), nargs="+", metavar="VALUE",
+                           help="default: {!r}".format(default))
+
+    return parser.parse_args()
+
+
+def param_type(name, default):
+    """argparse type of a training parameter: python literals of the type of its default"""
+    def _parse(value):
+        if isinstance(default, str):
+            return value
+        try:
+            parsed = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            raise argparse.ArgumentTypeError("{} of {} is not a python literal".format(value, name))
+        if isinstance(default, float) and type(parsed) == int:
+            parsed = float(parsed)
+        if type(parsed) != type(default):
+            raise argparse.ArgumentTypeError("{} of {} is not of type {}".format(
+                value, name, type(default).__name__))
+        return parsed
+    return _parse
+
+
+def sweep_configs(args, defaults):
+    """Overridden parameters of every configuration, the product of the values given"""
+    names = [name for name in defaults if getattr(args, name) is not None]
+    return [dict(zip(names, values)) for values in itertools.product(*[getattr(args, name) for name in names])]
+
+
+def percentiles(values, qs=(0, 5, 50, 95, 100)):
+    if len(values) == 0:
+        return "-"
+    return "/".join("{:g}".format(v) for v in np.percentile(values, qs))
+
+
+def simulate(params, args, src_vocab, tgt_vocab, cost):
+    """Batching statistics of one configuration over `args.epochs` epochs"""
+    dataset = Dataset(params, args.source, args.target, src_vocab, tgt_vocab,
+                      ctc_file=args.ctc,
+                      batch_or_token=params.batch_or_token,
+                      data_leak_ratio=params.data_leak_ratio,
+                      src_feature_path=args.feature_path,
+                      manifest=args.manifest,
+                      batch_sampler=params.batch_sampler,
+                      cost_model=BatchCostModel.from_string(params.batch_cost, params.batch_cost_budget),
+                      packing=params.batch_packing,
+                      pack_sequences=params.pack_sequences,
+                      num_shards=params.num_shards,
+                      shard_index=params.shard_index)
+    size = params.batch_size if params.batch_or_token == 'batch' else params.token_size
+    predictor = cost if cost is not None else dataset.cost_model
+
+    meter = PaddingMeter()
+    num_batches, units, samples, costs, leaked = [], [], [], [], []
+    for epoch in range(1, args.epochs + 1):
+        batches = dataset.batcher(size, buffer_size=params.buffer_size, shuffle=params.shuffle_batch,
+                                  train=True, seed=params.random_seed + epoch)
+        count = 0
+        for batch in batches:
+            lengths = dataset.batch_lengths(batch)
+            meter.add(lengths[:, 0], lengths[:, 1])
+            units.append(len(batch))
+            samples.append(len(batch) if dataset.pack_capacity is None else sum(len(row) for row in batch))
+            if predictor is not None:
+                costs.append(predictor.batch_cost(lengths))
+            count += 1
+        num_batches.append(count)
+        leaked.append(len(dataset.leak_buffer))
+
+    return {
+        'batches': np.mean(num_batches),
+        'samples': np.sum(samples) / args.epochs,
+        'leaked': np.mean(leaked),
+        'units': units,
+        'packed_samples': samples if dataset.pack_capacity is not None else None,
+        'padding': meter.ratios(),
+        'costs': costs if predictor is not None else None,
+    }
+
+
+def report(stats, epochs):
+    print("  batches/epoch: {:g}, samples/epoch: {:g}, leaked samples at epoch end: {:g}".format(
+        stats['batches'], stats['samples'], stats['leaked']))
+    print("  batch size (min/5%/50%/95%/max): {}{}".format(
+        percentiles(stats['units']), "" if stats['packed_samples'] is None
+        else ", samples per batch: {}".format(percentiles(stats['packed_samples']))))
+    print("  padding: frames {:.2%}, tokens {:.2%}".format(*stats['padding']))
+    if stats['costs'] is not None:
+        print("  step cost (min/5%/50%/95%/max): {}, per epoch: {:g}".format(
+            percentiles(stats['costs']), np.sum(stats['costs']) / epochs))
+
+
+def main(args):
+    if args.manifest == "" and (args.source == "" or args.target == ""):
+        raise ValueError("Either --manifest or --source and --target are required")
+
+    src_vocab = Vocab(args.src_vocab)
+    tgt_vocab = Vocab(args.tgt_vocab)
+    cost = BatchCostModel.from_string(args.cost, 1.)
+
+    defaults = default_params()
+    for config in sweep_configs(args, defaults):
+        params = argparse.Namespace(**dict(defaults, **config))
+
+        start_time = time.time()
+        print("Config: {}".format(",".join("{}={!r}".format(name, value) for name, value in config.items())
+                                  if len(config) > 0 else "default"))
+        # every configuration runs in its own process, given up after the time limit: when most
+        #   batches leak, the buffer batcher batches its growing leak buffer again for every sample
+        pool = multiprocessing.Pool(1)
+        try:
+            stats = pool.apply_async(simulate, (params, args, src_vocab, tgt_vocab, cost)).get(args.time_limit)
+        except multiprocessing.TimeoutError:
+            print("  stopped after {:g} seconds, are most batches leaked (data_leak_ratio)?".format(
+                args.time_limit))
+            continue
+        finally:
+            pool.terminate()
+        report(stats, args.epochs)
+        print("  simulated within {:.3f} seconds".format(time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main(parseargs())
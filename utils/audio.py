@@ -0,0 +1,364 @@
+# coding: utf-8
+
+"""
+Direct readers for segmented audio corpora.
+MuST-C style segments are (offset, duration) windows into long talk recordings,
+decoding the recording for every segment wastes most of the time in data workers.
+For uncompressed PCM wav files, we parse the RIFF header once and expose the payload
+as a memory-mapped array, so that a segment is just a slice of the file.
+Audio files kept in tar or zip archives are read in place the same way, by seeking to
+the member inside the archive.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import io
+import json
+import wave
+import struct
+import tarfile
+import zipfile
+import collections
+import numpy as np
+
+# wav format tags
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# (format tag, bits per sample) => little-endian numpy dtype
+_WAV_DTYPES = {
+    (WAVE_FORMAT_PCM, 16): np.dtype('<i2'),
+    (WAVE_FORMAT_PCM, 32): np.dtype('<i4'),
+    (WAVE_FORMAT_IEEE_FLOAT, 32): np.dtype('<f4'),
+    (WAVE_FORMAT_IEEE_FLOAT, 64): np.dtype('<f8'),
+}
+
+
+class WavInfo(collections.namedtuple("WavInfo",
+                                     ("rate", "channels", "dtype", "data_offset", "num_samples"))):
+    pass
+
+
+def parse_wav_header(reader, base=0, end=None):
+    """Parse the RIFF header of a wav file starting at byte `base` of `reader`
+    Returns a WavInfo, or None if the file is not a plain PCM/float wav that
+    could be memory-mapped directly (e.g. compressed, 8/24-bit or RIFX).
+    `end` bounds the wav file when it is embedded in a larger one, such as an archive.
+    """
+    reader.seek(base)
+    riff = reader.read(12)
+    if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+        return None
+
+    fmt = None
+    pos = base + 12
+    while True:
+        reader.seek(pos)
+        chunk = reader.read(8)
+        if len(chunk) < 8:
+            return None
+        chunk_id, chunk_size = chunk[:4], struct.unpack('<I', chunk[4:])[0]
+
+        if chunk_id == b'fmt ':
+            body = reader.read(chunk_size)
+            tag, channels, rate, _, _, bits = struct.unpack('<HHIIHH', body[:16])
+            if tag == WAVE_FORMAT_EXTENSIBLE and len(body) >= 26:
+                # the real format tag is the first two bytes of the sub-format guid
+                tag = struct.unpack('<H', body[24:26])[0]
+            fmt = (tag, channels, rate, bits)
+        elif chunk_id == b'data':
+            if fmt is None:
+                return None
+            tag, channels, rate, bits = fmt
+            if (tag, bits) not in _WAV_DTYPES:
+                return None
+            dtype = _WAV_DTYPES[(tag, bits)]
+
+            # note some writers leave the data size unset (0 or 0xFFFFFFFF) for streams,
+            # we trust the size unless it is obviously invalid
+            if end is None:
+                reader.seek(0, 2)
+                end = reader.tell()
+            available = end - pos - 8
+            if chunk_size == 0 or chunk_size > available:
+                chunk_size = available
+
+            num_samples = chunk_size // (dtype.itemsize * channels)
+            return WavInfo(rate, channels, dtype, pos + 8, num_samples)
+
+        # chunks are word-aligned
+        pos += 8 + chunk_size + (chunk_size & 1)
+
+
+def pcm_to_float(data, out=None):
+    """Convert PCM samples into float32 in [-1, 1), following the scaling of soundfile
+    If `out` is given, the conversion is written into it without intermediate copy.
+    """
+    if out is None:
+        out = np.empty(data.shape, dtype=np.float32)
+    if data.dtype.kind == 'i':
+        scale = 1. / (2 ** (8 * data.dtype.itemsize - 1))
+        np.multiply(data, scale, out=out, casting='unsafe')
+    else:
+        out[...] = data
+    return out
+
+
+def pcm_to_int16(data, out=None):
+    """Convert samples into int16 PCM, floats in [-1, 1) are scaled back as pcm_to_float would read them"""
+    if out is None:
+        out = np.empty(data.shape, dtype=np.int16)
+    if data.dtype == np.int16:
+        out[...] = data
+    elif data.dtype.kind == 'i':
+        # keep the most significant 16 bits
+        out[...] = np.right_shift(data, 8 * data.dtype.itemsize - 16)
+    else:
+        out[...] = np.clip(np.round(data * 32768.), -32768, 32767)
+    return out
+
+
+def write_wav(path, data, rate):
+    """Write int16 mono samples as a plain PCM wav file, atomically so that concurrent writers are harmless"""
+    dirname = os.path.dirname(path)
+    if dirname != "" and not os.path.exists(dirname):
+        os.makedirs(dirname, exist_ok=True)
+
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    writer = wave.open(tmp_path, 'wb')
+    writer.setnchannels(1)
+    writer.setsampwidth(2)
+    writer.setframerate(rate)
+    writer.writeframes(np.asarray(data, dtype='<i2').tobytes())
+    writer.close()
+    os.rename(tmp_path, path)
+
+
+class WavReader(object):
+    """Memory-mapped reader for uncompressed wav files
+
+    Headers are parsed only once per file; at most `max_open_files` mappings are
+    kept alive, the least recently used ones are dropped first.
+    Files that could not be mapped are remembered, so the caller can fall back to
+    a decoder, such as librosa, without re-checking the header.
+    """
+
+    def __init__(self, max_open_files=256):
+        self.max_open_files = max_open_files
+        self._maps = collections.OrderedDict()
+        self._unsupported = set()
+
+    def open(self, path):
+        """Return (WavInfo, payload) for the given file, payload is a [samples, channels] memmap"""
+        if path in self._maps:
+            self._maps.move_to_end(path)
+            return self._maps[path]
+        if path in self._unsupported:
+            return None
+
+        with open(path, 'rb') as reader:
+            info = parse_wav_header(reader)
+        if info is None or info.num_samples == 0:
+            self._unsupported.add(path)
+            return None
+
+        payload = np.memmap(path, dtype=info.dtype, mode='r', offset=info.data_offset,
+                            shape=(info.num_samples, info.channels))
+        self._maps[path] = (info, payload)
+        if len(self._maps) > self.max_open_files:
+            self._maps.popitem(last=False)
+        return info, payload
+
+    def segment(self, path, offset=0.0, duration=None, sample_rate=16000):
+        """Slice the [offset, offset + duration] window of a mono wav file
+        Returns a read-only view onto the file (no decoding, no copy), or None
+        when the file must be decoded otherwise (compressed, multi-channel or
+        mismatched sample rate).
+        """
+        opened = self.open(path)
+        if opened is None:
+            return None
+        info, payload = opened
+        if info.channels != 1 or (sample_rate is not None and info.rate != sample_rate):
+            return None
+
+        # follow the seeking convention of librosa/soundfile
+        start = min(int(offset * info.rate), info.num_samples)
+        end = info.num_samples if duration is None \
+            else min(start + int(duration * info.rate), info.num_samples)
+        return payload[start:end, 0]
+
+
+def is_archive(path):
+    """Whether the audio path is a tar or zip archive rather than a directory"""
+    return os.path.isfile(path) and path.endswith(('.tar', '.zip'))
+
+
+class ArchiveReader(object):
+    """Random access to the audio files of a tar or zip archive
+
+    The member index, name => (offset, size, stored), is built once and cached next to the
+    archive as `<archive>.index.json`, it is rebuilt when the archive changes. Stored members
+    (all of an uncompressed tar, ZIP_STORED ones of a zip) are read by seeking into the
+    archive, through one file handle per process: forked data workers open their own.
+    Deflated zip members are read through zipfile.
+    Names are looked up as given, or below the prefix shared by all members, such as `./` or
+    `wav/` for archives made with `tar -C wav .` or `tar cf wav.tar wav`.
+    """
+
+    def __init__(self, path, max_headers=65536):
+        self.path = path
+        self.max_headers = max_headers
+        self.index = self._load_index()
+        self.prefix = self._common_prefix(self.index)
+
+        self._pid = None
+        self._file = None
+        self._zip = None
+        self._headers = collections.OrderedDict()
+
+    def _load_index(self):
+        stat = os.stat(self.path)
+        index_path = self.path + ".index.json"
+        if os.path.exists(index_path):
+            with open(index_path) as reader:
+                cached = json.load(reader)
+            if cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime:
+                return cached['members']
+
+        print("Indexing audio archive {}".format(self.path))
+        if self.path.endswith('.zip'):
+            members = self._index_zip()
+        else:
+            members = self._index_tar()
+
+        try:
+            tmp_path = "{}.{}.tmp".format(index_path, os.getpid())
+            with open(tmp_path, 'w') as writer:
+                json.dump({'size': stat.st_size, 'mtime': stat.st_mtime, 'members': members}, writer)
+            os.rename(tmp_path, index_path)
+        except (IOError, OSError) as e:
+            print("Cannot cache the archive index at {}: {}".format(index_path, e))
+        return members
+
+    def _index_tar(self):
+        members = {}
+        try:
+            archive = tarfile.open(self.path, 'r:')
+        except tarfile.ReadError:
+            raise ValueError("{} is not an uncompressed tar archive, which is required "
+                             "to read its members in place".format(self.path))
+        with archive:
+            member = archive.next()
+            while member is not None:
+                if member.isfile():
+                    members[member.name] = [member.offset_data, member.size, 1]
+                # do not keep all member infos in memory
+                archive.members = []
+                member = archive.next()
+        return members
+
+    def _index_zip(self):
+        members = {}
+        with zipfile.ZipFile(self.path) as archive, open(self.path, 'rb') as reader:
+            for member in archive.infolist():
+                if member.is_dir():
+                    continue
+                # the payload follows the local header, whose extra field may differ from the central one
+                reader.seek(member.header_offset)
+                header = reader.read(30)
+                name_len, extra_len = struct.unpack('<HH', header[26:30])
+                offset = member.header_offset + 30 + name_len + extra_len
+                stored = int(member.compress_type == zipfile.ZIP_STORED)
+                members[member.filename] = [offset, member.file_size, stored]
+        return members
+
+    @staticmethod
+    def _common_prefix(names):
+        """Leading `./` and top-level directory shared by all member names"""
+        names = list(names)
+        prefix = ""
+        if len(names) > 0 and all(name.startswith("./") for name in names):
+            prefix = "./"
+            names = [name[2:] for name in names]
+        tops = set(name.split("/", 1)[0] for name in names)
+        if len(tops) == 1 and all("/" in name for name in names):
+            prefix += tops.pop() + "/"
+        return prefix
+
+    def _member(self, name):
+        """Index key of a member name, which may leave out the prefix shared by all members"""
+        if name in self.index:
+            return name
+        name = name[2:] if name.startswith("./") else name
+        for key in (name, self.prefix + name):
+            if key in self.index:
+                return key
+        raise KeyError("{} is not a member of the audio archive {}, whose members are named like {}"
+                       "".format(name, self.path, next(iter(self.index), None)))
+
+    def _reader(self):
+        if self._pid != os.getpid():
+            # file positions must not be shared with forked processes
+            self._pid = os.getpid()
+            self._file = open(self.path, 'rb')
+            self._zip = None
+        return self._file
+
+    def __contains__(self, name):
+        try:
+            self._member(name)
+        except KeyError:
+            return False
+        return True
+
+    def read(self, name):
+        """Raw bytes of one member"""
+        name = self._member(name)
+        offset, size, stored = self.index[name]
+        reader = self._reader()
+        if not stored:
+            if self._zip is None:
+                self._zip = zipfile.ZipFile(reader)
+            return self._zip.read(name)
+        reader.seek(offset)
+        return reader.read(size)
+
+    def open(self, name):
+        """File-like object of one member, e.g. for decoders"""
+        return io.BytesIO(self.read(name))
+
+    def _header(self, name):
+        if name in self._headers:
+            self._headers.move_to_end(name)
+            return self._headers[name]
+
+        offset, size, stored = self.index[self._member(name)]
+        info = parse_wav_header(self._reader(), base=offset, end=offset + size) if stored else None
+        self._headers[name] = info
+        if len(self._headers) > self.max_headers:
+            self._headers.popitem(last=False)
+        return info
+
+    def segment(self, name, offset=0.0, duration=None, sample_rate=16000):
+        """Read the [offset, offset + duration] window of a mono wav member
+        As WavReader.segment, but the samples are read from the archive (one seek and read),
+        None when the member must be decoded otherwise.
+        """
+        info = self._header(name)
+        if info is None or info.num_samples == 0:
+            return None
+        if info.channels != 1 or (sample_rate is not None and info.rate != sample_rate):
+            return None
+
+        start = min(int(offset * info.rate), info.num_samples)
+        end = info.num_samples if duration is None \
+            else min(start + int(duration * info.rate), info.num_samples)
+
+        reader = self._reader()
+        reader.seek(info.data_offset + start * info.dtype.itemsize)
+        return np.frombuffer(reader.read((end - start) * info.dtype.itemsize), dtype=info.dtype)
@@ -0,0 +1,289 @@
+# coding: utf-8
+
+"""
+Batching algorithms over sample lengths.
+Everything here works on plain numpy arrays, without tensorflow or audio dependencies.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+def batch_indexer(datasize, batch_size):
+    """Just divide the datasize into batched size"""
+    dataindex = np.arange(datasize).tolist()
+
+    batchindex = []
+    for i in range(datasize // batch_size):
+        batchindex.append(dataindex[i * batch_size: (i + 1) * batch_size])
+    if datasize % batch_size > 0:
+        batchindex.append(dataindex[-(datasize % batch_size):])
+
+    return batchindex
+
+
+class BatchCostModel(object):
+    """Predicted cost (step time or memory) of a padded batch
+
+    cost = count * (frame * F + frame_square * F^2 + token * T) + bias
+    where F and T are the padded frame and token lengths. The quadratic term follows the
+    self-attention over frames, the token term the decoder and softmax. Coefficients are
+    configured by hand or fitted on profiled step times, see scripts/fit_batch_cost.py.
+    """
+
+    def __init__(self, coefficients, budget):
+        self.frame, self.frame_square, self.token, self.bias = [float(c) for c in coefficients]
+        self.budget = float(budget)
+
+    @classmethod
+    def from_string(cls, coefficients, budget):
+        """Parse "frame,frame_square,token,bias", None for an empty string"""
+        if coefficients.strip() == "":
+            return None
+        coefficients = [float(c) for c in coefficients.split(",")]
+        if len(coefficients) != 4:
+            raise ValueError("Expected 4 cost coefficients, got {}".format(coefficients))
+        if budget <= 0:
+            raise ValueError("A positive cost budget is required with a cost model")
+        return cls(coefficients, budget)
+
+    def __call__(self, counts, frames, tokens):
+        """Vectorized over arrays of batch sizes and padded lengths"""
+        frames = np.asarray(frames, dtype=np.float64)
+        tokens = np.asarray(tokens, dtype=np.float64)
+        per_sample = self.frame * frames + self.frame_square * frames * frames + self.token * tokens
+        return np.asarray(counts, dtype=np.float64) * per_sample + self.bias
+
+    def batch_cost(self, lengths):
+        """Cost of one batch given [(frames, tokens)] of its samples"""
+        lengths = np.asarray(lengths, dtype=np.int64).reshape([len(lengths), -1])
+        return float(self(len(lengths), lengths[:, 0].max(), lengths[:, 1].max()))
+
+    @staticmethod
+    def fit(counts, frames, tokens, costs):
+        """Least-squares coefficients from profiled batches"""
+        counts = np.asarray(counts, dtype=np.float64)
+        frames = np.asarray(frames, dtype=np.float64)
+        tokens = np.asarray(tokens, dtype=np.float64)
+        design = np.stack([counts * frames, counts * frames * frames,
+                           counts * tokens, np.ones_like(counts)], axis=1)
+        coefficients = np.linalg.lstsq(design, np.asarray(costs, dtype=np.float64), rcond=None)[0]
+        return coefficients.tolist()
+
+
+def token_indexer(dataset, token_size, cost_model=None):
+    """Divide the dataset into token-based batch"""
+    # assume dataset format: [(len1, len2, ..., lenN)]
+    # a batch grows until `count * max length` reaches token_size on any dimension,
+    # or, with a cost model over (frames, tokens), until its predicted cost reaches the budget
+    # when an extreme instance occur, handle it by making a 1-size batch
+    lengths = np.asarray(dataset, dtype=np.int64).reshape([len(dataset), -1])
+    datasize = len(lengths)
+
+    batchindex = []
+    start = 0
+    window = 64
+    while start < datasize:
+        end = min(start + window, datasize)
+
+        # running max length and the cost of cutting the batch at each position
+        max_lens = np.maximum.accumulate(lengths[start:end], axis=0)
+        counts = np.arange(1, end - start + 1)[:, None]
+        if cost_model is None:
+            overflow = np.any(counts * max_lens >= token_size, axis=1)
+        else:
+            overflow = cost_model(counts[:, 0], max_lens[:, 0], max_lens[:, 1]) >= cost_model.budget
+
+        if not overflow.any():
+            if end < datasize:
+                # no overflow inside the window, look further
+                window *= 2
+                continue
+            batch_end = datasize
+        else:
+            batch_end = start + max(int(np.argmax(overflow)), 1)
+
+        batchindex.append(list(range(start, batch_end)))
+        window = max(2 * (batch_end - start), 64)
+        start = batch_end
+
+    return batchindex
+
+
+def padding_minimal_indexer(dataset, token_size, cost_model=None):
+    """Divide the sorted dataset into token-based batches with the least padding
+
+    Batches are contiguous ranges of the (length sorted) dataset, satisfying the same budget
+    as token_indexer. Among all such divisions, dynamic programming picks one with the fewest
+    batches, and then the smallest padded area summed over all length dimensions.
+    """
+    lengths = np.asarray(dataset, dtype=np.int64).reshape([len(dataset), -1])
+    datasize = len(lengths)
+    cum_lengths = np.concatenate([np.zeros([1, lengths.shape[1]], dtype=np.int64),
+                                  np.cumsum(lengths, axis=0)], axis=0)
+
+    # lexicographic (batches, padding) packed into one integer
+    scale = int(lengths.max(initial=0)) * max(datasize, 1) * lengths.shape[1] + 1
+    best = np.zeros([datasize + 1], dtype=np.int64)
+    prev = np.zeros([datasize + 1], dtype=np.int64)
+
+    window = 64
+    for end in range(1, datasize + 1):
+        while True:
+            k = min(window, end)
+            # candidate batches [end - c, end) for c in 1..k, growing backwards
+            max_lens = np.maximum.accumulate(lengths[end - k:end][::-1], axis=0)
+            counts = np.arange(1, k + 1)[:, None]
+            if cost_model is None:
+                feasible = np.all(counts * max_lens < token_size, axis=1)
+            else:
+                feasible = cost_model(counts[:, 0], max_lens[:, 0], max_lens[:, 1]) < cost_model.budget
+            # an extreme instance makes a 1-size batch
+            feasible[0] = True
+            if feasible[-1] and k < end:
+                window *= 2
+                continue
+            break
+
+        starts = end - np.arange(1, k + 1)
+        padding = np.sum(counts * max_lens - (cum_lengths[end] - cum_lengths[starts]), axis=1)
+        scores = best[starts] + scale + padding
+        scores[~feasible] = np.iinfo(np.int64).max
+
+        choice = int(np.argmin(scores))
+        best[end] = scores[choice]
+        prev[end] = starts[choice]
+        window = max(2 * int(feasible.sum()), 64)
+
+    batchindex = []
+    end = datasize
+    while end > 0:
+        batchindex.append(list(range(int(prev[end]), end)))
+        end = int(prev[end])
+
+    return batchindex[::-1]
+
+
+def get_indexer(packing):
+    """Token batching strategy: greedy cuts at the first overflow, dp minimises padding"""
+    if packing == 'greedy':
+        return token_indexer
+    if packing == 'dp':
+        return padding_minimal_indexer
+    raise ValueError("Unknown batch packing {}".format(packing))
+
+
+def pack_rows(lengths, capacity):
+    """Group samples into rows, summing to at most `capacity` on every length dimension
+
+    The longest remaining sample opens a row, which is then topped up with the shortest
+    remaining ones. Samples exceeding the capacity get a row of their own.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64).reshape([len(lengths), -1])
+    capacity = np.asarray(capacity, dtype=np.int64)
+    order = np.argsort(lengths[:, 0], kind='stable').tolist()
+
+    rows = []
+    short, long = 0, len(order) - 1
+    while short <= long:
+        row = [order[long]]
+        used = lengths[order[long]].copy()
+        long -= 1
+        while short <= long and np.all(used + lengths[order[short]] <= capacity):
+            used += lengths[order[short]]
+            row.append(order[short])
+            short += 1
+        rows.append(row)
+    return rows
+
+
+def shard_batches(batches, num_shards, shard_index):
+    """Yield batch `shard_index` of every group of `num_shards` consecutive batches
+
+    Processes iterating the same batch stream thus get disjoint batches and the same number of
+    them: the incomplete group at the end is dropped.
+    """
+    group = []
+    for batch in batches:
+        group.append(batch)
+        if len(group) == num_shards:
+            yield group[shard_index]
+            group = []
+
+
+class PaddingMeter(object):
+    """Accumulate real and padded lengths of batches, per dimension (frames, tokens)"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.real = np.zeros([2], dtype=np.int64)
+        self.padded = np.zeros([2], dtype=np.int64)
+
+    def add(self, frames, tokens):
+        for dim, lens in enumerate([frames, tokens]):
+            lens = np.asarray(lens, dtype=np.int64)
+            if len(lens) > 0:
+                self.real[dim] += lens.sum()
+                self.padded[dim] += len(lens) * lens.max()
+
+    def ratios(self):
+        """Fraction of padding in the padded batches, for frames and tokens"""
+        return ((self.padded - self.real) / np.maximum(self.padded, 1)).tolist()
+
+
+class GlobalBatchSampler(object):
+    """Length-bucketed batches over the whole corpus
+
+    Samples are sorted by their longest dimension once, cut into size- or token-based
+    batches, and only the batch order changes between epochs, drawn from an epoch seed.
+    Batch composition is thus independent of buffer sizes and worker counts, and any
+    position (seed, cursor) in the stream can be reached without touching samples.
+    With a `pack_capacity`, samples are first packed into rows (see pack_rows), which are
+    batched as samples are, and every batch is a list of rows of sample indices.
+    """
+
+    def __init__(self, lengths, size, batch_or_token='token', cost_model=None, packing='greedy',
+                 pack_capacity=None):
+        lengths = np.asarray(lengths, dtype=np.int64).reshape([len(lengths), -1])
+
+        rows = None
+        if pack_capacity is not None:
+            rows = [np.asarray(row, dtype=np.int64) for row in pack_rows(lengths, pack_capacity)]
+            lengths = np.stack([lengths[row].sum(axis=0) for row in rows]).reshape([len(rows), -1])
+
+        order = np.argsort(lengths.max(axis=1), kind='stable')
+        if batch_or_token == 'batch':
+            index = batch_indexer(len(order), size)
+        else:
+            index = get_indexer(packing)(lengths[order], size, cost_model=cost_model)
+
+        if rows is None:
+            self.batches = [order[batch] for batch in index]
+        else:
+            self.batches = [[rows[r] for r in order[batch]] for batch in index]
+
+    def __len__(self):
+        return len(self.batches)
+
+    def order(self, seed=None, shuffle=True):
+        """Batch order for the given epoch seed"""
+        if not shuffle:
+            return np.arange(len(self.batches))
+        return np.random.RandomState(seed).permutation(len(self.batches))
+
+    def iterate(self, seed=None, cursor=0, shuffle=True, num_shards=1, shard_index=0):
+        """Yield sample indices of the batches at and after `cursor` in the epoch given by `seed`
+
+        With several shards, the epoch order is split as by shard_batches, and `cursor` counts
+        the batches of this shard.
+        """
+        order = self.order(seed, shuffle)
+        if num_shards > 1:
+            order = order[:len(order) // num_shards * num_shards][shard_index::num_shards]
+        for bidx in order[cursor:]:
+            yield self.batches[bidx]
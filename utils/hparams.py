@@ -0,0 +1,327 @@
+# coding: utf-8
+
+"""
+Default hyper-parameters, free of tensorflow.
+run.py builds its global HParams from them, and offline tools (see scripts/simulate_batching.py)
+read them without importing tensorflow.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+def default_params():
+    """A fresh dict of the default hyper-parameters"""
+    return dict(
+        # whether share source and target word embedding
+        shared_source_target_embedding=False,
+        # whether share target and softmax word embedding
+        shared_target_softmax_embedding=True,
+
+        # decoding maximum length: source length + decode_length
+        decode_length=50,
+        # beam size
+        beam_size=4,
+        # length penalty during beam search
+        decode_alpha=0.6,
+        decode_beta=1./6.,
+        # noise beam search with gumbel
+        enable_noise_beam_search=False,
+        # beam search temperature, sharp or flat prediction
+        beam_search_temperature=1.0,
+        # return top elements, not used
+        top_beams=1,
+        # which version of beam search to use
+        # cache or dev
+        search_mode="cache",
+
+        # distance considered for PDP
+        pdp_r=512,
+
+        # speech feature number
+        # not that meaningful, we extracted mel features of dimension 40
+        #   after applying deltas, the feature grows to 120
+        audio_sample_rate=16000,
+        audio_preemphasis=0.97,
+        # note, disable it after training
+        audio_dither=1.0 / np.iinfo(np.int16).max,
+        audio_frame_length=25.0,
+        audio_frame_step=10.0,
+        audio_lower_edge_hertz=20.0,
+        audio_upper_edge_hertz=8000.0,
+        audio_num_mel_bins=80,
+        audio_add_delta_deltas=True,
+        # how to read audio segments: mmap or librosa
+        #   mmap slices plain wav files directly and falls back to librosa for other formats
+        audio_reader="mmap",
+        # directory where source files that cannot be sliced directly (not audio_sample_rate, or not plain wav)
+        #   are decoded and resampled once, as 16-bit wav, empty to decode them for every segment
+        #   scripts/resample_audio.py fills it ahead of training, otherwise it is filled on first use
+        resample_cache="",
+        # resampler for other sample rates: librosa (high quality, slow) or polyphase (scipy, fast)
+        resample_method="librosa",
+        # size (in MB) of the shared in-memory cache of decoded waveforms, 0 disables it
+        #   once the corpus fits, epochs after the first one barely touch the disk
+        audio_cache_mb=0,
+        # waveform type from the data workers to the model: float32, or int16
+        #   int16 keeps the pcm samples as read, halving batch sizes, and scales them inside the frontend
+        audio_dtype="float32",
+        # model input: raw waveforms (audio), or offline logmel features (features)
+        #   features are produced by scripts/extract_features.py and skip the in-graph frontend
+        input_type="audio",
+
+        # ASR pretrained model path
+        asr_pretrain="",
+        # whether filter variables from ASR initialization, such as not initlaize global steps
+        filter_variables=False,
+
+        # lrate decay
+        # number of shards
+        nstable=4,
+        # warmup steps: start point for learning rate stop increaing
+        warmup_steps=4000,
+        # select strategy: noam, gnmt+, epoch, score and vanilla
+        lrate_strategy="noam",
+        # learning decay rate
+        lrate_decay=0.5,
+        # cosine learning rate schedule period
+        cosine_period=5000,
+        # cosine factor
+        cosine_factor=1,
+
+        # early stopping
+        estop_patience=100,
+
+        # initialization
+        # type of initializer
+        initializer="uniform",
+        # initializer range control
+        initializer_gain=0.08,
+
+        # parameters for rnnsearch
+        # encoder and decoder hidden size
+        hidden_size=1000,
+        # source and target embedding size
+        embed_size=620,
+        # dropout value
+        dropout=0.1,
+        relu_dropout=0.1,
+        residual_dropout=0.1,
+        # label smoothing value
+        label_smooth=0.1,
+        # model name
+        model_name="transformer",
+        # scope name
+        scope_name="transformer",
+        # filter size for transformer
+        filter_size=2048,
+        # attention dropout
+        attention_dropout=0.1,
+        # the number of encoder layers, valid for deep nmt
+        num_encoder_layer=6,
+        # the number of decoder layers, valid for deep nmt
+        num_decoder_layer=6,
+        # the number of attention heads
+        num_heads=8,
+
+        # sample rate * N / 100
+        max_frame_len=100,
+        max_text_len=100,
+        # constant batch size at 'batch' mode for batch-based batching
+        batch_size=80,
+        # constant token size at 'token' mode for token-based batching
+        token_size=3000,
+        # token or batch-based data iterator
+        batch_or_token='token',
+        # batch size for decoding, i.e. number of source sentences decoded at the same time
+        eval_batch_size=32,
+        # whether shuffle batches during training
+        shuffle_batch=True,
+        # data leak buffer threshold
+        data_leak_ratio=0.5,
+        # how token-based batches are cut from sorted samples: greedy, or dp
+        #   greedy: cut at the first overflow, dp: fewest batches first, then the least padded area
+        batch_packing="greedy",
+        # concatenate several training utterances into each row, up to max_frame_len and max_text_len,
+        #   attention stays within each utterance and losses are averaged over utterances
+        pack_sequences=False,
+        # cost model of token-based batches: "frame,frame_square,token,bias" coefficients, empty to disable
+        #   a batch costs count * (frame * F + frame_square * F^2 + token * T) + bias, with padded lengths F and T,
+        #   and is filled up to batch_cost_budget instead of token_size, see scripts/fit_batch_cost.py
+        batch_cost="",
+        batch_cost_budget=0.,
+        # append the padded shape and the step time of every training step into this file
+        batch_cost_profile="",
+        # training batch sampler: buffer or global
+        #   buffer: sort and batch within every buffer_size samples, tails leak into the next buffer
+        #   global: sort and batch the whole corpus once, only the batch order is shuffled per epoch
+        batch_sampler="buffer",
+        # split training batches among num_shards processes (e.g. one per host), this one takes shard_index
+        #   batches are formed over the whole corpus first, so every process runs the same number of steps
+        num_shards=1,
+        shard_index=0,
+
+        # whether use multiprocessing deal with data reading, default true
+        #   during training, process_num workers are forked once and serve all epochs and dev evaluations,
+        #   the next epoch is prefetched while the current one drains
+        process_num=1,
+        # buffer size controls the number of sentences readed in one time,
+        buffer_size=100,
+        # a unique queue in multi-thread reading process
+        input_queue_size=100,
+        output_queue_size=100,
+        # tune the number of data workers during training every N batches, 0 keeps process_num fixed
+        #   workers are added while the trainer waits for data, and retired while they wait for the trainer
+        #   all process_num_max workers are forked with the pool, the ones not in use are parked
+        #   once at process_num_max, the number of batches in flight grows up to the sum of the queue sizes
+        #   the workers, queue depth and last tuning decision are printed every disp_freq steps
+        data_autotune_interval=0,
+        process_num_min=1,
+        # 0: number of cpus
+        process_num_max=0,
+        # number of preallocated shared memory slots carrying batches from workers, 0 disables it
+        #   workers write arrays into a slot in place, and only a small descriptor is pickled
+        #   training and dev batches share the slots, each holding gpus + 1 of them, or
+        #   gpus * (device_prefetch_steps + 2) + 1 with device_prefetch: at least twice that plus one is required
+        shm_slots=0,
+        # size (in MB) of one slot, batches exceeding it are pickled as usual
+        shm_slot_mb=64,
+        # yield batches in reading order with several data workers, for reproducible training runs
+        #   out-of-order batches wait in a reorder buffer bounded by the queue sizes
+        ordered_batches=False,
+        # stage training batches into per-tower tf.data pipelines instead of feeding them at every step
+        #   host-to-device copies then overlap the previous step, not available with safe_nan
+        device_prefetch=False,
+        # number of tower groups staged ahead of the running step
+        device_prefetch_steps=1,
+        # collate batches into reused, bucket-sized arrays inside the data workers
+        #   only effective with the shared memory transport (shm_slots > 0), which copies batches out
+        collate_buffers=True,
+        # drop the raw samples from batches, as the training and decoding loops never read them
+        drop_raw=True,
+
+        # source vocabulary
+        src_vocab_file="",
+        # target vocabulary
+        tgt_vocab_file="",
+        # source train file
+        #   the *_path audio locations are directories, or tar/zip archives read in place (indexed once)
+        src_train_path="",
+        src_train_file="",
+        # offline features of train/dev/test sources, valid for input_type=features
+        src_train_feature="",
+        # target train file
+        tgt_train_file="",
+        # ctc train file
+        ctc_train_file="",
+        # binarised target/ctc train files (python vocab.py --binarize <vocab> <text file> <prefix>),
+        #   read via memory map instead of the text files above, separated by ';' as these
+        tgt_train_bin="",
+        ctc_train_bin="",
+        # compiled training manifest (scripts/compile_manifest.py), replacing the three files above
+        train_manifest="",
+        # packed training shards (scripts/pack_shards.py), replacing the audio and the three files above
+        train_shards="",
+        # number of shards read at the same time, their blocks are interleaved
+        shard_read_parallel=4,
+        # number of consecutive segments read at once, blocks are shuffled within every shard
+        shard_block_size=256,
+        # source development file
+        src_dev_path="",
+        src_dev_file="",
+        src_dev_feature="",
+        # target development file
+        tgt_dev_file="",
+        # source test file
+        src_test_path="",
+        src_test_file="",
+        src_test_feature="",
+        # target test file
+        tgt_test_file="",
+        # output directory
+        output_dir="",
+        # output during testing
+        test_output="",
+
+        # adam optimizer hyperparameters
+        beta1=0.9,
+        beta2=0.999,
+        epsilon=1e-9,
+        # gradient clipping value
+        clip_grad_norm=5.0,
+        # the gradient norm upper bound, to avoid wired large gradient norm, only works for safe nan mode
+        gnorm_upper_bound=1e20,
+        # initial learning rate
+        lrate=1e-5,
+        # minimum learning rate
+        min_lrate=0.0,
+        # maximum learning rate
+        max_lrate=1.0,
+
+        # maximum epochs
+        epoches=10,
+        # the effective batch size is: batch/token size * update_cycle * num_gpus
+        # sequential update cycle
+        update_cycle=1,
+        # the number of gpus
+        gpus=[0],
+
+        # enable safely handle nan
+        safe_nan=False,
+        # exponential moving average for stability, disabled by default
+        ema_decay=-1.,
+
+        # enable training deep transformer
+        deep_transformer_init=False,
+
+        # print information every disp_freq training steps
+        disp_freq=100,
+        # evaluate on the development file every eval_freq steps
+        eval_freq=10000,
+        # keep the dev batches processed at the first evaluation, and replay them in the following ones
+        cache_dev_batches=False,
+        # file holding the cached dev sources as a memory map, empty to keep them in memory
+        dev_batch_cache_path="",
+        # save the model parameters every save_freq steps
+        save_freq=5000,
+        # print sample translations every sample_freq steps
+        sample_freq=1000,
+        # saved checkpoint number
+        checkpoints=5,
+        best_checkpoints=1,
+        # the maximum training steps, program with stop if epochs or max_training_steps is meet
+        max_training_steps=1000,
+
+        # random control, not so well for tensorflow.
+        random_seed=1234,
+        # whether or not train from checkpoint
+        train_continue=True,
+
+        # provide interface to modify the default datatype
+        default_dtype="float32",
+        dtype_epsilon=1e-8,
+        dtype_inf=1e8,
+        loss_scale=1.0,
+
+        # speech-specific settings
+        sinusoid_posenc=True,
+        max_poslen=2048,
+        ctc_repeated=False,
+        ctc_enable=False,
+        ctc_alpha=0.3,      # ctc loss factor
+        enc_localize="log",
+        dec_localize="none",
+        encdec_localize="none",
+
+        # cola ctc settings
+        # -1: disable cola ctc, in our paper we set 256.
+        cola_ctc_L=-1,
+
+        # neural acoustic feature modeling
+        use_nafm=False,
+        nafm_alpha=0.05,
+    )
+
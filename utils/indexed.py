@@ -0,0 +1,136 @@
+# coding: utf-8
+
+"""
+Flat binary storage for variable-length arrays, such as audio features or token ids.
+Each dataset is a pair of files sharing one prefix:
+    - prefix.bin: all entries concatenated along the first axis
+    - prefix.idx: entry offsets (in rows), element dtype and trailing shape
+Entries are served as views of a read-only memory map, so readers do no per-entry parsing.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import glob
+import numpy as np
+
+
+def indexed_exists(prefix):
+    return os.path.exists(prefix + ".bin") and os.path.exists(prefix + ".idx")
+
+
+class IndexedArrayBuilder(object):
+    """Append entries to prefix.bin, offsets are written to prefix.idx at finalize"""
+
+    def __init__(self, prefix, dtype, shape=()):
+        self.prefix = prefix
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+
+        self._writer = open(prefix + ".bin", 'wb')
+        self._offsets = [0]
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def add(self, array):
+        array = np.ascontiguousarray(array, dtype=self.dtype)
+        assert array.shape[1:] == self.shape, (array.shape, self.shape)
+
+        self._writer.write(array.tobytes())
+        self._offsets.append(self._offsets[-1] + len(array))
+
+    def finalize(self):
+        self._writer.close()
+        with open(self.prefix + ".idx", 'wb') as writer:
+            np.savez(writer,
+                     offsets=np.asarray(self._offsets, dtype=np.int64),
+                     dtype=np.asarray(self.dtype.str),
+                     shape=np.asarray(self.shape, dtype=np.int64))
+
+
+class IndexedArray(object):
+    """Random access to entries written by IndexedArrayBuilder"""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+        with open(prefix + ".idx", 'rb') as reader:
+            index = np.load(reader)
+            self.offsets = index['offsets']
+            self.dtype = np.dtype(str(index['dtype']))
+            self.shape = tuple(index['shape'].tolist())
+
+        total = int(self.offsets[-1])
+        if total > 0:
+            self.data = np.memmap(prefix + ".bin", dtype=self.dtype, mode='r',
+                                  shape=(total,) + self.shape)
+        else:
+            self.data = np.zeros((0,) + self.shape, dtype=self.dtype)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]: self.offsets[i + 1]]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+
+def shard_prefix(prefix, shard):
+    return "{}.{:05d}".format(prefix, shard)
+
+
+class ShardedIndexedArrayBuilder(object):
+    """Write entries into a sequence of shards, each holding at most `shard_size` entries"""
+
+    def __init__(self, prefix, dtype, shape=(), shard_size=100000):
+        self.prefix = prefix
+        self.dtype = dtype
+        self.shape = shape
+        self.shard_size = shard_size
+
+        self._num_shards = 0
+        self._builder = None
+
+    def add(self, array):
+        if self._builder is None or len(self._builder) >= self.shard_size:
+            if self._builder is not None:
+                self._builder.finalize()
+            self._builder = IndexedArrayBuilder(
+                shard_prefix(self.prefix, self._num_shards), self.dtype, self.shape)
+            self._num_shards += 1
+        self._builder.add(array)
+
+    def finalize(self):
+        if self._builder is not None:
+            self._builder.finalize()
+        return self._num_shards
+
+
+class ShardedIndexedArray(object):
+    """Concatenated view over all shards written by ShardedIndexedArrayBuilder"""
+
+    def __init__(self, prefix):
+        shard_files = sorted(glob.glob(prefix + ".[0-9][0-9][0-9][0-9][0-9].idx"))
+        if len(shard_files) == 0:
+            raise ValueError("No shards found for {}".format(prefix))
+
+        self.shards = [IndexedArray(f[:-len(".idx")]) for f in shard_files]
+        self.shape = self.shards[0].shape
+        self.dtype = self.shards[0].dtype
+        # global entry index => (shard, local index)
+        self.bounds = np.cumsum([0] + [len(shard) for shard in self.shards])
+
+    def __len__(self):
+        return int(self.bounds[-1])
+
+    def __getitem__(self, i):
+        shard = int(np.searchsorted(self.bounds, i, side='right')) - 1
+        return self.shards[shard][i - self.bounds[shard]]
+
+    def lengths(self):
+        return np.concatenate([shard.lengths() for shard in self.shards])
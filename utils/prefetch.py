@@ -0,0 +1,122 @@
+# coding: utf-8
+
+"""
+Device-side input pipeline for training.
+Batches produced by the data workers are staged into one tf.data pipeline per tower, a few
+steps ahead of the training loop, so that host-to-device copies overlap the previous step
+instead of being part of every `sess.run` as with feed_dict.
+The resulting tensors can still be fed, which is how evaluation and sampling use them.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import numpy as np
+import tensorflow as tf
+
+from six.moves import queue
+from modules import speech
+from utils import queuer
+
+
+class DevicePrefetcher(object):
+    def __init__(self, params, lookahead=1):
+        self.num_towers = max(len(params.gpus), 1)
+        self.lookahead = lookahead
+
+        self._queues = [queue.Queue() for _ in range(self.num_towers)]
+        # batches of the incomplete tower group, and how many of them were handed out
+        self._unstaged = []
+        self._unstaged_yielded = 0
+        # staged batches not yet handed to the training loop
+        self._staged = collections.deque()
+
+        self.features = []
+        self.initializers = []
+        for tidx in range(self.num_towers):
+            feature, initializer = self._tower_pipeline(tidx, params)
+            self.features.append(feature)
+            self.initializers.append(initializer)
+
+    def _tower_pipeline(self, tidx, params):
+        batches = self._queues[tidx]
+
+        def _generator():
+            while True:
+                data = batches.get()
+                if data is None:
+                    return
+                indices, values, shape = data['spar']
+                outputs = (data['src'], data['tgt'], np.reshape(indices, [-1, 2]), values, shape)
+                if params.pack_sequences:
+                    outputs += (data['src_seg'], data['tgt_seg'])
+                yield outputs
+
+        src_shape = [None, None]
+        if params.input_type == "features":
+            src_shape.append(speech.feature_size(params))
+
+        output_types = (speech.source_dtype(params), tf.int32, tf.int64, tf.int32, tf.int64)
+        output_shapes = (tf.TensorShape(src_shape), tf.TensorShape([None, None]),
+                         tf.TensorShape([None, 2]), tf.TensorShape([None]), tf.TensorShape([2]))
+        if params.pack_sequences:
+            # segment ids of the samples packed into each row
+            output_types += (tf.int32, tf.int32)
+            output_shapes += (tf.TensorShape([None, None]), tf.TensorShape([None, None]))
+
+        dataset = tf.data.Dataset.from_generator(
+            _generator, output_types=output_types, output_shapes=output_shapes)
+        if len(params.gpus) > 0:
+            # towers are placed on /gpu:i, see utils.parallel
+            dataset = dataset.apply(
+                tf.data.experimental.prefetch_to_device("/gpu:{}".format(tidx), buffer_size=1))
+        else:
+            dataset = dataset.prefetch(1)
+
+        iterator = tf.compat.v1.data.make_initializable_iterator(dataset)
+        outputs = iterator.get_next()
+        source, target, indices, values, shape = outputs[:5]
+
+        feature = {
+            "source": source,
+            "target": target,
+            "label": tf.SparseTensor(indices, values, shape),
+        }
+        if params.pack_sequences:
+            feature["source_segments"], feature["target_segments"] = outputs[5:]
+        return feature, iterator.initializer
+
+    def stage(self, data_iter):
+        """Yield the batches of `data_iter`, each full tower group being staged `lookahead` groups earlier
+
+        As in the training loop, a group is one batch per tower, and an incomplete group at the
+        end of `data_iter` is carried over to the next call.
+        """
+        for data in data_iter:
+            self._unstaged.append(data)
+
+            if len(self._unstaged) == self.num_towers:
+                for batches, _data in zip(self._queues, self._unstaged):
+                    batches.put(_data)
+                self._staged.extend(self._unstaged[self._unstaged_yielded:])
+                self._unstaged = []
+                self._unstaged_yielded = 0
+
+            while len(self._staged) > self.lookahead * self.num_towers:
+                yield self._staged.popleft()
+
+        while len(self._staged) > 0:
+            yield self._staged.popleft()
+        for data in self._unstaged[self._unstaged_yielded:]:
+            yield data
+        self._unstaged_yielded = len(self._unstaged)
+
+    def detach(self):
+        """Copy the carried batches of the incomplete tower group, before their shared memory is released"""
+        self._unstaged = [queuer.copy_chunk(data) for data in self._unstaged]
+
+    def close(self):
+        for batches in self._queues:
+            batches.put(None)
@@ -10,6 +10,13 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import time
+import ctypes
+import pickle
+import threading
+import collections
+import multiprocessing
+import numpy as np
 from multiprocessing import Process, Queue
 # from threading import Thread as Process
 # from queue import Queue
@@ -35,13 +42,252 @@ def combine_reader_to_processor(reader, preprocessor):
         yield preprocessor(data_chunk)
 
 
+def tag_reader_with_sequence(reader, credits):
+    # every chunk in flight takes one credit, returned by the consumer once it is yielded
+    for seq, data_chunk in enumerate(reader):
+        credits.acquire()
+        yield seq, data_chunk
+
+
+class _Reorder(object):
+    """Processed chunks put aside until they are consumed, in arrival or sequence order"""
+
+    def __init__(self, ordered=False):
+        self.ordered = ordered
+        self.next_seq = 0
+        self._chunks = {}
+        self._arrival = collections.deque()
+
+    def __len__(self):
+        return len(self._chunks)
+
+    def is_next(self, seq):
+        return not self.ordered or seq == self.next_seq
+
+    def put(self, seq, data_chunk):
+        self._chunks[seq] = data_chunk
+        if not self.ordered:
+            self._arrival.append(seq)
+
+    def taken(self, seq):
+        self.next_seq += 1
+
+    def pop(self):
+        """Return (True, chunk) for the next consumable chunk, or (False, None)"""
+        if self.ordered:
+            if self.next_seq not in self._chunks:
+                return False, None
+            seq = self.next_seq
+        else:
+            if len(self._arrival) == 0:
+                return False, None
+            seq = self._arrival.popleft()
+
+        data_chunk = self._chunks.pop(seq)
+        self.taken(seq)
+        return True, data_chunk
+
+
+def min_shm_slots(hold, jobs=1):
+    """Slots needed by `jobs` consumers holding `hold` chunks each, plus one for the producers"""
+    return jobs * hold + 1
+
+
+class SharedMemoryRing(object):
+    """A ring of preallocated shared memory slots to move numpy arrays across processes
+
+    Producers copy the arrays of a processed data chunk into a free slot, and only a small
+    descriptor goes through the multiprocessing queue; the consumer gets read-only views
+    onto the slot. A slot returns to the ring once the consumer has moved `hold` chunks
+    further, so the consumer must not keep more than `hold` chunks alive at a time.
+    Up to `jobs` consumers may hold slots at once, each one its own `hold` chunks.
+    Chunks that do not fit into one slot fall back to pickling. Either way, the arrays of a
+    chunk are copied by `pack`, so the producer is free to reuse them afterwards.
+    """
+
+    alignment = 64
+
+    def __init__(self, num_slots, slot_bytes, hold=1, jobs=1):
+        # producers block until a slot is free, so held slots must leave one for them
+        if num_slots < min_shm_slots(hold, jobs):
+            raise ValueError("{} shared memory slots are too few for {} job(s) holding {} chunks each, "
+                             "at least {} are required.".format(num_slots, jobs, hold,
+                                                                min_shm_slots(hold, jobs)))
+
+        self.num_slots = num_slots
+        self.slot_bytes = slot_bytes
+        self.hold = hold
+
+        self._arena = multiprocessing.RawArray(ctypes.c_char, num_slots * slot_bytes)
+        self._free_slots = Queue()
+        for sid in range(num_slots):
+            self._free_slots.put(sid)
+
+        self._leased = collections.deque()
+
+    def _slot(self, sid):
+        return np.frombuffer(self._arena, dtype=np.uint8,
+                             count=self.slot_bytes, offset=sid * self.slot_bytes)
+
+    def _layout(self, value, offset):
+        if isinstance(value, np.ndarray):
+            spec = ('array', offset, value.dtype.str, value.shape)
+            offset += (value.nbytes + self.alignment - 1) // self.alignment * self.alignment
+            return spec, offset
+        if isinstance(value, tuple) and len(value) > 0 \
+                and all(isinstance(v, np.ndarray) for v in value):
+            specs = []
+            for v in value:
+                spec, offset = self._layout(v, offset)
+                specs.append(spec)
+            return ('tuple', specs), offset
+        return ('object', value), offset
+
+    def _write(self, slot, spec, value):
+        if spec[0] == 'array':
+            _, offset, _, _ = spec
+            view = value.reshape([-1]).view(np.uint8) if value.flags.c_contiguous \
+                else np.ascontiguousarray(value).reshape([-1]).view(np.uint8)
+            slot[offset: offset + view.nbytes] = view
+        elif spec[0] == 'tuple':
+            for s, v in zip(spec[1], value):
+                self._write(slot, s, v)
+
+    def _read(self, slot, spec):
+        if spec[0] == 'array':
+            _, offset, dtype, shape = spec
+            dtype = np.dtype(dtype)
+            count = int(np.prod(shape))
+            return slot[offset: offset + count * dtype.itemsize].view(dtype).reshape(shape)
+        elif spec[0] == 'tuple':
+            return tuple(self._read(slot, s) for s in spec[1])
+        return spec[1]
+
+    def pack(self, data_chunk):
+        """Producer side: move the arrays of a dict chunk into a slot, return its descriptor"""
+        if not isinstance(data_chunk, dict):
+            return data_chunk
+
+        specs, offset = {}, 0
+        for key, value in data_chunk.items():
+            specs[key], offset = self._layout(value, offset)
+        if offset > self.slot_bytes:
+            # serialized right away, as with slots the producer may reuse its arrays once packed
+            return _PickledChunk(pickle.dumps(data_chunk, protocol=pickle.HIGHEST_PROTOCOL))
+
+        # blocks until the consumer releases a slot
+        sid = self._free_slots.get()
+        slot = self._slot(sid)
+        for key, value in data_chunk.items():
+            self._write(slot, specs[key], value)
+        return _SlotDescriptor(sid, specs)
+
+    def unpack(self, data_chunk, leased=None):
+        """Consumer side: rebuild the chunk with views onto its slot"""
+        if isinstance(data_chunk, _PickledChunk):
+            return pickle.loads(data_chunk.payload)
+        if not isinstance(data_chunk, _SlotDescriptor):
+            return data_chunk
+        if leased is None:
+            leased = self._leased
+
+        slot = self._slot(data_chunk.sid)
+        data = {key: self._read(slot, spec) for key, spec in data_chunk.specs.items()}
+
+        # release slots that are no longer held by the consumer
+        leased.append(data_chunk.sid)
+        while len(leased) > self.hold:
+            self._free_slots.put(leased.popleft())
+        return data
+
+    def copy_out(self, data_chunk):
+        """Consumer side: copy the chunk out of its slot and release the slot at once"""
+        if isinstance(data_chunk, _PickledChunk):
+            return pickle.loads(data_chunk.payload)
+        if not isinstance(data_chunk, _SlotDescriptor):
+            return data_chunk
+
+        slot = self._slot(data_chunk.sid)
+        data = copy_chunk({key: self._read(slot, spec) for key, spec in data_chunk.specs.items()})
+
+        self._free_slots.put(data_chunk.sid)
+        return data
+
+    def release(self, leased):
+        while len(leased) > 0:
+            self._free_slots.put(leased.popleft())
+
+
+class _SlotDescriptor(collections.namedtuple("SlotDescriptor", ("sid", "specs"))):
+    pass
+
+
+class _PickledChunk(collections.namedtuple("PickledChunk", ("payload",))):
+    pass
+
+
+def copy_chunk(data_chunk):
+    """Copy the arrays of a dict chunk, detaching them from the shared memory slot they may view"""
+    if not isinstance(data_chunk, dict):
+        return data_chunk
+
+    data = {}
+    for key, value in data_chunk.items():
+        if isinstance(value, np.ndarray):
+            value = value.copy()
+        elif isinstance(value, tuple) and all(isinstance(v, np.ndarray) for v in value):
+            value = tuple(v.copy() for v in value)
+        data[key] = value
+    return data
+
+
+def drop_keys_from_chunk(data_chunk, keys):
+    if isinstance(data_chunk, dict):
+        for key in keys:
+            data_chunk.pop(key, None)
+    return data_chunk
+
+
+def staged_groups(params):
+    if params.device_prefetch and not params.safe_nan:
+        return params.device_prefetch_steps + 1
+    return 0
+
+
+def transport_options(params):
+    """EnQueuer transport arguments from the hyper-parameters"""
+    # consumers group one chunk per gpu before feeding, and keep the last one for sampling
+    #   the device prefetcher keeps a few more groups staged
+    hold = max(len(params.gpus), 1) * (1 + staged_groups(params)) + 1
+    # a training epoch and a dev evaluation hold chunks at the same time
+    required = min_shm_slots(hold, jobs=2)
+    if 0 < params.shm_slots < required:
+        raise ValueError("shm_slots={} is too small: training and dev batches each hold {} slots with {} gpu(s) "
+                         "and {} staged groups, at least {} slots are required"
+                         "".format(params.shm_slots, hold, max(len(params.gpus), 1),
+                                   staged_groups(params), required))
+
+    return {
+        'shm_slots': params.shm_slots,
+        'shm_slot_mb': params.shm_slot_mb,
+        'shm_hold': hold,
+        'drop_keys': ('raw',) if params.drop_raw else None,
+        'ordered': params.ordered_batches,
+    }
+
+
 class EnQueuer(object):
     def __init__(self,
                  reader,
                  preprocessor,
                  worker_processes_num=1,
                  input_queue_size=5,
-                 output_queue_size=5
+                 output_queue_size=5,
+                 shm_slots=0,               # number of shared memory slots, 0 pickles chunks through queues
+                 shm_slot_mb=64,            # size of one slot, larger chunks fall back to pickling
+                 shm_hold=1,                # number of chunks the consumer keeps alive at once
+                 drop_keys=None,            # chunk entries the consumer does not use, such as 'raw'
+                 ordered=False,             # yield chunks in reading order with several processing workers
                  ):
         if worker_processes_num < 0:
             raise ValueError("worker_processes_num must be a "
@@ -53,9 +299,28 @@ class EnQueuer(object):
         self.output_queue_size = output_queue_size
         self.reader = reader
 
+        if drop_keys:
+            self.preprocessor = lambda chunk: drop_keys_from_chunk(preprocessor(chunk), drop_keys)
+
+        # zero-copy transport only matters when chunks cross processes
+        self.ring = None
+        if shm_slots > 0 and worker_processes_num > 0:
+            self.ring = SharedMemoryRing(shm_slots, shm_slot_mb * 1024 * 1024, hold=shm_hold)
+
+        # a single worker keeps the reading order anyway
+        self.ordered = ordered and worker_processes_num > 1
+        self._iterator = None
+
     # make the queue iterable
     def __iter__(self):
-        return self._create_processed_data_chunks_gen(self.reader)
+        self._iterator = self._create_processed_data_chunks_gen(self.reader)
+        return self._iterator
+
+    def close(self):
+        """Stop the workers of an iteration left unfinished, e.g. by an exception of the consumer"""
+        if self._iterator is not None:
+            self._iterator.close()
+            self._iterator = None
 
     def _create_processed_data_chunks_gen(self, reader_gen):
         if self.worker_processes_number == 0:
@@ -72,6 +337,24 @@ class EnQueuer(object):
         output_queue = Queue(self.output_queue_size)
         workers = []
 
+        preprocessor = self.preprocessor
+        if self.ring is not None:
+            preprocessor = lambda chunk: self.ring.pack(self.preprocessor(chunk))
+
+        reorder = _Reorder(self.ordered)
+        if self.ordered:
+            # chunks carry their sequence numbers, and at most `credits` of them are
+            #   queued, being processed or waiting in the reorder buffer at any time
+            num_credits = self.input_queue_size + self.output_queue_size + self.worker_processes_number
+            if self.ring is not None:
+                # buffered chunks keep their slots, leave room for the one to yield next
+                num_credits = min(num_credits, self.ring.num_slots - self.ring.hold)
+            credits = multiprocessing.Semaphore(max(num_credits, 1))
+            reader_gen = tag_reader_with_sequence(reader_gen, credits)
+
+            _preprocessor = preprocessor
+            preprocessor = lambda task: (task[0], _preprocessor(task[1]))
+
         if self.worker_processes_number > 1:
             term_tokens_expected = self.worker_processes_number - 1
             input_queue = Queue(self.input_queue_size)
@@ -85,14 +368,14 @@ class EnQueuer(object):
                 queue_iter = create_iter_from_queue(input_queue,
                                                     TERMINATION_TOKEN)
 
-                data_itr = combine_reader_to_processor(queue_iter, self.preprocessor)
+                data_itr = combine_reader_to_processor(queue_iter, preprocessor)
                 proc_worker = _ParallelWorker(data_chunk_iter=data_itr,
                                               queue=output_queue)
                 workers.append(proc_worker)
         else:
             term_tokens_expected = 1
 
-            data_itr = combine_reader_to_processor(reader_gen, self.preprocessor)
+            data_itr = combine_reader_to_processor(reader_gen, preprocessor)
             proc_worker = _ParallelWorker(data_chunk_iter=data_itr,
                                           queue=output_queue)
             workers.append(proc_worker)
@@ -101,19 +384,336 @@ class EnQueuer(object):
             pr.daemon = True
             pr.start()
 
+        try:
+            while True:
+                data_chunk = output_queue.get()
+                if data_chunk == TERMINATION_TOKEN:
+                    term_tokens_received += 1
+                    # need to received all tokens in order to be sure that
+                    # all data has been processed
+                    if term_tokens_received == term_tokens_expected:
+                        for pr in workers:
+                            pr.join()
+                        break
+                    continue
+
+                if not self.ordered:
+                    if self.ring is not None:
+                        data_chunk = self.ring.unpack(data_chunk)
+                    yield data_chunk
+                    continue
+
+                seq, data_chunk = data_chunk
+                reorder.put(seq, data_chunk)
+                while True:
+                    ready, data_chunk = reorder.pop()
+                    if not ready:
+                        break
+                    credits.release()
+                    if self.ring is not None:
+                        data_chunk = self.ring.unpack(data_chunk)
+                    yield data_chunk
+        finally:
+            # workers of an unfinished iteration stay blocked on full queues otherwise
+            for pr in workers:
+                if pr.is_alive():
+                    pr.terminate()
+
+
+class WorkerPool(object):
+    """Long-lived data workers shared by all epochs and datasets
+
+    Worker processes are forked once with a dict of named preprocessors, such as
+    {'train': train_dataset.processor, 'dev': dev_dataset.processor}. Each `submit`
+    starts a job: a feeder thread in the main process pushes the reader output into the
+    shared input queue, bounded by `max_inflight` chunks not yet consumed, and iterating
+    over the job yields its processed chunks. Chunks of other jobs arriving meanwhile are
+    stashed, so a job submitted early (the next epoch, say) is prefetched while the
+    current one drains, and a dev evaluation can run in the middle of a training epoch.
+    Ordered jobs also stash early chunks of their own, and yield in reading order.
+    Jobs must be consumed from one thread.
+    With autotuning, up to `max_workers` workers are forked at once as well, and the ones beyond
+    the current number of workers are parked: forking never happens once training has started.
+    """
+
+    def __init__(self,
+                 preprocessors,
+                 worker_processes_num=1,
+                 input_queue_size=5,
+                 output_queue_size=5,
+                 shm_slots=0,
+                 shm_slot_mb=64,
+                 shm_hold=1,
+                 drop_keys=None,
+                 ordered=False,
+                 autotune_interval=0,       # consumed chunks between two tuning decisions, 0 disables tuning
+                 min_workers=1,
+                 max_workers=None,          # None: number of cpus
+                 ):
+        if worker_processes_num <= 0:
+            raise ValueError("worker_processes_num must be a "
+                             "positive integer.")
+
+        self.preprocessors = preprocessors
+        self.drop_keys = drop_keys
+        self.ordered = ordered
+
+        # a dev evaluation in the middle of a training epoch leases slots alongside the epoch job
+        self.ring = None
+        if shm_slots > 0:
+            self.ring = SharedMemoryRing(shm_slots, shm_slot_mb * 1024 * 1024, hold=shm_hold, jobs=2)
+
+        # queues are created at their largest size, the depth actually used is
+        #   the number of chunks a job may have in flight
+        self.depth = output_queue_size
+        self.max_depth = input_queue_size + output_queue_size
+        self._input_queue = Queue(input_queue_size)
+        self._output_queue = Queue(output_queue_size)
+
+        self._job_counter = 0
+        self._stash = {}
+
+        # time the consumer blocks on the output queue (starvation), and the
+        #   time workers block on it (backpressure)
+        self.autotune_interval = autotune_interval
+        self.min_workers = max(min_workers, 1)
+        self.max_workers = max_workers or multiprocessing.cpu_count()
+        self._producer_wait = multiprocessing.Value(ctypes.c_double, 0.)
+        self._consumer_wait = 0.
+        self._consumed = 0
+        self._window = (time.time(), 0., 0.)
+        self._history = collections.deque(maxlen=100)
+
+        # workers with an index from `_active` on wait on `_parking` instead of taking chunks
+        self._active = multiprocessing.RawValue(ctypes.c_int, worker_processes_num)
+        self._parking = multiprocessing.Condition()
+        self.num_workers = worker_processes_num
+
+        num_forked = worker_processes_num
+        if autotune_interval > 0:
+            num_forked = max(self.max_workers, worker_processes_num)
+        self._workers = []
+        for widx in range(num_forked):
+            worker = _PoolWorker(self, widx)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _set_active(self, num_workers):
+        with self._parking:
+            self._active.value = num_workers
+            self._parking.notify_all()
+        self.num_workers = num_workers
+
+    def _add_worker(self):
+        self._set_active(self.num_workers + 1)
+
+    def _retire_worker(self):
+        # the last active worker parks once it is done with the chunk it waits for
+        self._set_active(self.num_workers - 1)
+
+    def _autotune(self, job):
+        """Scale workers and in-flight chunks from the waiting times of the last window"""
+        start_time, consumer_wait, producer_wait = self._window
+        now = time.time()
+        elapsed = max(now - start_time, 1e-6)
+        starvation = (self._consumer_wait - consumer_wait) / elapsed
+        backpressure = (self._producer_wait.value - producer_wait) / (elapsed * self.num_workers)
+        self._window = (now, self._consumer_wait, self._producer_wait.value)
+
+        action = "keep"
+        if starvation > 0.1:
+            # the trainer waits for data
+            if self.num_workers < min(self.max_workers, len(self._workers)):
+                self._add_worker()
+                action = "add worker"
+            elif self.depth < self.max_depth:
+                self.depth += 1
+                job.credits.release()
+                action = "deepen queue"
+        elif starvation < 0.01 and backpressure > 0.5 and self.num_workers > self.min_workers:
+            # workers mostly wait for the trainer, give the cpu back to the session
+            self._retire_worker()
+            action = "retire worker"
+
+        self._history.append((self._consumed, starvation, backpressure, self.num_workers, self.depth, action))
+
+    def stats(self):
+        return {
+            'workers': self.num_workers,
+            'depth': self.depth,
+            'consumed': self._consumed,
+            'consumer_wait': self._consumer_wait,
+            'producer_wait': self._producer_wait.value,
+            'history': list(self._history)[-5:],
+        }
+
+    def process(self, name, data_chunk):
+        """Worker side: run the named preprocessor, and hand over the result"""
+        data_chunk = self.preprocessors[name](data_chunk)
+        if self.drop_keys:
+            data_chunk = drop_keys_from_chunk(data_chunk, self.drop_keys)
+        if self.ring is not None:
+            data_chunk = self.ring.pack(data_chunk)
+        return data_chunk
+
+    def submit(self, name, reader, max_inflight=None, after=None, ordered=None):
+        """Start feeding `reader` to the `name` preprocessor, after the feeding of job `after` finishes"""
+        if name not in self.preprocessors:
+            raise ValueError("Unknown preprocessor {}".format(name))
+
+        self._job_counter += 1
+        job = _PoolJob(self, self._job_counter, name, reader,
+                       max_inflight or self.depth, after)
+        self._stash[job.job_id] = _Reorder(self.ordered if ordered is None else ordered)
+        job.start()
+        return job
+
+    def _next(self, job):
+        """Consumer side: the next processed chunk of `job`, None when it is exhausted"""
+        data_chunk = self._receive(job)
+        if data_chunk is not None:
+            job.credits.release()
+            job.received += 1
+
+            self._consumed += 1
+            if self.autotune_interval > 0 and self._consumed % self.autotune_interval == 0:
+                self._autotune(job)
+        return data_chunk
+
+    def _receive(self, job):
+        stash = self._stash[job.job_id]
         while True:
-            data_chunk = output_queue.get()
+            ready, data_chunk = stash.pop()
+            if ready:
+                return data_chunk
+            if job.total is not None and job.received == job.total:
+                return None
+
+            start_time = time.time()
+            job_id, seq, data_chunk = self._output_queue.get()
+            self._consumer_wait += time.time() - start_time
+
             if data_chunk == TERMINATION_TOKEN:
-                term_tokens_received += 1
-                # need to received all tokens in order to be sure that
-                # all data has been processed
-                if term_tokens_received == term_tokens_expected:
-                    for pr in workers:
-                        pr.join()
-                    break
                 continue
+            if job_id not in self._stash:
+                # cancelled job
+                if self.ring is not None:
+                    self.ring.copy_out(data_chunk)
+                continue
+
+            if job_id == job.job_id and stash.is_next(seq):
+                stash.taken(seq)
+                if self.ring is not None:
+                    data_chunk = self.ring.unpack(data_chunk, job.leased)
+                return data_chunk
+
+            # the chunk belongs to another job, or comes out of order
+            if self.ring is not None:
+                # do not hold slots for chunks consumed later
+                data_chunk = self.ring.copy_out(data_chunk)
+            self._stash[job_id].put(seq, data_chunk)
+
+    def _close_job(self, job):
+        job.cancelled = True
+        # wake up a feeder waiting for credits
+        job.credits.release()
+        self._stash.pop(job.job_id, None)
+        if self.ring is not None:
+            self.ring.release(job.leased)
+
+    def close(self):
+        for job_id in list(self._stash.keys()):
+            self._stash.pop(job_id)
+        # parked workers are woken up to take their termination token
+        self._set_active(len(self._workers))
+        for _ in range(len(self._workers)):
+            self._input_queue.put(TERMINATION_TOKEN)
+        for worker in self._workers:
+            worker.join(timeout=1.)
+            if worker.is_alive():
+                worker.terminate()
+        self._workers = []
+
+
+class _PoolJob(object):
+    """One pass of a reader through the WorkerPool"""
+
+    def __init__(self, pool, job_id, name, reader, max_inflight, after=None):
+        self.pool = pool
+        self.job_id = job_id
+        self.name = name
+        self.reader = reader
+        self.after = after
+
+        self.credits = threading.Semaphore(max_inflight)
+        self.leased = collections.deque()
+        self.cancelled = False
+        self.received = 0
+        self.total = None
+
+        self._feeder = threading.Thread(target=self._feed)
+        self._feeder.daemon = True
+
+    def start(self):
+        self._feeder.start()
+
+    def _feed(self):
+        if self.after is not None:
+            self.after._feeder.join()
+
+        sent = 0
+        for data_chunk in self.reader:
+            self.credits.acquire()
+            if self.cancelled:
+                return
+            self.pool._input_queue.put((self.job_id, self.name, sent, data_chunk))
+            sent += 1
+        self.total = sent
+        # wake up the consumer in case it waits for a chunk that never comes
+        self.pool._output_queue.put((self.job_id, -1, TERMINATION_TOKEN))
+
+    def __iter__(self):
+        while True:
+            data_chunk = self.pool._next(self)
+            if data_chunk is None:
+                break
             yield data_chunk
 
+    def close(self):
+        """Stop feeding and release shared memory held by consumed chunks"""
+        if not self.cancelled:
+            self.pool._close_job(self)
+
+    def __del__(self):
+        self.close()
+
+
+class _PoolWorker(Process):
+    """Worker process of WorkerPool"""
+
+    def __init__(self, pool, index):
+        super(_PoolWorker, self).__init__()
+        self._pool = pool
+        self._index = index
+
+    def run(self):
+        while True:
+            with self._pool._parking:
+                while self._index >= self._pool._active.value:
+                    self._pool._parking.wait()
+
+            task = self._pool._input_queue.get()
+            if task == TERMINATION_TOKEN:
+                break
+            job_id, name, seq, data_chunk = task
+            data_chunk = self._pool.process(name, data_chunk)
+
+            start_time = time.time()
+            self._pool._output_queue.put((job_id, seq, data_chunk))
+            with self._pool._producer_wait.get_lock():
+                self._pool._producer_wait.value += time.time() - start_time
+
 
 class _ParallelWorker(Process):
     """Worker to execute data reading or processing on a separate process."""
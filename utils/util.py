@@ -12,57 +12,8 @@ import numpy as np
 import tensorflow as tf
 
 from utils import dtype
-
-
-def batch_indexer(datasize, batch_size):
-    """Just divide the datasize into batched size"""
-    dataindex = np.arange(datasize).tolist()
-
-    batchindex = []
-    for i in range(datasize // batch_size):
-        batchindex.append(dataindex[i * batch_size: (i + 1) * batch_size])
-    if datasize % batch_size > 0:
-        batchindex.append(dataindex[-(datasize % batch_size):])
-
-    return batchindex
-
-
-def token_indexer(dataset, token_size):
-    """Divide the dataset into token-based batch"""
-    # assume dataset format: [(len1, len2, ..., lenN)]
-    dataindex = np.arange(len(dataset)).tolist()
-
-    batchindex = []
-
-    _batcher = [0.] * len(dataset[0])
-    _counter = 0
-    i = 0
-    while True:
-        if i >= len(dataset): break
-
-        # attempt put this datapoint into batch
-        _batcher = [max(max_l, l)
-                    for max_l, l in zip(_batcher, dataset[i])]
-        _counter += 1
-        for l in _batcher:
-            if _counter * l >= token_size:
-                # when an extreme instance occur, handle it by making a 1-size batch
-                if _counter > 1:
-                    batchindex.append(dataindex[i - _counter + 1: i])
-                    i -= 1
-                else:
-                    batchindex.append(dataindex[i: i + 1])
-
-                _counter = 0
-                _batcher = [0.] * len(dataset[0])
-                break
-
-        i += 1
-
-    _counter = sum([len(slice) for slice in batchindex])
-    if _counter != len(dataset):
-        batchindex.append(dataindex[_counter:])
-    return batchindex
+# batching algorithms live in a tensorflow-free module, kept here for compatibility
+from utils.batching import batch_indexer, token_indexer
 
 
 def mask_scale(value, mask, scale=None):
@@ -294,6 +245,12 @@ def remove_invalid_seq(sequence, mask):
     return filtered_seq, filtered_mask
 
 
+def fit_length(sequence, length):
+    """Zero-pad or cut a [batch, sequence] tensor to the given length"""
+    pad = tf.maximum(length - tf.shape(sequence)[1], 0)
+    return tf.pad(sequence, [[0, 0], [0, pad]])[:, :length]
+
+
 def time_str(t=None):
     """String format of the time long data"""
     if t is None:
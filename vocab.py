@@ -4,7 +4,16 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+import json
+import heapq
+import hashlib
 import argparse
+import collections
+import multiprocessing
+import numpy as np
+
+from utils.indexed import IndexedArrayBuilder
 
 
 class Vocab(object):
@@ -36,6 +45,11 @@ class Vocab(object):
     def size(self):
         return len(self.word2id)
 
+    def digest(self):
+        """Hash of the tokens in id order, changed by any token or order difference"""
+        tokens = "\n".join(self.id2word[id] for id in range(self.size()))
+        return hashlib.md5(tokens.encode('utf-8')).hexdigest()
+
     def load_vocab(self, vocab_file):
         with open(vocab_file, 'r', encoding='utf-8') as reader:
             for token in reader:
@@ -82,21 +96,103 @@ class Vocab(object):
         return self.get_id(self.pad_sym)
 
 
+def _count_range(path, start, end):
+    """Count the tokens of the lines starting within bytes [start, end) of the file"""
+    counter = collections.Counter()
+    with open(path, 'rb') as reader:
+        if start > 0:
+            # move to the first line starting at or after `start`
+            reader.seek(start - 1)
+            reader.readline()
+        while reader.tell() < end:
+            line = reader.readline()
+            if not line:
+                break
+            counter.update(line.decode('utf-8').split())
+    return counter
+
+
+def count_tokens(path, num_workers=1):
+    """Token counts of a text file, counted over byte ranges in parallel
+
+    Keys follow the order of first occurrence in the file, as Vocab.insert would see them:
+    per-range counters keep it, and they are merged in file order.
+    """
+    size = os.path.getsize(path)
+    num_ranges = max(1, min(num_workers * 4, size // (1 << 20)))
+    bounds = [size * i // num_ranges for i in range(num_ranges + 1)]
+    ranges = [(path, bounds[i], bounds[i + 1]) for i in range(num_ranges)]
+
+    if num_workers > 1 and num_ranges > 1:
+        pool = multiprocessing.Pool(num_workers)
+        counters = pool.starmap(_count_range, ranges)
+        pool.close()
+        pool.join()
+    else:
+        counters = [_count_range(*r) for r in ranges]
+
+    counts = collections.Counter()
+    for counter in counters:
+        counts.update(counter)
+    return counts
+
+
+def build_vocab(path, size=1e6, min_freq=1, num_workers=1):
+    """Vocabulary of a text file, the same as inserting all its tokens and calling sort_vocab
+
+    Tokens are ranked by frequency, ties by first occurrence; only the top `size` entries
+    (special symbols included) are kept, selected with a heap, and those seen fewer than
+    `min_freq` times are dropped.
+    Returns the vocabulary and the number of distinct tokens.
+    """
+    counts = count_tokens(path, num_workers)
+
+    vocab = Vocab()
+    candidates = [(-count, order, token) for order, (token, count) in enumerate(counts.items())
+                  if count >= min_freq and token not in vocab.word2id]
+    top_k = max(int(size) - vocab.size(), 0)
+    for _, _, token in heapq.nsmallest(top_k, candidates):
+        vocab.insert(token)
+
+    return vocab, len(set(counts) | set(vocab.word2id))
+
+
+def binarize(vocab_file, input, output):
+    """Convert a text file into token ids (eos included, untruncated) at output.bin/.idx
+    Trainers read them via memory map, see `tgt_train_bin` and `ctc_train_bin`.
+    """
+    vocab = Vocab(vocab_file)
+    builder = IndexedArrayBuilder(output, np.int32)
+    with open(input, 'r', encoding='utf-8') as reader:
+        for line in reader:
+            builder.add(vocab.to_id(line.strip().split()))
+    builder.finalize()
+
+    with open(output + ".json", 'w', encoding='utf-8') as writer:
+        json.dump({'vocab_file': vocab_file, 'vocab_size': vocab.size(), 'vocab_hash': vocab.digest(),
+                   'lines': len(builder)}, writer)
+    return len(builder)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser('Vocabulary Preparison')
     parser.add_argument('--size', type=int, default=1e6, help='maximum vocabulary size')
+    parser.add_argument('--min_freq', type=int, default=1, help='minimum token frequency')
+    parser.add_argument('--workers', type=int, default=1, help='number of counting processes')
+    parser.add_argument('--binarize', type=str, default='',
+                        help='binarize the input with this vocabulary into output.bin/.idx, '
+                             'instead of building a vocabulary')
     parser.add_argument('input', type=str, help='the input file path')
     parser.add_argument('output', type=str, help='the output file name')
 
     args = parser.parse_args()
 
-    vocab = Vocab()
-    with open(args.input, 'r', encoding='utf-8') as reader:
-        for line in reader:
-            for token in line.strip().split():
-                vocab.insert(token)
-
-    vocab.sort_vocab()
-    vocab.save_vocab(args.output, args.size)
+    if args.binarize != '':
+        lines = binarize(args.binarize, args.input, args.output)
+        print("Binarizing {} lines from {} into {}.bin".format(lines, args.input, args.output))
+    else:
+        vocab, num_tokens = build_vocab(args.input, args.size, args.min_freq, args.workers)
+        vocab.save_vocab(args.output, args.size)
 
-    print("Loading {} tokens from {}".format(vocab.size(), args.input))
+        print("Loading {} tokens from {}, saving {} into {}".format(
+            num_tokens, args.input, min(vocab.size(), int(args.size)), args.output))